@@ -2,21 +2,79 @@
 import os
 import sqlite3
 import json
+import hashlib
+import hmac
+import math
+import mimetypes
+import multiprocessing
+import atexit
+import base64
+import bisect
 from datetime import datetime
 from io import BytesIO
 import re
+import posixpath
+import random
+import shutil
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
-import requests
+from types import SimpleNamespace
+from urllib.parse import quote
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # ไม่บังคับติดตั้ง ไม่มีก็บีบ response ด้วย gzip อย่างเดียว
+    brotli = None
 
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, session, flash, send_file, abort, Response
+    url_for, session, flash, send_file, abort, Response,
+    g, has_request_context, jsonify, current_app
 )
+from flask.globals import _cv_app
 
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, quote_etag, unquote_etag
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
 
 app = Flask(__name__)
 
+
+class Settings:
+    """ค่าตั้งของแอปที่กำลังทำงาน: ``settings.DB_PATH`` คือ ``current_app.config["DB_PATH"]``
+
+    ค่าคงที่ระดับโมดูล (อ่านจาก env) เป็นแค่ค่าเริ่มต้นของ app.config แอปแต่ละตัวที่ create_app(config) สร้าง
+    มีค่าของตัวเอง นอก app context (thread เบื้องหลัง / atexit) ใช้ค่าของแอประดับโมดูล
+    """
+
+    __slots__ = ()
+
+    def __getattribute__(self, name):
+        # ถูกเรียกหลายสิบครั้งต่อ request: อ่าน context var ของ Flask ตรง ๆ แทน current_app (LocalProxy)
+        # และใช้ __getattribute__ แทน __getattr__ (ไม่ต้องค้นแอตทริบิวต์ปกติให้พลาดก่อน) เร็วกว่าราว 5 เท่า
+        ctx = _cv_app.get(None)
+        config = (ctx.app if ctx is not None else app).config
+        try:
+            return config[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+settings = Settings()
+
 TURNSTILE_SITE_KEY = os.getenv("TURNSTILE_SITE_KEY", "")
 TURNSTILE_SECRET_KEY = os.getenv("TURNSTILE_SECRET_KEY", "")
 
@@ -26,17 +84,19 @@ def verify_turnstile(token, remote_ip=None):
     ตรวจสอบ token จาก Cloudflare Turnstile
     ถ้าไม่ได้ตั้งค่า key ไว้ ให้ถือว่าผ่านอัตโนมัติ (กันล็อกอิน/สมัครไม่ได้)
     """
-    if not (TURNSTILE_SITE_KEY and TURNSTILE_SECRET_KEY):
+    if not (settings.TURNSTILE_SITE_KEY and settings.TURNSTILE_SECRET_KEY):
         return True
 
     if not token:
         return False
 
+    import requests
+
     try:
         resp = requests.post(
             "https://challenges.cloudflare.com/turnstile/v0/siteverify",
             data={
-                "secret": TURNSTILE_SECRET_KEY,
+                "secret": settings.TURNSTILE_SECRET_KEY,
                 "response": token,
                 "remoteip": remote_ip or "",
             },
@@ -51,7 +111,7 @@ def verify_turnstile(token, remote_ip=None):
 @app.context_processor
 def inject_globals():
     # ให้ใช้ตัวแปร TURNSTILE_SITE_KEY ได้ในทุก template
-    return {"TURNSTILE_SITE_KEY": TURNSTILE_SITE_KEY}
+    return {"TURNSTILE_SITE_KEY": settings.TURNSTILE_SITE_KEY}
 
 
 
@@ -69,6 +129,21 @@ def thdt(value):
 app.jinja_env.filters['thdt']=thdt
 
 
+def human_bytes(value):
+    """แปลงจำนวนไบต์เป็นข้อความอ่านง่าย เช่น 1.5 GB"""
+    try:
+        size = float(value or 0)
+    except Exception:
+        return value
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+app.jinja_env.filters['human_bytes']=human_bytes
+
+
 # ---------- Admin login defaults (reset every restart) ----------
 DEFAULT_ADMIN_USERNAME = "admin"
 DEFAULT_ADMIN_PASSWORD = "1234"
@@ -79,22 +154,274 @@ current_admin_password = DEFAULT_ADMIN_PASSWORD
 
 DB_PATH = "videos.db"
 BASE_DIR = os.path.dirname(__file__)
-VIDEO_ROOT = os.path.join(BASE_DIR, "video_files")
+VIDEO_ROOT = os.environ.get("VIDEO_ROOT", os.path.join(BASE_DIR, "video_files"))
 COVER_ROOT = os.path.join(BASE_DIR, "static", "covers")
 EPISODE_COVER_ROOT = os.path.join(COVER_ROOT, "episodes")
 
-os.makedirs(VIDEO_ROOT, exist_ok=True)
-os.makedirs(COVER_ROOT, exist_ok=True)
-os.makedirs(EPISODE_COVER_ROOT, exist_ok=True)
+# โควตาพื้นที่แคชไฟล์วิดีโอที่โหลดมาจาก Google Drive (หน่วยไบต์) ตั้งเป็น 0 = ไม่จำกัด
+VIDEO_CACHE_QUOTA_BYTES = int(os.environ.get("VIDEO_CACHE_QUOTA_BYTES", "0") or 0)
+# บันทึกเวลาเข้าถึงไฟล์เดิมซ้ำได้ไม่บ่อยกว่านี้ (วินาที) กันเขียน DB ทุกครั้งที่ player ขอ range
+VIDEO_CACHE_TOUCH_INTERVAL = int(os.environ.get("VIDEO_CACHE_TOUCH_INTERVAL", "60") or 60)
+
+# URL สำหรับโหลดไฟล์ Drive ตรง ๆ ({id} = drive_id) เปลี่ยนเป็นเซิร์ฟเวอร์จำลองได้ตอนทดสอบ
+DRIVE_DOWNLOAD_URL = os.environ.get(
+    "DRIVE_DOWNLOAD_URL",
+    "https://drive.usercontent.google.com/download?id={id}&export=download&confirm=t",
+)
+# จำนวน connection ที่ใช้โหลดไฟล์เดียวพร้อมกัน
+DRIVE_DOWNLOAD_SEGMENTS = max(1, int(os.environ.get("DRIVE_DOWNLOAD_SEGMENTS", "4") or 1))
+
+# โหลดตอนถัดไปของเรื่องล่วงหน้ากี่ตอนเมื่อเริ่มดูตอนหนึ่ง (0 = ปิด prefetch)
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", "2") or 0)
+# จำนวนไฟล์ที่ prefetch พร้อมกันได้สูงสุดต่อ process
+PREFETCH_CONCURRENCY = max(1, int(os.environ.get("PREFETCH_CONCURRENCY", "2") or 1))
+# แบนด์วิดท์รวมของ prefetch (ไบต์/วินาที) 0 = ไม่จำกัด
+PREFETCH_BANDWIDTH_BYTES = int(os.environ.get("PREFETCH_BANDWIDTH_BYTES", "0") or 0)
+# จำนวนงาน prefetch ที่รอคิวได้สูงสุด เกินนี้จะไม่รับงานเพิ่ม
+PREFETCH_QUEUE_LIMIT = int(os.environ.get("PREFETCH_QUEUE_LIMIT", "32") or 32)
+# จำนวนตอนที่ prefetch ล่วงหน้าสำหรับเรื่องยอดนิยม (ดูจากแบนด์วิดท์ที่สตรีมออกไป)
+PREFETCH_DEPTH_HOT = int(os.environ.get("PREFETCH_DEPTH_HOT", str(PREFETCH_DEPTH * 2)) or 0)
+
+# ขนาดก้อนที่อ่านจากไฟล์ต่อครั้งตอนสตรีมวิดีโอ
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(256 * 1024)) or 256 * 1024)
+# เขียนยอดไบต์ที่สตรีมออกไป (สะสมในหน่วยความจำ) ลง videos.db ทุกกี่วินาที
+BANDWIDTH_FLUSH_INTERVAL = float(os.environ.get("BANDWIDTH_FLUSH_INTERVAL", "30") or 30)
+# "เรื่องยอดนิยม" = HOT_SERIES_COUNT เรื่องที่ใช้แบนด์วิดท์มากที่สุดใน HOT_SERIES_WINDOW_HOURS ชั่วโมงล่าสุด
+# ไฟล์ของเรื่องยอดนิยมถูกลบออกจากแคชทีหลังสุด และ prefetch ลึกกว่าปกติ
+HOT_SERIES_WINDOW_HOURS = int(os.environ.get("HOT_SERIES_WINDOW_HOURS", "24") or 24)
+HOT_SERIES_COUNT = int(os.environ.get("HOT_SERIES_COUNT", "10") or 0)
+
+# จำนวนตอนที่ผู้ใช้เปิดดูพร้อมกันได้สูงสุด (รวมทุก worker, Range request ของการดูเดียวกันนับเป็นหนึ่ง) 0 = ไม่จำกัด
+STREAM_MAX_CONCURRENT = int(os.environ.get("STREAM_MAX_CONCURRENT", "0") or 0)
+# แบนด์วิดท์รวมต่อผู้ใช้ (ไบต์/วินาที รวมทุกสตรีมทุก worker) 0 = ไม่จำกัด
+STREAM_USER_RATE_BYTES = int(os.environ.get("STREAM_USER_RATE_BYTES", "0") or 0)
+# ไบต์ที่ส่งรวดเดียวได้ก่อนเริ่มโดนจำกัด (0 = 10 วินาทีของ STREAM_USER_RATE_BYTES)
+STREAM_USER_BURST_BYTES = int(os.environ.get("STREAM_USER_BURST_BYTES", "0") or 0)
+# ขอ token จาก bucket กลางครั้งละกี่ไบต์ (มากขึ้น = แตะ runtime.db น้อยลง แต่จำกัดหยาบขึ้น)
+STREAM_TOKEN_GRANT_BYTES = int(os.environ.get("STREAM_TOKEN_GRANT_BYTES", str(1024 * 1024)) or 1024 * 1024)
+# ถ้าสตรีมใหม่ต้องรอ token นานกว่านี้ (วินาที) ตอบ 429 ทันทีแทนการส่งช้า ๆ
+STREAM_RATE_MAX_WAIT = float(os.environ.get("STREAM_RATE_MAX_WAIT", "5") or 0)
+# การดูที่ไม่ได้ต่ออายุเกินกี่วินาทีถือว่าจบแล้ว (worker ตายกลางทาง)
+STREAM_LEASE_TTL = float(os.environ.get("STREAM_LEASE_TTL", "60") or 60)
+# การดูที่ไม่มี request ค้างอยู่เกินกี่วินาทีถือว่าจบแล้ว (ดูจบ / ผู้ชมปิดไป) ตอนใหม่จึงเปิดต่อได้เกือบทันที
+STREAM_LEASE_IDLE_GRACE = float(os.environ.get("STREAM_LEASE_IDLE_GRACE", "5") or 0)
+
+# key สำหรับลงชื่อลิงก์สตรีม (คั่นด้วย , ได้หลายค่า: ตัวแรกใช้ลงชื่อ ทุกตัวใช้ตรวจ ไว้สลับ key แบบไม่สะดุด)
+# ว่าง = สร้างจาก SECRET_KEY เปลี่ยน/ถอด key เก่าออก = ยกเลิกลิงก์ที่ออกไปแล้วทั้งหมด
+STREAM_TOKEN_KEYS = os.environ.get("STREAM_TOKEN_KEYS", "")
+# อายุลิงก์สตรีม (วินาที) 0 = ปิด ใช้ session + DB ทุก request แบบเดิม
+STREAM_TOKEN_TTL = int(os.environ.get("STREAM_TOKEN_TTL", str(4 * 3600)) or 0)
+
+# ให้ proxy ด้านหน้าส่งไฟล์วิดีโอแทน worker ของ Python (ดู nginx.conf.example)
+# "" = ส่งเอง, "nginx" = X-Accel-Redirect, "sendfile" = X-Sendfile (Apache mod_xsendfile / lighttpd)
+STREAM_OFFLOAD = os.environ.get("STREAM_OFFLOAD", "").strip().lower()
+# location แบบ internal ของ nginx ที่ alias ไปยัง VIDEO_ROOT
+STREAM_OFFLOAD_PREFIX = os.environ.get("STREAM_OFFLOAD_PREFIX", "/_protected_video/")
+
+# worker ตรวจว่า process อื่นแก้ข้อมูลที่แคชไว้หรือไม่ ไม่บ่อยกว่านี้ (วินาที, 0 = ทุก request)
+CACHE_CHECK_INTERVAL = float(os.environ.get("CACHE_CHECK_INTERVAL", "1") or 0)
+
+# จำนวนรายการต่อหน้าของ /api/v1 (ค่าเริ่มต้น / สูงสุดที่ขอผ่าน ?limit= ได้)
+API_PAGE_SIZE = int(os.environ.get("API_PAGE_SIZE", "50") or 50)
+API_MAX_PAGE_SIZE = int(os.environ.get("API_MAX_PAGE_SIZE", "200") or 200)
+
+# วิธีแฮชรหัสผ่าน (รูปแบบของ werkzeug) เปลี่ยนค่านี้แล้วรหัสเดิมจะถูกแฮชใหม่ตอนผู้ใช้ล็อกอินครั้งถัดไป
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+# จำนวน process ที่แฮชรหัสผ่านต่อ worker (0 = แฮชใน thread ของ request แบบเดิม)
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2") or 0)
+# งานแฮชที่รอ/กำลังทำได้พร้อมกันต่อ worker เกินนี้ตอบ "ระบบไม่ว่าง" ทันที (503 + Retry-After)
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get("PASSWORD_HASH_QUEUE_LIMIT", "4") or 4)
+# รอผลแฮชนานสุดกี่วินาที
+PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", "10") or 10)
+
+# จำนวนผู้ใช้ต่อหน้าในหน้าจัดการผู้ใช้ของแอดมิน
+ADMIN_USERS_PAGE_SIZE = int(os.environ.get("ADMIN_USERS_PAGE_SIZE", "100") or 100)
+
+# จำนวนคำแนะนำสูงสุดที่ /search/suggest ตอบต่อครั้ง (?limit= ขอน้อยกว่านี้ได้)
+SUGGEST_LIMIT = int(os.environ.get("SUGGEST_LIMIT", "8") or 8)
+
+# บีบอัด response ที่เป็นข้อความ (HTML/JSON/CSS/JS) ด้วย br หรือ gzip ตาม Accept-Encoding (0 = ปิด)
+COMPRESS_ENABLED = os.environ.get("COMPRESS_ENABLED", "1") != "0"
+# body เล็กกว่านี้ (ไบต์) ส่งตรง ๆ ประหยัดได้ไม่คุ้ม CPU
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024") or 0)
+# ระดับการบีบของ gzip (1-9) และ brotli (0-11)
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6") or 6)
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", "5") or 5)
+# body ที่รู้ขนาดและไม่เกินนี้บีบทีเดียวทั้งก้อน (และแคชผลได้) ใหญ่กว่านี้/ไม่รู้ขนาด บีบทีละก้อนระหว่างส่ง
+COMPRESS_BUFFER_MAX = int(os.environ.get("COMPRESS_BUFFER_MAX", str(1024 * 1024)))
+# แคชผลการบีบตาม hash ของเนื้อหา รวมไม่เกินกี่ไบต์ต่อ process (0 = ไม่แคช)
+COMPRESS_CACHE_BYTES = int(os.environ.get("COMPRESS_CACHE_BYTES", str(8 * 1024 * 1024)) or 0)
+
+# ฐานข้อมูลสถิติระหว่างรัน (metrics ฯลฯ) ใช้ร่วมกันทุก worker แยกจาก videos.db ลบทิ้งได้ทุกเมื่อ
+RUNTIME_DB_PATH = os.environ.get("RUNTIME_DB_PATH", "runtime.db")
+# เก็บ metrics ต่อ route (0 = ปิด)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+# เขียน metrics ที่สะสมในหน่วยความจำลง runtime.db ทุกกี่วินาที
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "10") or 10)
+# token สำหรับ Prometheus scrape /admin/metrics (Authorization: Bearer <token>) ว่าง = ต้องล็อกอินแอดมิน
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# คำสั่ง SQL ที่ใช้เวลาเกินนี้ (มิลลิวินาที) จะถูกบันทึกลง slow query log
+SQL_SLOW_MS = float(os.environ.get("SQL_SLOW_MS", "100") or 100)
+# เก็บ slow query ล่าสุดไว้กี่รายการ (ring buffer ใน runtime.db)
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("SLOW_QUERY_LOG_SIZE", "500") or 500)
+# 1 = log ทุกคำสั่ง SQL ที่รันจริง (รวมคำสั่งใน trigger) พร้อมเวลาและ view ที่เรียก (ใช้ตอนพัฒนา)
+SQL_TRACE = os.environ.get("SQL_TRACE", "0") != "0"
+# จำนวนคำสั่ง SQL สูงสุดต่อ request (0 = ไม่ตรวจ) เกินแล้วบันทึกลง slow query log
+SQL_QUERY_BUDGET = int(os.environ.get("SQL_QUERY_BUDGET", "0") or 0)
+# 1 = request ที่ใช้ SQL เกินงบจะล้มทันที (ใช้ตอนพัฒนา/ทดสอบ จับ N+1 query)
+SQL_BUDGET_ENFORCE = os.environ.get("SQL_BUDGET_ENFORCE", "0") != "0"
+
+# โฟลเดอร์เก็บไฟล์ profile (.pstats / .collapsed) ที่เก็บจาก request จริง
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# เก็บไฟล์ profile ล่าสุดไว้กี่ไฟล์
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "200") or 200)
+# worker อ่านค่าตั้ง profiler (เปิด/ปิดจากหน้าแอดมิน) ใหม่ทุกกี่วินาที
+PROFILER_REFRESH_INTERVAL = float(os.environ.get("PROFILER_REFRESH_INTERVAL", "5") or 5)
+# ช่วงเวลาระหว่างการเก็บ stack แต่ละครั้งในโหมด sampling (วินาที)
+PROFILER_SAMPLE_INTERVAL = float(os.environ.get("PROFILER_SAMPLE_INTERVAL", "0.005") or 0.005)
+
+# ที่เก็บไฟล์วิดีโอแบบตั้งชื่อตาม hash ของเนื้อไฟล์ (ไฟล์เนื้อหาเดียวกันเก็บแค่ชุดเดียว)
+BLOB_ROOT = os.path.join(VIDEO_ROOT, "blobs")
+# โฟลเดอร์พักไฟล์ระหว่างโหลด/อัปโหลด ต้องอยู่ดิสก์เดียวกับ BLOB_ROOT เพื่อย้ายไฟล์ได้ทันที
+BLOB_TMP_ROOT = os.path.join(VIDEO_ROOT, "tmp")
+
+# ที่เก็บไฟล์วิดีโอ/รูปปก: "local" = ดิสก์ของเครื่องนี้, "s3" = S3 หรือที่เข้ากันได้ (MinIO) ใช้ร่วมกันได้หลายเครื่อง
+MEDIA_STORAGE = os.environ.get("MEDIA_STORAGE", "local").strip().lower() or "local"
+S3_BUCKET = os.environ.get("S3_BUCKET", "")
+# คำนำหน้า key ของทุกไฟล์ใน bucket (เช่น "myseries/")
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+# endpoint ของ MinIO / S3-compatible (ว่าง = AWS)
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL", "")
+S3_REGION = os.environ.get("S3_REGION", "")
+# ว่างไว้ = ใช้ credential ตามปกติของ boto3 (AWS_ACCESS_KEY_ID, ~/.aws, IAM role)
+S3_ACCESS_KEY_ID = os.environ.get("S3_ACCESS_KEY_ID", "")
+S3_SECRET_ACCESS_KEY = os.environ.get("S3_SECRET_ACCESS_KEY", "")
+# ไฟล์ที่ใหญ่กว่านี้อัปโหลดแบบ multipart ทีละ part ขนาดนี้ (ขั้นต่ำของ S3 คือ 5 MB)
+S3_MULTIPART_CHUNK_SIZE = max(
+    5 * 1024 * 1024, int(os.environ.get("S3_MULTIPART_CHUNK_SIZE", str(16 * 1024 * 1024)) or 0)
+)
+# จำนวน part ที่อัปโหลดพร้อมกันต่อไฟล์
+S3_UPLOAD_CONCURRENCY = max(1, int(os.environ.get("S3_UPLOAD_CONCURRENCY", "4") or 1))
+# connection ไป S3 ที่เปิดค้างได้ต่อ process (สตรีมหนึ่งสตรีมถือหนึ่ง connection ระหว่างส่ง)
+S3_MAX_CONNECTIONS = max(1, int(os.environ.get("S3_MAX_CONNECTIONS", "64") or 1))
+# จำขนาด/เวลาแก้ไขของไฟล์ไว้กี่วินาที (Range request ของ player ไม่ต้อง HEAD ทุกครั้ง, 0 = ไม่จำ)
+S3_STAT_CACHE_TTL = float(os.environ.get("S3_STAT_CACHE_TTL", "30") or 0)
 
 # ใช้ secret key แบบง่าย ๆ ถ้ายังไม่ตั้งค่า
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-key")
 
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+class QueryBudgetExceeded(RuntimeError):
+    """request ใช้คำสั่ง SQL เกิน SQL_QUERY_BUDGET (เฉพาะเมื่อ SQL_BUDGET_ENFORCE=1)"""
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor ที่จับเวลาทุกคำสั่ง SQL แล้วนับรวมเข้ากับ request ปัจจุบัน (metrics / slow query log)"""
+
+    _sql = None
+
+    def _timed(self, sql, run, count=1):
+        start = time.perf_counter()
+        try:
+            return run()
+        finally:
+            record_query(time.perf_counter() - start, sql, count)
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        return self._timed(sql, lambda: super(TracedCursor, self).execute(sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        return self._timed(sql, lambda: super(TracedCursor, self).executemany(sql, seq_of_parameters))
+
+    def executescript(self, sql_script):
+        self._sql = sql_script
+        return self._timed(sql_script, lambda: super(TracedCursor, self).executescript(sql_script))
+
+    # เวลาอ่านผลลัพธ์ก็นับรวมด้วย (SQLite ทำงานจริงตอน step แต่ละแถว) แต่ไม่นับเป็น query ใหม่
+    def fetchone(self):
+        return self._timed(self._sql, super().fetchone, count=0)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._timed(self._sql, lambda: super(TracedCursor, self).fetchmany(*args, **kwargs), count=0)
+
+    def fetchall(self):
+        return self._timed(self._sql, super().fetchall, count=0)
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection ที่ทุก cursor (รวม conn.execute) เป็น TracedCursor"""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        super().commit()
+        # process นี้เพิ่งแก้ข้อมูล ให้ตรวจ cache_epochs ใน request ถัดไปเลย ไม่ต้องรอรอบ CACHE_CHECK_INTERVAL
+        if self.total_changes:
+            mark_cache_dirty(self.db_path)
+
+
+def _query_caller() -> str:
+    """ชื่อ view ที่กำลังรัน SQL (นอก request ใช้ชื่อ thread เช่นงาน prefetch)"""
+    if has_request_context():
+        return request.endpoint or "unmatched"
+    return threading.current_thread().name
+
+
+def _trace_statement(statement: str):
+    # trace callback ของ SQLite: ได้ข้อความคำสั่งที่รันจริงทีละคำสั่ง (รวม executescript และ trigger)
+    if has_request_context():
+        g.setdefault("sql_trace", []).append(statement)
+    else:
+        app.logger.info("sql [%s] %s", _query_caller(), statement)
+
+
+def record_query(seconds: float, sql: str | None = None, count: int = 1):
+    """สะสมจำนวน/เวลา SQL ของ request ปัจจุบันไว้ใน g และตรวจ slow query / งบจำนวน query"""
+    in_request = has_request_context()
+    if in_request:
+        stats = g.setdefault("sql_stats", [0, 0.0])
+        stats[0] += count
+        stats[1] += seconds
+        if count and settings.SQL_QUERY_BUDGET and stats[0] > settings.SQL_QUERY_BUDGET and not g.get("sql_budget_hit"):
+            g.sql_budget_hit = True
+            log_slow_query(_query_caller(), sql, seconds, kind="budget", queries=stats[0])
+            if settings.SQL_BUDGET_ENFORCE:
+                raise QueryBudgetExceeded(
+                    f"{_query_caller()} ใช้คำสั่ง SQL เกินงบ {settings.SQL_QUERY_BUDGET} คำสั่งต่อ request"
+                )
+
+    if settings.SQL_TRACE and in_request and count:
+        statements = g.pop("sql_trace", None) or [sql]
+        app.logger.info(
+            "sql [%s] %.2f ms %s", _query_caller(), seconds * 1000, " ; ".join(map(str, statements))
+        )
+
+    if sql is not None and seconds * 1000 >= settings.SQL_SLOW_MS:
+        log_slow_query(_query_caller(), sql, seconds, kind="execute" if count else "fetch")
+
+
+def get_db_connection(path: str | None = None):
+    """connection ไปยัง videos.db ของแอปปัจจุบัน (หรือไฟล์ ``path``)"""
+    path = path or settings.DB_PATH
+    conn = sqlite3.connect(path, factory=TracedConnection)
+    conn.db_path = path
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON;")
+    if settings.SQL_TRACE:
+        conn.set_trace_callback(_trace_statement)
     return conn
 
 
@@ -130,6 +457,16 @@ def generate_user_key() -> str:
     return "U" + os.urandom(8).hex().upper()
 
 
+def backfill_user_keys(conn: sqlite3.Connection):
+    """เติม user_key ให้ผู้ใช้ที่ยังไม่มี ด้วย UPDATE คำสั่งเดียว (รูปแบบเดียวกับ generate_user_key)"""
+    conn.execute(
+        """
+        UPDATE users SET user_key = 'U' || upper(hex(randomblob(8)))
+        WHERE user_key IS NULL OR user_key = ''
+        """
+    )
+
+
 def ensure_user_extra_columns(conn: sqlite3.Connection):
     """เพิ่มคอลัมน์ user_key และ plain_password ให้ตาราง users ถ้ายังไม่มี
     และเติมค่า user_key อัตโนมัติถ้ายังเป็นค่าว่าง"""
@@ -140,28 +477,24 @@ def ensure_user_extra_columns(conn: sqlite3.Connection):
         conn.execute("ALTER TABLE users ADD COLUMN user_key TEXT")
     if "plain_password" not in cols:
         conn.execute("ALTER TABLE users ADD COLUMN plain_password TEXT")
-    conn.commit()
 
     # เติม key ให้ผู้ใช้ที่ยังไม่มี
-    cur = conn.execute("SELECT id, user_key FROM users")
-    rows = cur.fetchall()
-    for r in rows:
-        try:
-            current_key = r["user_key"]
-        except Exception:
-            current_key = r[1]
-        if not current_key:
-            new_key = generate_user_key()
-            conn.execute("UPDATE users SET user_key = ? WHERE id = ?", (new_key, r[0]))
+    backfill_user_keys(conn)
     conn.commit()
 
 
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
+# ---------- Migration ของฐานข้อมูล ----------
+# เวอร์ชัน schema เก็บไว้ใน PRAGMA user_version ของไฟล์ DB
+# worker ทุกตัวแค่อ่านเลขเวอร์ชันตอนเริ่ม (ไม่ต้อง probe ตาราง/ไล่ทุกแถว)
+# ถ้ายังไม่ล่าสุด จะมี process เดียวรัน migration ภายใต้ file lock ที่เหลือรอ
+# หรือสั่งรันเองก่อนบูตด้วย `flask --app app migrate-db`
+# migration แต่ละขั้นต้องรันซ้ำได้ (ใช้ IF NOT EXISTS) เผื่อล้มกลางทาง
+
 
+def _migration_001_base_schema(conn: sqlite3.Connection):
+    """ตารางหลักของระบบ + คอลัมน์ที่เพิ่มมาในเวอร์ชันเก่า (DB เดิมที่ยังไม่มี user_version เริ่มที่ขั้นนี้)"""
     # ตารางเรื่อง
-    cur.execute(
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS series (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -174,7 +507,7 @@ def init_db():
     )
 
     # ตารางตอน (เวอร์ชันใหม่มี thumbnail_url)
-    cur.execute(
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS episodes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -198,7 +531,7 @@ def init_db():
     ensure_visibility_columns(conn)
 
     # ตารางผู้ใช้ทั่วไป
-    cur.execute(
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -210,7 +543,7 @@ def init_db():
     )
 
     # ตารางประวัติการดู
-    cur.execute(
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS watch_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -227,11 +560,304 @@ def init_db():
 
     ensure_user_extra_columns(conn)
 
-    conn.commit()
+
+def _migration_002_video_cache(conn: sqlite3.Connection):
+    """ตารางแคชไฟล์วิดีโอจาก Google Drive (ขนาด เวลาสตรีมล่าสุด หมุด และสถิติ)"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS video_cache (
+            file_path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            last_access TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_video_cache_last_access ON video_cache(last_access)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_episodes_file_path ON episodes(file_path)"
+    )
+
+    # เรื่องที่ปักหมุดไว้ ไฟล์ของเรื่องเหล่านี้จะไม่ถูกลบออกจากแคช
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS video_cache_pins (
+            series_id INTEGER PRIMARY KEY,
+            pinned_at TEXT NOT NULL,
+            FOREIGN KEY(series_id) REFERENCES series(id) ON DELETE CASCADE
+        )
+        """
+    )
+
+    # ตัวนับสถิติแคช (hits, misses, evictions, ...) ใช้ร่วมกันทุก worker
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS video_cache_stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+
+
+def _migration_003_video_blobs(conn: sqlite3.Connection):
+    """ไฟล์วิดีโอใน blob store และจำนวนตอนที่อ้างถึงแต่ละไฟล์"""
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS video_blobs (
+            sha256 TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def _migration_004_bandwidth_rollups(conn: sqlite3.Connection):
+    """ยอดไบต์ที่สตรีมออกไปจริง รวมต่อตอนต่อชั่วโมง และต่อผู้ใช้ต่อวัน
+
+    ไม่ผูก foreign key ไว้ ลบตอน/ผู้ใช้ระหว่างที่ยอดยังค้างในหน่วยความจำจะได้ไม่ทำให้ flush ล้ม
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bandwidth_episode_hourly (
+            episode_id INTEGER NOT NULL,
+            series_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (episode_id, hour)
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_bandwidth_episode_hour ON bandwidth_episode_hourly (hour)"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bandwidth_user_daily (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            requests INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_bandwidth_user_day ON bandwidth_user_daily (day)"
+    )
+
+
+def _migration_005_cache_epochs(conn: sqlite3.Connection):
+    """เลข epoch ต่อ namespace ของแคชในหน่วยความจำ และ epoch ล่าสุดที่แต่ละเรื่อง/ตอนเปลี่ยน
+
+    trigger เพิ่ม epoch ให้เองทุกครั้งที่ตารางของ namespace ถูกแก้ (ไม่ต้องเรียกเพิ่มเลขเองในโค้ดที่แก้ข้อมูล
+    และครอบคลุมการแก้จากนอกแอปด้วย) namespace ใหม่ให้เพิ่มใน migration ขั้นถัดไป
+    trigger ของ series/episodes จดแถวที่เปลี่ยนลง catalog_changes ด้วย epoch ใหม่ตามลำดับ
+    (ใช้ตอบ /api/v1/changes?changes_since=) แถวของเรื่อง/ตอนที่ถูกลบยังอยู่ (tombstone)
+    ขนาดตารางจึงเท่ากับจำนวนเรื่อง/ตอนที่เคยมี
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS cache_epochs (
+            namespace TEXT PRIMARY KEY,
+            epoch INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS catalog_changes (
+            kind TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (kind, item_id)
+        )
+        """
+    )
+    for namespace in ("catalog", "users"):
+        conn.execute(
+            "INSERT OR IGNORE INTO cache_epochs (namespace, epoch) VALUES (?, 0)", (namespace,)
+        )
+
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS cache_epoch_users_{event.lower()}
+            AFTER {event} ON users
+            BEGIN
+                UPDATE cache_epochs SET epoch = epoch + 1 WHERE namespace = 'users';
+            END
+            """
+        )
+
+    for kind, table in (("series", "series"), ("episode", "episodes")):
+        conn.execute(
+            f"""
+            INSERT OR IGNORE INTO catalog_changes (kind, item_id, version)
+            SELECT '{kind}', id, 0 FROM {table}
+            """
+        )
+        for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            conn.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS catalog_change_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE cache_epochs SET epoch = epoch + 1 WHERE namespace = 'catalog';
+                    INSERT INTO catalog_changes (kind, item_id, version)
+                    VALUES ('{kind}', {row}.id, (SELECT epoch FROM cache_epochs WHERE namespace = 'catalog'))
+                    ON CONFLICT (kind, item_id) DO UPDATE SET version = excluded.version;
+                END
+                """
+            )
+
+
+def _migration_006_user_search(conn: sqlite3.Connection):
+    """ดัชนีค้นหาผู้ใช้ในหน้าแอดมิน: FTS5 trigram ของ username / user_key และ index ของลำดับ/คำนำหน้า key
+
+    users_search เป็น external content (ไม่เก็บข้อความซ้ำ) detail=none ให้เล็กที่สุด ใช้ผ่าน LIKE ทีละคอลัมน์
+    trigger ด้านล่างทำให้ดัชนีตรงกับตาราง users เสมอ ถ้า SQLite ไม่มี FTS5/trigram (ต่ำกว่า 3.34)
+    จะข้ามตารางนี้ไป และหน้าแอดมินค้นแบบไล่ทั้งตารางเหมือนเดิม
+    """
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_created ON users (datetime(created_at), id)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_user_key ON users (user_key)")
+    try:
+        conn.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5(
+                username, user_key,
+                content='users', content_rowid='id', tokenize='trigram', detail='none'
+            )
+            """
+        )
+    except sqlite3.OperationalError as e:
+        app.logger.warning("users_search skipped (FTS5 trigram unavailable): %s", e)
+        return
+    conn.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+    # external content: ลบออกจากดัชนีต้องส่งค่าเดิมที่เคยใส่ไว้ (คำสั่ง 'delete')
+    conn.executescript(
+        """
+        CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_search (rowid, username, user_key) VALUES (NEW.id, NEW.username, NEW.user_key);
+        END;
+        CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_search (users_search, rowid, username, user_key)
+            VALUES ('delete', OLD.id, OLD.username, OLD.user_key);
+        END;
+        CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF username, user_key ON users BEGIN
+            INSERT INTO users_search (users_search, rowid, username, user_key)
+            VALUES ('delete', OLD.id, OLD.username, OLD.user_key);
+            INSERT INTO users_search (rowid, username, user_key) VALUES (NEW.id, NEW.username, NEW.user_key);
+        END;
+        """
+    )
+
+
+def _migration_007_dedup_video_files(conn: sqlite3.Connection):
+    """ไฟล์วิดีโอแบบเก่า (video_files/series_<id>/...) ที่ยังไม่อยู่ใน blob store
+
+    ไม่ย้ายไฟล์ในขั้นนี้: ต้อง hash ไฟล์ทั้งโฟลเดอร์ (และอัปโหลดขึ้น S3) ซึ่งหนักเกินไปสำหรับ migration
+    ที่ worker รันเองใน request แรก (ถือ migrate lock และติด timeout ของ worker) ไฟล์แบบเก่ายังเล่นได้ตามเดิม
+    ย้ายจริงด้วย `flask --app app migrate-db` หรือ `flask --app app dedup-videos`
+    """
+    legacy = conn.execute(
+        """
+        SELECT COUNT(DISTINCT file_path) FROM episodes
+        WHERE file_path IS NOT NULL AND file_path != ''
+          AND file_path NOT IN (SELECT file_path FROM video_blobs)
+        """
+    ).fetchone()[0]
+    if legacy:
+        app.logger.warning(
+            "%d legacy video files are not in the blob store yet; run `flask --app app dedup-videos`", legacy
+        )
+
+
+def _migration_008_bandwidth_estimated(conn: sqlite3.Connection):
+    """แยกไบต์ที่ส่งผ่าน proxy (STREAM_OFFLOAD) ออกจากไบต์ที่ส่งจริง
+
+    ตอน offload worker ไม่เห็นไบต์ที่ส่งจริง รู้แค่ช่วงที่ผู้ชมขอ (ผู้ชมที่ตัดกลางทางได้น้อยกว่านั้น)
+    จึงเก็บไว้ใน estimated_bytes ให้รายงานแสดงแยกว่าเป็นค่าประมาณ
+    """
+    for table in ("bandwidth_episode_hourly", "bandwidth_user_daily"):
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if "estimated_bytes" not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN estimated_bytes INTEGER NOT NULL DEFAULT 0")
+
+
+# เพิ่ม migration ใหม่ต่อท้ายเสมอ ห้ามแก้ลำดับหรือลบขั้นที่ปล่อยไปแล้ว
+MIGRATIONS = [
+    _migration_001_base_schema,
+    _migration_002_video_cache,
+    _migration_003_video_blobs,
+    _migration_004_bandwidth_rollups,
+    _migration_005_cache_epochs,
+    _migration_006_user_search,
+    _migration_007_dedup_video_files,
+    _migration_008_bandwidth_estimated,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# 0 = ไม่ให้ worker รัน migration เอง (ต้องสั่ง migrate-db ก่อนบูต)
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "1") != "0"
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_db() -> int:
+    """รัน migration ที่ยังไม่ได้รันทั้งหมด คืนเวอร์ชัน schema หลังรันเสร็จ
+
+    ล็อกไฟล์ไว้ระหว่างรัน worker อื่นที่บูตพร้อมกันจะรอแล้วเห็นว่าเป็นเวอร์ชันล่าสุดแล้ว
+    """
+    with open(settings.DB_PATH + ".migrate.lock", "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        conn = get_db_connection()
+        try:
+            version = get_schema_version(conn)
+            for index in range(version, SCHEMA_VERSION):
+                MIGRATIONS[index](conn)
+                conn.execute(f"PRAGMA user_version = {index + 1}")
+                conn.commit()
+            return get_schema_version(conn)
+        finally:
+            conn.close()
+
+
+def init_db():
+    """ตรวจเวอร์ชัน schema ตอนเริ่ม worker (อ่าน PRAGMA user_version ครั้งเดียว)"""
+    conn = get_db_connection()
+    version = get_schema_version(conn)
     conn.close()
 
+    if version >= SCHEMA_VERSION:
+        return
+    if not settings.AUTO_MIGRATE:
+        raise RuntimeError(
+            f"ฐานข้อมูลเป็น schema เวอร์ชัน {version} แต่โค้ดต้องการ {SCHEMA_VERSION} "
+            "กรุณารัน `flask --app app migrate-db` ก่อนเริ่มเซิร์ฟเวอร์"
+        )
+    migrate_db()
+
 
-init_db()
+@app.cli.command("migrate-db")
+def migrate_db_command():
+    """อัปเดต schema ของฐานข้อมูลให้เป็นเวอร์ชันล่าสุด แล้วย้ายไฟล์วิดีโอแบบเก่าเข้า blob store"""
+    version = migrate_db()
+    print(f"schema เวอร์ชัน {version}")
+    result = dedup_video_files()
+    if result["files"] or result["missing"]:
+        print_dedup_result(result)
 
 
 def extract_drive_id(text: str) -> str | None:
@@ -261,64 +887,3125 @@ def extract_drive_id(text: str) -> str | None:
     return None
 
 
-def download_drive_file(file_id: str, series_id: int) -> str:
-    import gdown
+# ---------- ตัวโหลดไฟล์แบบหลาย connection (HTTP Range) ที่โหลดต่อจากเดิมได้ ----------
+# แบ่งไฟล์เป็นหลายช่วงแล้วโหลดพร้อมกันลงไฟล์ .part ที่จองขนาดไว้แล้ว
+# ความคืบหน้าของแต่ละช่วงเก็บไว้ใน .part.json ถ้า process ล้มกลางทางจะโหลดต่อจากเดิมได้
+# ไฟล์จะถูก rename เข้าที่จริงหลังตรวจขนาดและชนิดไฟล์แล้วเท่านั้น (ไม่มีไฟล์ครึ่ง ๆ กลาง ๆ ค้าง)
+
+
+class DirectDownloadUnavailable(RuntimeError):
+    """เซิร์ฟเวอร์ไม่ได้ส่งไฟล์มาตรง ๆ (เช่น Drive ส่งหน้า HTML ยืนยันมาแทน)"""
+
+
+class RateLimiter:
+    """token bucket จำกัดจำนวนไบต์ต่อวินาที ใช้ร่วมกันได้หลาย thread"""
 
-    series_dir = os.path.join(VIDEO_ROOT, f"series_{series_id}")
-    os.makedirs(series_dir, exist_ok=True)
+    def __init__(self, rate: float):
+        self.rate = float(rate)
+        self._tokens = self.rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-    output = os.path.join(series_dir, f"{file_id}.mp4")
+    def consume(self, amount: int):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
 
-    if os.path.exists(output):
+
+def _save_segment_map(map_path: str, state: dict):
+    tmp_path = map_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, map_path)
+
+
+def _looks_like_html(path: str) -> bool:
+    with open(path, "rb") as f:
+        head = f.read(512).lstrip().lower()
+    return head.startswith(b"<!doctype html") or head.startswith(b"<html")
+
+
+def download_ranged(url: str, output: str, segments: int = 4, limiter: RateLimiter | None = None) -> str:
+    """โหลด url ลง output โดยแบ่งเป็น ``segments`` ช่วงโหลดพร้อมกันด้วย HTTP Range
+
+    ถ้ามีไฟล์ output.part และ output.part.json จากรอบก่อนจะโหลดต่อ เมื่อ url ขนาด และ ETag / Last-Modified
+    ของไฟล์ปลายทาง (หลัง redirect ที่ได้ไบต์มาจริง) ตรงกับรอบก่อน
+    ถ้าเซิร์ฟเวอร์ไม่รองรับ Range จะโหลดแบบ connection เดียวแทน
+    ถ้าได้หน้า HTML แทนไฟล์จะ raise DirectDownloadUnavailable
+    """
+    import requests
+
+    part_path = output + ".part"
+    map_path = part_path + ".json"
+    timeout = (10, 60)
+    chunk_size = 256 * 1024
+
+    # ขอแค่ไบต์แรกเพื่อดูขนาดไฟล์ ชนิดไฟล์ และว่าเซิร์ฟเวอร์รองรับ Range หรือไม่
+    probe = requests.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout)
+    with probe:
+        probe.raise_for_status()
+        content_type = (probe.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if content_type.startswith("text/"):
+            raise DirectDownloadUnavailable(f"เซิร์ฟเวอร์ส่ง {content_type} มาแทนไฟล์วิดีโอ")
+        final_url = probe.url
+        # ตัวระบุเวอร์ชันของไฟล์ที่ได้ไบต์มาจริง (ปลายทางหลัง redirect) ใช้ตรวจตอนโหลดต่อ
+        etag = probe.headers.get("ETag")
+        last_modified = probe.headers.get("Last-Modified")
+        content_range = probe.headers.get("Content-Range", "")
+        total = 0
+        if probe.status_code == 206 and "/" in content_range:
+            total_text = content_range.rsplit("/", 1)[1]
+            total = int(total_text) if total_text.isdigit() else 0
+        ranged = total > 0
+
+        if not ranged:
+            # เซิร์ฟเวอร์ไม่รองรับ Range: โหลดแบบ connection เดียว (เขียนลง .part แล้ว rename เมื่อเสร็จ)
+            # ถ้าได้ 200 มาแล้วก็อ่านต่อจาก response เดิมเลยไม่ต้องขอใหม่
+            resp = probe if probe.status_code == 200 else requests.get(final_url, stream=True, timeout=timeout)
+            with resp:
+                resp.raise_for_status()
+                total = int(resp.headers.get("Content-Length") or 0)
+                with open(part_path, "wb") as f:
+                    for chunk in resp.iter_content(chunk_size):
+                        if limiter:
+                            limiter.consume(len(chunk))
+                        f.write(chunk)
+
+    if not ranged:
+        if total and os.path.getsize(part_path) != total:
+            raise RuntimeError("ขนาดไฟล์ที่โหลดได้ไม่ตรงกับที่เซิร์ฟเวอร์แจ้ง")
+        if _looks_like_html(part_path):
+            os.remove(part_path)
+            raise DirectDownloadUnavailable("เซิร์ฟเวอร์ส่งหน้า HTML มาแทนไฟล์วิดีโอ")
+        os.replace(part_path, output)
         return output
 
-    url = f"https://drive.google.com/uc?export=download&id={file_id}"
+    state = None
+    if os.path.exists(part_path) and os.path.exists(map_path):
+        try:
+            with open(map_path) as f:
+                state = json.load(f)
+            if (
+                state.get("url") != url
+                or state.get("size") != total
+                or state.get("etag") != etag
+                or state.get("last_modified") != last_modified
+            ):
+                state = None
+        except Exception:
+            state = None
+
+    if state is None:
+        segments = max(1, min(segments, total // (1024 * 1024) or 1))
+        step = -(-total // segments)
+        state = {
+            "url": url,
+            "final_url": final_url,
+            "size": total,
+            "etag": etag,
+            "last_modified": last_modified,
+            "segments": [
+                [start, min(start + step, total) - 1, 0] for start in range(0, total, step)
+            ],
+        }
+        with open(part_path, "wb") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, total)
+            except (AttributeError, OSError):
+                f.truncate(total)
+        _save_segment_map(map_path, state)
+
+    state["final_url"] = final_url
+    # ถ้าไฟล์ปลายทางเปลี่ยนระหว่างโหลด เซิร์ฟเวอร์จะส่งทั้งไฟล์ (200) แทนช่วงที่ขอ ไม่เอาไบต์ของคนละไฟล์มาต่อกัน
+    if_range = etag if etag and not etag.startswith("W/") else last_modified
+    state_lock = threading.Lock()
+    stop = threading.Event()
+    fd = os.open(part_path, os.O_WRONLY)
+
+    def fetch(segment):
+        start, end, done = segment
+        if start + done > end:
+            return
+        headers = {"Range": f"bytes={start + done}-{end}"}
+        if if_range:
+            headers["If-Range"] = if_range
+        with requests.get(final_url, headers=headers, stream=True, timeout=timeout) as resp:
+            if resp.status_code != 206:
+                raise RuntimeError(f"เซิร์ฟเวอร์ไม่ส่งช่วงข้อมูลที่ขอ (HTTP {resp.status_code})")
+            unsaved = 0
+            for chunk in resp.iter_content(chunk_size):
+                if stop.is_set():
+                    return
+                if limiter:
+                    limiter.consume(len(chunk))
+                chunk = chunk[: end - (start + segment[2]) + 1]
+                os.pwrite(fd, chunk, start + segment[2])
+                with state_lock:
+                    segment[2] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= 8 * 1024 * 1024:
+                        _save_segment_map(map_path, state)
+                        unsaved = 0
+                if start + segment[2] > end:
+                    break
+        if start + segment[2] <= end:
+            raise RuntimeError("การเชื่อมต่อถูกตัดก่อนโหลดช่วงข้อมูลครบ")
+
+    pending = [seg for seg in state["segments"] if seg[0] + seg[2] <= seg[1]]
+    try:
+        if pending:
+            with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                futures = [pool.submit(fetch, seg) for seg in pending]
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception:
+                        stop.set()
+                        raise
+    finally:
+        os.close(fd)
+        with state_lock:
+            _save_segment_map(map_path, state)
+
+    if any(seg[0] + seg[2] <= seg[1] for seg in state["segments"]):
+        raise RuntimeError("โหลดไฟล์ไม่ครบทุกช่วง")
+    if os.path.getsize(part_path) != total:
+        raise RuntimeError("ขนาดไฟล์ที่โหลดได้ไม่ตรงกับที่เซิร์ฟเวอร์แจ้ง")
+    if _looks_like_html(part_path):
+        os.remove(part_path)
+        os.remove(map_path)
+        raise DirectDownloadUnavailable("เซิร์ฟเวอร์ส่งหน้า HTML มาแทนไฟล์วิดีโอ")
+
+    os.replace(part_path, output)
+    os.remove(map_path)
+    return output
+
+
+# ไฟล์ Drive ที่กำลังโหลดอยู่ใน process นี้ ((DB_PATH, drive_id) -> Future) กันโหลดไฟล์เดียวกันซ้อนกัน
+_drive_inflight_lock = threading.Lock()
+_drive_inflight = {}
+# ข้าม process ใช้ไฟล์ล็อกชุดคงที่ใน BLOB_TMP_ROOT เลือกตาม hash ของ drive_id (ไม่สร้างไฟล์ล็อกค้างไว้ทีละ id)
+# id ที่ชนช่องเดียวกันแค่รอกันเป็นครั้งคราว
+_DRIVE_LOCK_STRIPES = 64
+
+
+def _fetch_drive_file(file_id: str, output: str, limiter: RateLimiter | None = None):
+    """โหลดไฟล์ Drive ลง output ด้วยตัวโหลดแบบหลาย connection ถ้าไม่ได้จึงใช้ gdown"""
+    url = settings.DRIVE_DOWNLOAD_URL.format(id=file_id)
+    try:
+        download_ranged(url, output, segments=settings.DRIVE_DOWNLOAD_SEGMENTS, limiter=limiter)
+        return
+    except DirectDownloadUnavailable:
+        # ไฟล์ที่ Drive ต้องกดยืนยันเพิ่ม ให้ gdown จัดการแทน
+        pass
+    except Exception as e:
+        # เก็บ .part ไว้ รอบหน้าจะโหลดต่อจากเดิม
+        raise RuntimeError(f"โหลดไฟล์จาก Google Drive ไม่สำเร็จ: {e}")
+
+    import gdown
+
+    part_path = output + ".part"
+    gdown_url = f"https://drive.google.com/uc?export=download&id={file_id}"
     try:
-        gdown.download(url, output, quiet=False)
+        gdown.download(gdown_url, part_path, quiet=False, speed=limiter.rate if limiter else None)
     except Exception as e:
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
         raise RuntimeError(f"โหลดไฟล์จาก Google Drive ไม่สำเร็จ: {e}")
 
-    if not os.path.exists(output):
+    if not os.path.exists(part_path):
         raise RuntimeError("ไม่พบไฟล์ที่ดาวน์โหลดจาก Google Drive")
+    os.replace(part_path, output)
 
-    return output
 
+def download_drive_file(file_id: str, series_id: int, limiter: RateLimiter | None = None) -> str:
+    """โหลดไฟล์จาก Google Drive เข้า blob store แล้วคืน path แบบ relative ของ blob (key ในที่เก็บ)
 
-def is_admin() -> bool:
-    return bool(session.get("is_admin"))
+    ถ้าไฟล์ Drive นี้มีอยู่ในเครื่องแล้ว (แม้จะแนบไว้กับเรื่องอื่น) จะใช้ไฟล์เดิมโดยไม่โหลดซ้ำ
+    และถ้ามีอีก thread กำลังโหลดไฟล์เดียวกันอยู่ (เช่น prefetch) จะรอผลจากตัวนั้นแทน
+    ``limiter`` ใช้จำกัดความเร็ว ผู้เรียกต้อง blob_acquire เองเมื่อผูกไฟล์เข้ากับตอน
+    """
+    existing = find_drive_blob(file_id)
+    if existing:
+        return existing
 
+    inflight_key = (settings.DB_PATH, file_id)
+    with _drive_inflight_lock:
+        future = _drive_inflight.get(inflight_key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _drive_inflight[inflight_key] = future
 
-def admin_required():
-    if not is_admin():
-        flash("ต้องเข้าสู่ระบบแอดมินก่อน", "error")
-        return False
-    return True
+    if not owner:
+        return future.result()
 
+    try:
+        os.makedirs(settings.BLOB_TMP_ROOT, exist_ok=True)
+        # ชื่อไฟล์พักคงที่ต่อ drive_id เพื่อโหลดต่อจากรอบก่อนได้
+        # และล็อกไว้กัน worker อื่นโหลดไฟล์เดียวกันพร้อมกัน
+        output = os.path.join(settings.BLOB_TMP_ROOT, f"drive_{file_id}.mp4")
+        stripe = zlib.crc32(file_id.encode()) % _DRIVE_LOCK_STRIPES
+        with open(os.path.join(settings.BLOB_TMP_ROOT, f"drive.{stripe:02d}.lock"), "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            existing = find_drive_blob(file_id)
+            if existing:
+                result = existing
+            else:
+                _fetch_drive_file(file_id, output, limiter)
+                result = blob_store_file(output, ".mp4")
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _drive_inflight_lock:
+            _drive_inflight.pop(inflight_key, None)
 
 
-# ฟังก์ชันจัดการสถานะผู้ใช้ทั่วไป
-def get_current_user():
-    user_id = session.get("user_id")
-    if not user_id:
-        return None
-    conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
-    return user
+# ---------- ที่เก็บไฟล์วิดีโอ / รูปปก (ดิสก์ในเครื่อง หรือ S3 / MinIO) ----------
+# โค้ดส่วนอื่นอ้างถึงไฟล์ด้วย key เท่านั้น: วิดีโอใช้ episodes.file_path (relative กับ BASE_DIR เหมือนเดิม)
+# รูปปกใช้ thumbnail_url (relative กับ static) ข้อมูลใน DB จึงใช้ได้ทั้งสองแบบโดยไม่ต้องแปลง
+# ไฟล์ที่กำลังโหลดจาก Drive / อัปโหลดยังพักในเครื่องที่ BLOB_TMP_ROOT ครบแล้วค่อย put เข้าที่เก็บ
 
+class MediaStorageError(RuntimeError):
+    """ใช้ที่เก็บไฟล์ไม่ได้ (ตั้งค่าผิด / ไม่ได้ติดตั้ง boto3 / S3 ตอบ error)"""
 
-def login_user(user_row):
-    session["user_id"] = user_row["id"]
-    session["username"] = user_row["username"]
 
+class StoredObject:
+    """ข้อมูลของไฟล์ในที่เก็บ: size (ไบต์), mtime (epoch วินาที), etag (None ถ้าที่เก็บไม่มีให้)"""
 
-def logout_user():
-    session.pop("user_id", None)
-    session.pop("username", None)
+    __slots__ = ("size", "mtime", "etag")
 
+    def __init__(self, size: int, mtime: float, etag: str | None = None):
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
 
-def user_login_required(view_func):
-    @wraps(view_func)
+
+class LocalStorage:
+    """เก็บไฟล์บนดิสก์ใต้ ``root`` (key แบบ absolute ของข้อมูลรุ่นเก่าชี้ไปที่ไฟล์นั้นตรง ๆ)"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def local_path(self, key: str) -> str | None:
+        """path ในเครื่องของ key (ใช้กับ X-Accel-Redirect / pread ได้)"""
+        if not key:
+            return None
+        return key if os.path.isabs(key) else os.path.join(self.root, key)
+
+    def exists(self, key: str) -> bool:
+        return bool(key) and os.path.isfile(self.local_path(key))
+
+    def stat(self, key: str) -> StoredObject | None:
+        try:
+            st = os.stat(self.local_path(key))
+        except (OSError, TypeError):
+            return None
+        return StoredObject(st.st_size, st.st_mtime)
+
+    def open_range(self, key: str, start: int = 0, end: int | None = None, chunk_size: int = 256 * 1024):
+        """อ่านช่วง [start, end) ทีละก้อน (generator) ไม่มีไฟล์ = FileNotFoundError ตอนอ่านก้อนแรก"""
+        with open(self.local_path(key), "rb") as f:
+            # seek ไปตำแหน่งที่ขอเลย ไม่อ่านไฟล์ส่วนก่อนหน้าทิ้ง
+            f.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def put(self, key: str, src):
+        """เก็บไฟล์ลง key: ``src`` เป็น path ในเครื่อง (ย้ายเข้าไป ไฟล์เดิมหายไป) หรือ file object (อ่านทีละก้อน)"""
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if isinstance(src, str):
+            os.replace(src, target)
+            return
+        # เขียนลงไฟล์พักแล้ว rename คนที่อ่านอยู่ไม่เห็นไฟล์ครึ่ง ๆ กลาง ๆ
+        part_path = f"{target}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            with open(part_path, "wb") as f:
+                shutil.copyfileobj(src, f, 1024 * 1024)
+            os.replace(part_path, target)
+        except BaseException:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+            raise
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def delete_prefix(self, prefix: str) -> int:
+        """ลบทุกไฟล์ใต้โฟลเดอร์ ``prefix`` คืนจำนวนไฟล์ที่ลบ"""
+        folder = self.local_path(prefix)
+        if not folder or not os.path.isdir(folder):
+            return 0
+        count = sum(len(files) for _, _, files in os.walk(folder))
+        shutil.rmtree(folder, ignore_errors=True)
+        return count
+
+
+class S3Storage:
+    """เก็บไฟล์ใน bucket ของ S3 หรือที่เข้ากันได้ (MinIO) อ่านด้วย ranged GET เขียนด้วย multipart upload
+
+    key จาก DB ถูกแปลงเป็น key ของ object แบบ posix (ตัด / นำหน้าและ .. ที่เกิน root ออก) แล้วต่อท้าย ``prefix``
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = "", region: str = "",
+                 access_key: str = "", secret_key: str = "", chunk_size: int = 16 * 1024 * 1024,
+                 concurrency: int = 4, max_connections: int = 64, stat_ttl: float = 30):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+        except ImportError:
+            raise MediaStorageError("MEDIA_STORAGE=s3 ต้องติดตั้ง boto3 ก่อน (pip install -r requirements-s3.txt)")
+        if not bucket:
+            raise MediaStorageError("MEDIA_STORAGE=s3 ต้องตั้งค่า S3_BUCKET")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.session.Session().client(
+            "s3",
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None,
+            config=Config(
+                max_pool_connections=max_connections,
+                retries={"max_attempts": 3, "mode": "standard"},
+                # MinIO / stand-in ในเครื่องไม่มี DNS แบบ <bucket>.host
+                s3={"addressing_style": "path"} if endpoint_url else None,
+            ),
+        )
+        self.transfer = TransferConfig(
+            multipart_threshold=chunk_size,
+            multipart_chunksize=chunk_size,
+            max_concurrency=concurrency,
+            use_threads=concurrency > 1,
+        )
+        self.stat_ttl = stat_ttl
+        self._stats = OrderedDict()  # object key -> (เวลาหมดอายุ, StoredObject)
+        self._stats_lock = threading.Lock()
+
+    def with_prefix(self, prefix: str) -> "S3Storage":
+        """ที่เก็บใน bucket เดียวกันแต่ key ขึ้นต้นด้วย ``prefix`` เพิ่ม (ใช้ client / connection ร่วมกัน)"""
+        other = object.__new__(S3Storage)
+        other.__dict__.update(self.__dict__)
+        other.prefix = self.prefix + prefix
+        other._stats = OrderedDict()
+        other._stats_lock = threading.Lock()
+        return other
+
+    def object_key(self, key: str) -> str:
+        normalized = posixpath.normpath("/" + str(key).replace(os.sep, "/")).lstrip("/")
+        return self.prefix + normalized
+
+    def local_path(self, key: str) -> str | None:
+        return None
+
+    @staticmethod
+    def _missing(exc) -> bool:
+        code = str(exc.response.get("Error", {}).get("Code", ""))
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def _forget(self, object_key: str):
+        with self._stats_lock:
+            self._stats.pop(object_key, None)
+
+    def stat(self, key: str) -> StoredObject | None:
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        if not key:
+            return None
+        object_key = self.object_key(key)
+        now = time.monotonic()
+        with self._stats_lock:
+            cached = self._stats.get(object_key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=object_key)
+        except ClientError as e:
+            if self._missing(e):
+                self._forget(object_key)
+                return None
+            raise MediaStorageError(f"อ่านข้อมูลไฟล์ {object_key} จาก S3 ไม่สำเร็จ: {e}")
+        except BotoCoreError as e:
+            raise MediaStorageError(f"ติดต่อ S3 ไม่ได้: {e}")
+
+        info = StoredObject(
+            head["ContentLength"], head["LastModified"].timestamp(), (head.get("ETag") or "").strip('"') or None
+        )
+        if self.stat_ttl > 0:
+            with self._stats_lock:
+                self._stats[object_key] = (now + self.stat_ttl, info)
+                self._stats.move_to_end(object_key)
+                while len(self._stats) > 4096:
+                    self._stats.popitem(last=False)
+        return info
+
+    def exists(self, key: str) -> bool:
+        return self.stat(key) is not None
+
+    def open_range(self, key: str, start: int = 0, end: int | None = None, chunk_size: int = 256 * 1024):
+        """อ่านช่วง [start, end) ด้วย GET ครั้งเดียว (Range) แล้วส่งต่อทีละก้อนตามที่ได้รับ"""
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        if end is not None and end <= start:
+            return
+        object_key = self.object_key(key)
+        request = {"Bucket": self.bucket, "Key": object_key}
+        if start > 0 or end is not None:
+            request["Range"] = f"bytes={start}-{'' if end is None else end - 1}"
+        try:
+            body = self.client.get_object(**request)["Body"]
+        except ClientError as e:
+            if self._missing(e):
+                self._forget(object_key)
+                raise FileNotFoundError(object_key)
+            raise MediaStorageError(f"อ่านไฟล์ {object_key} จาก S3 ไม่สำเร็จ: {e}")
+        except BotoCoreError as e:
+            raise MediaStorageError(f"ติดต่อ S3 ไม่ได้: {e}")
+        try:
+            yield from body.iter_chunks(chunk_size)
+        except BotoCoreError as e:
+            raise MediaStorageError(f"การเชื่อมต่อ S3 ถูกตัดระหว่างอ่าน {object_key}: {e}")
+        finally:
+            # คืน connection เข้า pool (หรือทิ้งถ้ายังอ่านไม่ครบ) ผู้ชมที่ปิดกลางทางจะไม่ค้าง connection
+            body.close()
+
+    def put(self, key: str, src):
+        """เก็บไฟล์ลง key: ``src`` เป็น path ในเครื่อง (อัปโหลดแล้วลบทิ้ง) หรือ file object (อ่านทีละ part)
+
+        ไฟล์ที่ใหญ่กว่า S3_MULTIPART_CHUNK_SIZE อัปโหลดแบบ multipart หลาย part พร้อมกัน
+        ถ้าล้มเหลวกลางทาง boto3 ยกเลิก multipart upload ให้ (ไม่เหลือ part ค้างใน bucket)
+        """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        object_key = self.object_key(key)
+        extra = {"ContentType": mimetypes.guess_type(object_key)[0] or "application/octet-stream"}
+        try:
+            if isinstance(src, str):
+                self.client.upload_file(src, self.bucket, object_key, ExtraArgs=extra, Config=self.transfer)
+            else:
+                self.client.upload_fileobj(src, self.bucket, object_key, ExtraArgs=extra, Config=self.transfer)
+        except (BotoCoreError, ClientError) as e:
+            raise MediaStorageError(f"อัปโหลด {object_key} ขึ้น S3 ไม่สำเร็จ: {e}")
+        finally:
+            self._forget(object_key)
+        if isinstance(src, str):
+            os.remove(src)
+
+    def delete(self, key: str) -> bool:
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        object_key = self.object_key(key)
+        self._forget(object_key)
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=object_key)
+        except (BotoCoreError, ClientError) as e:
+            raise MediaStorageError(f"ลบ {object_key} จาก S3 ไม่สำเร็จ: {e}")
+        return True
+
+    def delete_prefix(self, prefix: str) -> int:
+        """ลบทุก object ที่ key ขึ้นต้นด้วย ``prefix``/ คืนจำนวนที่ลบ"""
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        object_prefix = self.object_key(prefix).rstrip("/") + "/"
+        count = 0
+        try:
+            pages = self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=object_prefix)
+            for page in pages:
+                keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+                if keys:
+                    # list ได้หน้าละไม่เกิน 1000 key เท่ากับที่ delete_objects รับได้ต่อครั้งพอดี
+                    self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys, "Quiet": True})
+                    count += len(keys)
+        except (BotoCoreError, ClientError) as e:
+            raise MediaStorageError(f"ลบไฟล์ใต้ {object_prefix} จาก S3 ไม่สำเร็จ: {e}")
+        with self._stats_lock:
+            for object_key in [k for k in self._stats if k.startswith(object_prefix)]:
+                del self._stats[object_key]
+        return count
+
+
+_media_storage_lock = threading.Lock()
+_media_storages = {}  # (ค่าตั้งของที่เก็บ, "video" / "cover" / "s3") -> driver
+
+
+def _media_storage_config() -> tuple:
+    """ค่าตั้งที่กำหนด driver (แอปที่ตั้งค่าเหมือนกันใช้ driver และ connection pool ชุดเดียวกัน)"""
+    if settings.MEDIA_STORAGE != "s3":
+        return (settings.MEDIA_STORAGE,)
+    return (
+        "s3", settings.S3_BUCKET, settings.S3_PREFIX, settings.S3_ENDPOINT_URL, settings.S3_REGION,
+        settings.S3_ACCESS_KEY_ID, settings.S3_SECRET_ACCESS_KEY, settings.S3_MULTIPART_CHUNK_SIZE,
+        settings.S3_UPLOAD_CONCURRENCY, settings.S3_MAX_CONNECTIONS, settings.S3_STAT_CACHE_TTL,
+    )
+
+
+def get_media_storage(kind: str = "video"):
+    """driver ของที่เก็บตาม MEDIA_STORAGE: ``kind`` = "video" (key = episodes.file_path)
+    หรือ "cover" (key = thumbnail_url ที่อัปโหลด) สร้างตอนใช้ครั้งแรกของแต่ละ process
+    """
+    config = _media_storage_config()
+    storage = _media_storages.get((config, kind))
+    if storage is not None:
+        return storage
+    with _media_storage_lock:
+        storage = _media_storages.get((config, kind))
+        if storage is None:
+            if config[0] == "s3":
+                base = _media_storages.get((config, "s3"))
+                if base is None:
+                    base = _media_storages[(config, "s3")] = S3Storage(*config[1:])
+                storage = base if kind == "video" else base.with_prefix("static/")
+            elif config[0] == "local":
+                storage = LocalStorage(BASE_DIR if kind == "video" else os.path.join(BASE_DIR, "static"))
+            else:
+                raise MediaStorageError(f"ไม่รู้จัก MEDIA_STORAGE={config[0]} (ใช้ได้: local, s3)")
+            _media_storages[(config, kind)] = storage
+        return storage
+
+
+def video_storage():
+    return get_media_storage("video")
+
+
+def cover_storage():
+    return get_media_storage("cover")
+
+
+def is_stored_cover(thumbnail_url) -> bool:
+    """thumbnail_url เป็นรูปที่อัปโหลดเก็บไว้เอง (ไม่ใช่ลิงก์จากเน็ต)"""
+    return bool(thumbnail_url) and not str(thumbnail_url).startswith("http")
+
+
+def store_cover(cover_file, key: str) -> str:
+    """เก็บไฟล์รูปปกที่อัปโหลด (FileStorage ของ Werkzeug) ลง key แล้วคืน key (ใช้เป็น thumbnail_url)"""
+    cover_storage().put(key, cover_file.stream)
+    return key
+
+
+def delete_cover(thumbnail_url):
+    """ลบรูปปกที่อัปโหลดไว้ (ลิงก์จากเน็ตไม่ต้องทำอะไร) ลบไม่ได้ก็ปล่อยไว้"""
+    if not is_stored_cover(thumbnail_url):
+        return
+    try:
+        cover_storage().delete(thumbnail_url)
+    except (OSError, MediaStorageError) as e:
+        app.logger.warning("delete cover %s failed: %s", thumbnail_url, e)
+
+
+def cover_url(thumbnail_url):
+    """URL ของรูปปกสำหรับ template / API: ลิงก์จากเน็ตใช้ตรง ๆ ไฟล์ในเครื่องเสิร์ฟจาก static
+    ส่วนที่เก็บแบบ S3 ส่งผ่าน /media/ ของแอปเอง"""
+    if not is_stored_cover(thumbnail_url):
+        return thumbnail_url
+    if settings.MEDIA_STORAGE == "local":
+        return url_for("static", filename=thumbnail_url)
+    return url_for("media_cover", key=thumbnail_url)
+
+
+app.jinja_env.filters["cover_url"] = cover_url
+
+
+@app.route("/media/<path:key>")
+def media_cover(key):
+    """รูปปกที่อัปโหลดไว้จากที่เก็บ (MEDIA_STORAGE=s3 เสิร์ฟจาก static ตรง ๆ ไม่ได้)"""
+    key = posixpath.normpath(key)
+    if not key.startswith("covers/"):
+        abort(404)
+    storage = cover_storage()
+    info = storage.stat(key)
+    if info is None:
+        abort(404)
+
+    response = Response(
+        storage.open_range(key),
+        mimetype=mimetypes.guess_type(key)[0] or "application/octet-stream",
+        direct_passthrough=True,
+    )
+    response.content_length = info.size
+    response.last_modified = datetime.utcfromtimestamp(int(info.mtime))
+    if info.etag:
+        response.set_etag(info.etag)
+    # ชื่อไฟล์ปกมีเวลาที่อัปโหลดอยู่แล้ว เปลี่ยนรูป = เปลี่ยน URL จึงให้ browser แคชได้นาน
+    response.cache_control.public = True
+    response.cache_control.max_age = 7 * 24 * 3600
+    return response.make_conditional(request)
+
+
+@app.errorhandler(MediaStorageError)
+def media_storage_unavailable(exc: MediaStorageError):
+    app.logger.warning("media storage error: %s", exc)
+    return Response(
+        "ที่เก็บไฟล์วิดีโอใช้งานไม่ได้ชั่วคราว กรุณาลองใหม่อีกครั้ง",
+        status=503,
+        mimetype="text/plain",
+        headers={"Retry-After": "5"},
+    )
+
+
+# ---------- แคชไฟล์วิดีโอจาก Google Drive (LRU + โควตาพื้นที่) ----------
+# ไฟล์จาก Google Drive โหลดใหม่ได้เสมอ (stream_episode จะโหลดใหม่เมื่อไฟล์หาย)
+# จึงลบไฟล์ที่ไม่ได้ถูกสตรีมนานที่สุดออกได้เมื่อพื้นที่เกินโควตา ส่วนไฟล์อัปโหลดจะไม่ถูกแตะเลย
+
+_cache_lock = threading.Lock()
+_cache_last_touch = {}  # (DB_PATH, file_path) -> time.monotonic() ที่จดล่าสุด
+_cache_pending = {}  # (DB_PATH, file_path) -> (size, last_access, hits) ที่ยังไม่ได้เขียนลง DB
+
+
+def media_abs_path(path: str) -> str:
+    """แปลง path ที่เก็บใน DB (relative กับ BASE_DIR) เป็น path เต็ม"""
+    if path and not os.path.isabs(path):
+        return os.path.join(BASE_DIR, path)
+    return path
+
+
+def cache_bump_stat(conn: sqlite3.Connection, name: str, amount: int = 1):
+    conn.execute(
+        """
+        INSERT INTO video_cache_stats (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+        """,
+        (name, amount),
+    )
+
+
+def cache_touch(file_path: str, hit: bool = True, force: bool = False, size: int | None = None):
+    """บันทึกว่าไฟล์ gdrive นี้เพิ่งถูกสตรีม (เพิ่มเข้าแคชถ้ายังไม่มี)
+
+    player ขอ range ถี่มาก จึงจดไม่บ่อยกว่า VIDEO_CACHE_TOUCH_INTERVAL ต่อไฟล์
+    และนับเป็น hit หนึ่งครั้งต่อช่วงเวลานั้น (ประมาณหนึ่งครั้งต่อการเปิดดู)
+    การจดจากการสตรีมเก็บไว้ในหน่วยความจำแล้วเขียนพร้อม bandwidth_flush() ส่วน ``force``
+    (ไฟล์เพิ่งโหลด/เพิ่งผูกกับตอน) เขียนลง DB ทันที ``size`` = ขนาดไฟล์ถ้าผู้เรียก stat มาแล้ว
+    """
+    if not file_path:
+        return
+    key = (settings.DB_PATH, file_path)
+    now = time.monotonic()
+    with _cache_lock:
+        last = _cache_last_touch.get(key)
+        if not force and last is not None and now - last < settings.VIDEO_CACHE_TOUCH_INTERVAL:
+            return
+        _cache_last_touch[key] = now
+
+    if size is None:
+        try:
+            info = video_storage().stat(file_path)
+        except MediaStorageError:
+            return
+        if info is None:
+            return
+        size = info.size
+
+    ts = datetime.utcnow().isoformat()
+    with _cache_lock:
+        pending = _cache_pending.get(key)
+        hits = (pending[2] if pending is not None else 0) + (1 if hit else 0)
+        _cache_pending[key] = (size, ts, hits)
+    if force:
+        cache_flush_touches()
+
+
+def cache_flush_touches():
+    """เขียนการจดของ cache_touch() ที่ค้างอยู่ลง video_cache ของแต่ละ DB (เขียนไม่สำเร็จ เก็บไว้รอบถัดไป)"""
+    with _cache_lock:
+        pending = dict(_cache_pending)
+        _cache_pending.clear()
+
+    by_db = {}
+    for (db_path, file_path), values in pending.items():
+        by_db.setdefault(db_path, {})[file_path] = values
+    for db_path, touches in by_db.items():
+        try:
+            conn = get_db_connection(db_path)
+            try:
+                conn.executemany(
+                    """
+                    INSERT INTO video_cache (file_path, size, last_access, created_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(file_path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access
+                    """,
+                    [(file_path, size, ts, ts) for file_path, (size, ts, _) in touches.items()],
+                )
+                hits = sum(hits for _, _, hits in touches.values())
+                if hits:
+                    cache_bump_stat(conn, "hits", hits)
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            with _cache_lock:
+                for file_path, (size, ts, hits) in touches.items():
+                    key = (db_path, file_path)
+                    newer = _cache_pending.get(key)
+                    if newer is not None:
+                        size, ts, hits = newer[0], newer[1], newer[2] + hits
+                    _cache_pending[key] = (size, ts, hits)
+
+
+def cache_forget(conn: sqlite3.Connection, file_path: str):
+    """เอาไฟล์ออกจากตารางแคช (ใช้ตอนลบตอน/เปลี่ยนไฟล์ของตอน)"""
+    if not file_path:
+        return
+    conn.execute("DELETE FROM video_cache WHERE file_path = ?", (file_path,))
+    key = (conn.db_path, file_path)
+    with _cache_lock:
+        _cache_last_touch.pop(key, None)
+        _cache_pending.pop(key, None)
+
+
+def cache_enforce_quota(keep: str | None = None) -> int:
+    """ลบไฟล์ gdrive ที่ถูกสตรีมล่าสุดนานที่สุดจนพื้นที่แคชไม่เกินโควตา
+    (ไฟล์ของเรื่องยอดนิยมตาม hot_series_ids() ถูกลบทีหลังไฟล์อื่นทั้งหมด)
+
+    ไม่ลบไฟล์ของเรื่องที่ปักหมุด ไฟล์ที่ตอนแบบอัปโหลดใช้อยู่ และไฟล์ ``keep``
+    (ไฟล์ที่กำลังจะส่งให้ผู้ชม) คืนค่าจำนวนไฟล์ที่ลบ
+    """
+    if settings.VIDEO_CACHE_QUOTA_BYTES <= 0:
+        return 0
+
+    # last_access ของไฟล์ที่เพิ่งถูกสตรีมต้องอยู่ใน DB ก่อนเลือกไฟล์ที่จะลบ
+    cache_flush_touches()
+    with _cache_lock:
+        conn = get_db_connection()
+        try:
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM video_cache"
+            ).fetchone()[0]
+            if total <= settings.VIDEO_CACHE_QUOTA_BYTES:
+                return 0
+
+            candidates = conn.execute(
+                """
+                SELECT c.file_path, c.size,
+                       (SELECT e.series_id FROM episodes e WHERE e.file_path = c.file_path LIMIT 1)
+                           AS series_id
+                FROM video_cache c
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM episodes e
+                    JOIN video_cache_pins p ON p.series_id = e.series_id
+                    WHERE e.file_path = c.file_path
+                )
+                AND NOT EXISTS (
+                    SELECT 1 FROM episodes e
+                    WHERE e.file_path = c.file_path AND e.source_type != 'gdrive'
+                )
+                ORDER BY c.last_access
+                """
+            ).fetchall()
+            # ไฟล์ของเรื่องยอดนิยมเก็บไว้ท้ายสุด (sort แบบ stable ลำดับ last_access ในกลุ่มเดิมไม่เปลี่ยน)
+            hot = hot_series_ids()
+            candidates.sort(key=lambda row: row["series_id"] in hot)
+
+            evicted = 0
+            freed = 0
+            for row in candidates:
+                if total <= settings.VIDEO_CACHE_QUOTA_BYTES:
+                    break
+                if row["file_path"] == keep:
+                    continue
+                try:
+                    video_storage().delete(row["file_path"])
+                except (OSError, MediaStorageError):
+                    continue
+                conn.execute(
+                    "DELETE FROM video_cache WHERE file_path = ?", (row["file_path"],)
+                )
+                _cache_last_touch.pop((conn.db_path, row["file_path"]), None)
+                _cache_pending.pop((conn.db_path, row["file_path"]), None)
+                total -= row["size"]
+                freed += row["size"]
+                evicted += 1
+
+            if evicted:
+                cache_bump_stat(conn, "evictions", evicted)
+                cache_bump_stat(conn, "evicted_bytes", freed)
+            conn.commit()
+            return evicted
+        finally:
+            conn.close()
+
+
+def get_cache_stats() -> dict:
+    cache_flush_touches()
+    conn = get_db_connection()
+    usage = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM video_cache"
+    ).fetchone()
+    counters = {
+        row["name"]: row["value"]
+        for row in conn.execute("SELECT name, value FROM video_cache_stats").fetchall()
+    }
+    conn.close()
+
+    hits = counters.get("hits", 0)
+    misses = counters.get("misses", 0)
+    lookups = hits + misses
+    try:
+        disk = shutil.disk_usage(settings.VIDEO_ROOT)
+        disk_total, disk_free = disk.total, disk.free
+    except OSError:
+        disk_total, disk_free = 0, 0
+
+    return {
+        "files": usage[0],
+        "used_bytes": usage[1],
+        "quota_bytes": settings.VIDEO_CACHE_QUOTA_BYTES,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": (hits / lookups) if lookups else 0.0,
+        "evictions": counters.get("evictions", 0),
+        "evicted_bytes": counters.get("evicted_bytes", 0),
+        "prefetches": counters.get("prefetches", 0),
+        "prefetch_pending": sum(1 for db_path, _ in _prefetch_pending if db_path == settings.DB_PATH),
+        "disk_total": disk_total,
+        "disk_free": disk_free,
+    }
+
+
+# ---------- Blob store: เก็บไฟล์วิดีโอตาม hash ของเนื้อไฟล์ ----------
+# episodes.file_path ชี้ไปที่ video_files/blobs/<2 ตัวแรก>/<sha256>.<ext>
+# ตอนหลายตอน (หรือหลายเรื่อง) ที่ใช้ไฟล์เดียวกันจะอ้างถึงไฟล์เดียว โดยนับจำนวนไว้ใน refcount
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def blob_key(conn: sqlite3.Connection, digest: str, ext: str) -> str:
+    """path แบบ relative ของ blob ที่มีเนื้อหา ``digest`` (ใช้ path เดิมถ้ามีแถวใน video_blobs แล้ว)"""
+    row = conn.execute(
+        "SELECT file_path FROM video_blobs WHERE sha256 = ?", (digest,)
+    ).fetchone()
+    if row is not None:
+        return row["file_path"]
+    return os.path.relpath(os.path.join(settings.BLOB_ROOT, digest[:2], digest + ext), BASE_DIR)
+
+
+def blob_store_file(src_path: str, ext: str = ".mp4") -> str:
+    """ย้ายไฟล์ src_path (ในเครื่อง) เข้า blob store ของ MEDIA_STORAGE แล้วคืน path แบบ relative ของ blob
+
+    ถ้ามีไฟล์เนื้อหาเดียวกันอยู่แล้วจะลบ src_path ทิ้งแล้วใช้ไฟล์เดิม
+    ฟังก์ชันนี้ไม่เพิ่ม refcount (ให้ผู้เรียก blob_acquire ตอนผูกกับตอน)
+    """
+    digest = file_sha256(src_path)
+    size = os.path.getsize(src_path)
+    ext = (ext or ".mp4").lower()
+
+    conn = get_db_connection()
+    try:
+        rel_path = blob_key(conn, digest, ext)
+        storage = video_storage()
+        if storage.exists(rel_path):
+            os.remove(src_path)
+        else:
+            # blob ที่ถูกลบออกจากแคชไปแล้วจะถูกเติมกลับมาที่ path เดิม
+            storage.put(rel_path, src_path)
+
+        conn.execute(
+            """
+            INSERT INTO video_blobs (sha256, file_path, size, refcount, created_at)
+            VALUES (?, ?, ?, 0, ?)
+            ON CONFLICT(sha256) DO NOTHING
+            """,
+            (digest, rel_path, size, datetime.utcnow().isoformat()),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return rel_path
+
+
+def find_drive_blob(drive_id: str) -> str | None:
+    """หา blob ที่มีอยู่ในเครื่องแล้วของไฟล์ Drive นี้ (จากตอนใดก็ได้ที่ใช้ drive_id เดียวกัน)"""
+    if not drive_id:
+        return None
+    conn = get_db_connection()
+    rows = conn.execute(
+        """
+        SELECT DISTINCT b.file_path FROM episodes e
+        JOIN video_blobs b ON b.file_path = e.file_path
+        WHERE e.drive_id = ?
+        """,
+        (drive_id,),
+    ).fetchall()
+    conn.close()
+    for row in rows:
+        if video_storage().exists(row["file_path"]):
+            return row["file_path"]
+    return None
+
+
+def blob_acquire(conn: sqlite3.Connection, file_path: str):
+    """เพิ่มจำนวนตอนที่อ้างถึง blob นี้ (ไฟล์แบบเก่าที่ไม่อยู่ใน blob store จะไม่มีผล)"""
+    if file_path:
+        conn.execute(
+            "UPDATE video_blobs SET refcount = refcount + 1 WHERE file_path = ?",
+            (file_path,),
+        )
+
+
+def release_video_file(conn: sqlite3.Connection, file_path: str, exclude_episode_id=None) -> bool:
+    """ปล่อยการอ้างอิงไฟล์วิดีโอของตอนหนึ่ง และลบไฟล์จริงเมื่อไม่มีตอนไหนใช้แล้ว
+
+    ไฟล์ใน blob store ดูจาก refcount ส่วนไฟล์แบบเก่าจะลบเมื่อไม่มีตอนอื่น
+    (นอกจาก exclude_episode_id) อ้างถึง path นี้อีก คืนค่า True ถ้าลบไฟล์
+    """
+    if not file_path:
+        return False
+
+    row = conn.execute(
+        "SELECT sha256, refcount FROM video_blobs WHERE file_path = ?", (file_path,)
+    ).fetchone()
+    if row is not None:
+        if row["refcount"] > 1:
+            conn.execute(
+                "UPDATE video_blobs SET refcount = refcount - 1 WHERE sha256 = ?",
+                (row["sha256"],),
+            )
+            return False
+        conn.execute("DELETE FROM video_blobs WHERE sha256 = ?", (row["sha256"],))
+    else:
+        still_used = conn.execute(
+            "SELECT 1 FROM episodes WHERE file_path = ? AND id != ? LIMIT 1",
+            (file_path, exclude_episode_id or 0),
+        ).fetchone()
+        if still_used:
+            return False
+
+    cache_forget(conn, file_path)
+    try:
+        video_storage().delete(file_path)
+    except (OSError, MediaStorageError) as e:
+        app.logger.warning("delete video %s failed: %s", file_path, e)
+    return True
+
+
+def blob_recount(conn: sqlite3.Connection):
+    """คำนวณ refcount ใหม่จากตาราง episodes (ใช้หลังคืนค่าข้อมูลจากไฟล์สำรอง)"""
+    conn.execute(
+        """
+        UPDATE video_blobs
+        SET refcount = (
+            SELECT COUNT(*) FROM episodes e WHERE e.file_path = video_blobs.file_path
+        )
+        """
+    )
+
+
+def _blob_put_copy(storage, key: str, src_path: str):
+    """เก็บ src_path ลง blob ``key`` โดยไม่แตะไฟล์ต้นทาง (ดิสก์เดียวกันใช้ hard link ไม่ต้อง copy)"""
+    target = storage.local_path(key)
+    if target is not None:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        link_path = f"{target}.{os.getpid()}.link"
+        try:
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.link(src_path, link_path)
+            os.replace(link_path, target)
+            return
+        except OSError:
+            # คนละ filesystem / ไม่รองรับ hard link: copy แทน
+            pass
+    with open(src_path, "rb") as f:
+        storage.put(key, f)
+
+
+def dedup_video_files() -> dict:
+    """ย้ายไฟล์วิดีโอแบบเก่า (video_files/series_<id>/...) เข้า blob store
+
+    ไฟล์ที่เนื้อหาซ้ำกันจะเหลือเพียงชุดเดียว และทุกตอนจะชี้ไปที่ blob เดียวกัน
+    รันจาก `flask --app app migrate-db` หรือ `flask --app app dedup-videos` (รันซ้ำได้ ไฟล์ที่ย้ายแล้วจะถูกข้าม)
+    แต่ละไฟล์: copy/link เข้า blob ก่อน แล้วแก้ video_blobs + episodes + video_cache ใน transaction เดียว
+    ลบไฟล์เดิมหลัง commit เท่านั้น ถ้า process ตายกลางทาง ตอนยังชี้ไฟล์เดิมที่ยังอยู่ (รันใหม่ก็ทำต่อได้)
+    """
+    conn = get_db_connection()
+    rows = conn.execute(
+        """
+        SELECT DISTINCT file_path FROM episodes
+        WHERE file_path IS NOT NULL AND file_path != ''
+          AND file_path NOT IN (SELECT file_path FROM video_blobs)
+        """
+    ).fetchall()
+
+    video_root = os.path.realpath(settings.VIDEO_ROOT)
+    storage = video_storage()
+    result = {"files": 0, "missing": 0, "skipped": 0, "bytes_before": 0, "bytes_saved": 0}
+    blob_bytes_before = conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM video_blobs"
+    ).fetchone()[0]
+
+    for row in rows:
+        old_path = row["file_path"]
+        full = media_abs_path(old_path)
+        if not os.path.isfile(full):
+            result["missing"] += 1
+            continue
+        # ย้ายเฉพาะไฟล์ที่อยู่ใต้ VIDEO_ROOT เท่านั้น
+        if not os.path.realpath(full).startswith(video_root + os.sep):
+            result["skipped"] += 1
+            continue
+
+        size = os.path.getsize(full)
+        digest = file_sha256(full)
+        ext = (os.path.splitext(old_path)[1] or ".mp4").lower()
+        new_path = blob_key(conn, digest, ext)
+        if not storage.exists(new_path):
+            _blob_put_copy(storage, new_path, full)
+
+        conn.execute(
+            """
+            INSERT INTO video_blobs (sha256, file_path, size, refcount, created_at)
+            VALUES (?, ?, ?, 0, ?)
+            ON CONFLICT(sha256) DO NOTHING
+            """,
+            (digest, new_path, size, datetime.utcnow().isoformat()),
+        )
+        conn.execute(
+            "UPDATE episodes SET file_path = ? WHERE file_path = ?", (new_path, old_path)
+        )
+        conn.execute(
+            "UPDATE OR REPLACE video_cache SET file_path = ? WHERE file_path = ?",
+            (new_path, old_path),
+        )
+        conn.execute(
+            """
+            UPDATE video_blobs SET refcount = (SELECT COUNT(*) FROM episodes WHERE file_path = ?)
+            WHERE sha256 = ?
+            """,
+            (new_path, digest),
+        )
+        conn.commit()
+
+        try:
+            os.remove(full)
+        except FileNotFoundError:
+            pass
+        result["files"] += 1
+        result["bytes_before"] += size
+
+    blob_recount(conn)
+    blob_bytes_after = conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM video_blobs"
+    ).fetchone()[0]
+    conn.commit()
+    conn.close()
+
+    result["bytes_saved"] = result["bytes_before"] - (blob_bytes_after - blob_bytes_before)
+
+    # ลบโฟลเดอร์ series_<id> ที่ว่างแล้ว
+    for name in os.listdir(settings.VIDEO_ROOT) if os.path.isdir(settings.VIDEO_ROOT) else ():
+        path = os.path.join(settings.VIDEO_ROOT, name)
+        if name.startswith("series_") and os.path.isdir(path) and not os.listdir(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+    return result
+
+
+@app.cli.command("dedup-videos")
+def dedup_videos_command():
+    """ย้ายไฟล์วิดีโอเดิมเข้า blob store และรวมไฟล์ที่ซ้ำกัน"""
+    create_app()
+    print_dedup_result(dedup_video_files())
+
+
+def print_dedup_result(result: dict):
+    print(
+        f"ย้ายไฟล์ {result['files']} ไฟล์ (ไม่พบ {result['missing']}, ข้าม {result['skipped']}) "
+        f"ประหยัดพื้นที่ได้ {human_bytes(result['bytes_saved'])}"
+    )
+
+
+def copy_media_to_storage() -> dict:
+    """คัดลอกไฟล์วิดีโอ/รูปปกที่ DB อ้างถึง จากดิสก์ในเครื่องขึ้นที่เก็บปัจจุบัน (ใช้ตอนย้ายไป MEDIA_STORAGE=s3)
+
+    ไฟล์ที่มีในที่เก็บแล้วจะข้าม (รันซ้ำได้) ไฟล์ในเครื่องไม่ถูกลบ
+    """
+    conn = get_db_connection()
+    keys = {
+        "video": [
+            row[0] for row in conn.execute(
+                "SELECT DISTINCT file_path FROM episodes WHERE file_path IS NOT NULL AND file_path != ''"
+            )
+        ],
+        "cover": [
+            row[0] for row in conn.execute(
+                "SELECT thumbnail_url FROM series UNION SELECT thumbnail_url FROM episodes"
+            )
+            if is_stored_cover(row[0])
+        ],
+    }
+    conn.close()
+
+    sources = {"video": LocalStorage(BASE_DIR), "cover": LocalStorage(os.path.join(BASE_DIR, "static"))}
+    result = {"copied": 0, "present": 0, "missing": 0, "bytes": 0}
+    for kind, kind_keys in keys.items():
+        target = get_media_storage(kind)
+        if isinstance(target, LocalStorage):
+            continue
+        for key in kind_keys:
+            if target.exists(key):
+                result["present"] += 1
+                continue
+            info = sources[kind].stat(key)
+            if info is None:
+                result["missing"] += 1
+                continue
+            with open(sources[kind].local_path(key), "rb") as f:
+                target.put(key, f)
+            result["copied"] += 1
+            result["bytes"] += info.size
+    return result
+
+
+@app.cli.command("media-upload")
+def media_upload_command():
+    """คัดลอกไฟล์วิดีโอ/รูปปกในเครื่องขึ้นที่เก็บตาม MEDIA_STORAGE (เช่น S3 / MinIO)"""
+    create_app()
+    if settings.MEDIA_STORAGE == "local":
+        print("MEDIA_STORAGE=local ไฟล์อยู่ในเครื่องอยู่แล้ว ไม่ต้องคัดลอก")
+        return
+    result = copy_media_to_storage()
+    print(
+        f"คัดลอก {result['copied']} ไฟล์ ({human_bytes(result['bytes'])}) "
+        f"มีอยู่แล้ว {result['present']} ไฟล์ ไม่พบในเครื่อง {result['missing']} ไฟล์"
+    )
+
+
+# ---------- โหลดไฟล์ Drive กลับมา + prefetch ตอนถัดไป ----------
+
+
+def rehydrate_drive_episode(episode, stat: str = "misses", limiter: RateLimiter | None = None) -> str:
+    """โหลดไฟล์ของตอนแบบ gdrive กลับมาเมื่อไฟล์ในเครื่องหาย แล้วอัปเดต file_path ของตอน
+
+    คืน path แบบ relative ของไฟล์ (key ในที่เก็บ) และนับสถิติแคชตามชื่อ ``stat`` (misses หรือ prefetches)
+    """
+    file_path = episode["file_path"]
+    rel_path = download_drive_file(episode["drive_id"], episode["series_id"], limiter=limiter)
+    conn = get_db_connection()
+    if rel_path != file_path:
+        conn.execute(
+            "UPDATE episodes SET file_path = ? WHERE id = ?",
+            (rel_path, episode["id"]),
+        )
+        blob_acquire(conn, rel_path)
+        release_video_file(conn, file_path, exclude_episode_id=episode["id"])
+    cache_bump_stat(conn, stat)
+    conn.commit()
+    conn.close()
+
+    # ไฟล์ที่เพิ่งโหลดกลับมาเข้าแคช แล้วลบไฟล์เก่าที่ไม่ได้ดูนานถ้าเกินโควตา
+    cache_touch(rel_path, hit=False, force=True)
+    cache_enforce_quota(keep=rel_path)
+    return rel_path
+
+
+_prefetch_lock = threading.Lock()
+_prefetch_executors = {}  # PREFETCH_CONCURRENCY -> ThreadPoolExecutor
+_prefetch_pending = set()  # (DB_PATH, drive_id) ที่รอคิว/กำลังโหลด
+# token bucket เดียวต่อค่า PREFETCH_BANDWIDTH_BYTES ใช้ร่วมกันทุกงาน prefetch ทำให้แบนด์วิดท์รวมไม่เกินที่ตั้งไว้
+_prefetch_limiters = {}  # PREFETCH_BANDWIDTH_BYTES -> RateLimiter
+
+
+def _get_prefetch_executor() -> ThreadPoolExecutor:
+    # สร้างตอนใช้งานครั้งแรก (ไม่สร้าง thread ตั้งแต่ import)
+    concurrency = settings.PREFETCH_CONCURRENCY
+    with _prefetch_lock:
+        executor = _prefetch_executors.get(concurrency)
+        if executor is None:
+            executor = _prefetch_executors[concurrency] = ThreadPoolExecutor(
+                max_workers=concurrency, thread_name_prefix="prefetch"
+            )
+        return executor
+
+
+def _get_prefetch_limiter() -> RateLimiter | None:
+    rate = settings.PREFETCH_BANDWIDTH_BYTES
+    if rate <= 0:
+        return None
+    with _prefetch_lock:
+        limiter = _prefetch_limiters.get(rate)
+        if limiter is None:
+            limiter = _prefetch_limiters[rate] = RateLimiter(rate)
+        return limiter
+
+
+def _prefetch_episode_job(flask_app: Flask, episode_id: int, drive_id: str):
+    # thread ของ pool ไม่มี app context ใช้ค่าตั้งของแอปที่สั่ง prefetch
+    with flask_app.app_context():
+        try:
+            conn = get_db_connection()
+            episode = conn.execute(
+                "SELECT * FROM episodes WHERE id = ?", (episode_id,)
+            ).fetchone()
+            conn.close()
+            if episode is None or episode["source_type"] != "gdrive" or not episode["drive_id"]:
+                return
+            if episode["file_path"] and video_storage().exists(episode["file_path"]):
+                return
+
+            rehydrate_drive_episode(episode, stat="prefetches", limiter=_get_prefetch_limiter())
+        except Exception as e:
+            app.logger.warning("prefetch episode %s failed: %s", episode_id, e)
+        finally:
+            with _prefetch_lock:
+                _prefetch_pending.discard((settings.DB_PATH, drive_id))
+
+
+def prefetch_next_episodes(series_id: int, episode_id: int) -> int:
+    """สั่งโหลดไฟล์ของตอนถัดไป PREFETCH_DEPTH ตอน (เรียงตาม episode_number) ไว้ล่วงหน้า
+    เรื่องยอดนิยมใช้ PREFETCH_DEPTH_HOT แทน
+
+    ข้ามตอนที่มีไฟล์อยู่แล้ว ตอนที่ถูกปิด และไฟล์ที่กำลังโหลดอยู่ คืนจำนวนงานที่สั่งเพิ่ม
+    """
+    if settings.PREFETCH_DEPTH <= 0:
+        return 0
+    depth = settings.PREFETCH_DEPTH
+    if series_id in hot_series_ids():
+        depth = max(depth, settings.PREFETCH_DEPTH_HOT)
+
+    series = get_catalog().series(series_id)
+    if series is None:
+        return 0
+    ids = [episode.id for episode in series.episodes]
+    if episode_id not in ids:
+        return 0
+    upcoming = series.episodes[ids.index(episode_id) + 1: ids.index(episode_id) + 1 + depth]
+
+    queued = 0
+    for episode in upcoming:
+        if episode.source_type != "gdrive" or not episode.drive_id:
+            continue
+        if not episode.active:
+            continue
+        if episode.file_path and video_storage().exists(episode.file_path):
+            continue
+
+        key = (settings.DB_PATH, episode.drive_id)
+        with _prefetch_lock:
+            if key in _prefetch_pending:
+                continue
+            if len(_prefetch_pending) >= settings.PREFETCH_QUEUE_LIMIT:
+                break
+            _prefetch_pending.add(key)
+        _get_prefetch_executor().submit(
+            _prefetch_episode_job, current_app._get_current_object(), episode.id, episode.drive_id
+        )
+        queued += 1
+    return queued
+
+
+# ---------- แคชในหน่วยความจำให้ตรงกันทุก worker (PRAGMA data_version + cache_epochs) ----------
+# trigger ใน videos.db เพิ่ม epoch ของ namespace ทุกครั้งที่ตารางของ namespace นั้นถูกแก้ (ดู migration 005)
+# แต่ละ process ถือ connection เฝ้าไว้หนึ่งตัว ทุก CACHE_CHECK_INTERVAL วินาทีถาม PRAGMA data_version
+# ซึ่งเปลี่ยนเมื่อ connection อื่น (process อื่นหรือ process นี้) commit เท่านั้น ถ้าไม่เปลี่ยนก็จบโดยไม่อ่านตาราง
+# ถ้าเปลี่ยนค่อยอ่าน cache_epochs แคชที่ epoch ไม่ตรงจะโหลดใหม่ ส่วน namespace อื่นไม่ถูกแตะ
+# (watch_history / rollup แบนด์วิดท์ถูกเขียนตลอด จึงใช้ data_version อย่างเดียวไม่ได้)
+
+_cache_watchers = {}  # (pid, DB_PATH) -> [connection, data_version ล่าสุด]
+_cache_epochs = {}  # DB_PATH -> {namespace: epoch ที่ process นี้เห็นล่าสุด}
+_cache_checked = {}  # DB_PATH -> time.monotonic() ที่ตรวจล่าสุด
+_cache_dirty = set()  # DB_PATH ที่ process นี้เพิ่ง commit
+_cache_coherence_lock = threading.Lock()
+
+
+def read_cache_epoch(conn: sqlite3.Connection, namespace: str) -> int:
+    row = conn.execute("SELECT epoch FROM cache_epochs WHERE namespace = ?", (namespace,)).fetchone()
+    return row[0] if row is not None else 0
+
+
+def mark_cache_dirty(db_path: str | None = None):
+    """ให้ sync_cache_epochs() ครั้งถัดไปของ DB นี้ตรวจทันที (เรียกหลัง commit ที่แก้ข้อมูล)"""
+    _cache_dirty.add(db_path or settings.DB_PATH)
+
+
+def sync_cache_epochs(db_path: str | None = None):
+    """อัปเดต epoch ของทุก namespace ใน DB ของแอปปัจจุบัน ถ้ามีการ commit จาก connection อื่นตั้งแต่ตรวจครั้งก่อน
+
+    ตรวจไม่บ่อยกว่า CACHE_CHECK_INTERVAL วินาที (ยกเว้น process นี้เพิ่งแก้ข้อมูลเอง)
+    """
+    db_path = db_path or settings.DB_PATH
+    interval = settings.CACHE_CHECK_INTERVAL
+    if db_path not in _cache_dirty and time.monotonic() - _cache_checked.get(db_path, 0.0) < interval:
+        return
+
+    with _cache_coherence_lock:
+        if db_path not in _cache_dirty and time.monotonic() - _cache_checked.get(db_path, 0.0) < interval:
+            return
+        _cache_dirty.discard(db_path)
+        _cache_checked[db_path] = time.monotonic()
+
+        key = (os.getpid(), db_path)
+        try:
+            watcher = _cache_watchers.get(key)
+            if watcher is None:
+                # connection ธรรมดา (ไม่ใช่ TracedConnection) ไม่นับเป็น query ของ request
+                watcher = [sqlite3.connect(db_path, timeout=5, check_same_thread=False), None]
+                _cache_watchers[key] = watcher
+            conn = watcher[0]
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == watcher[1]:
+                return
+            epochs = dict(conn.execute("SELECT namespace, epoch FROM cache_epochs").fetchall())
+        except sqlite3.Error:
+            # DB ไม่ว่างชั่วคราว ใช้แคชเดิมไปก่อนแล้วลองใหม่รอบถัดไป
+            return
+        watcher[1] = data_version
+        _cache_epochs.setdefault(db_path, {}).update(epochs)
+
+
+def cache_epoch(namespace: str, db_path: str | None = None) -> int | None:
+    """epoch ล่าสุดของ namespace ใน DB ของแอปปัจจุบันที่ process นี้รู้ (แคชที่สร้างจาก epoch อื่นถือว่าเก่าแล้ว)"""
+    return _cache_epochs.get(db_path or settings.DB_PATH, {}).get(namespace)
+
+
+def note_cache_epoch(namespace: str, epoch: int):
+    """จำ epoch ที่เพิ่งอ่านพร้อมข้อมูล (อาจใหม่กว่าที่ sync_cache_epochs เห็นล่าสุด)"""
+    _cache_epochs.setdefault(settings.DB_PATH, {})[namespace] = epoch
+
+
+def close_cache_watchers():
+    """ปิด connection เฝ้า data_version ของ process นี้ (ก่อน fork จะได้ไม่มี connection ค้าง)"""
+    with _cache_coherence_lock:
+        for key in [key for key in _cache_watchers if key[0] == os.getpid()]:
+            _cache_watchers.pop(key)[0].close()
+
+
+# ---------- Catalog ในหน่วยความจำ (เรื่อง/ตอน ที่หน้าเว็บสาธารณะใช้) ----------
+# catalog มีขนาดเล็กและเปลี่ยนไม่บ่อย แต่ละ worker เก็บ snapshot ทั้งหมดไว้ในหน่วยความจำ
+# หน้า index / search / series_detail / watch_episode อ่านจาก snapshot โดยไม่รัน SQL
+# snapshot จำ epoch ของ namespace "catalog" ที่ใช้สร้าง ถ้า epoch เปลี่ยนจะสร้างใหม่แล้วสลับทีเดียว
+
+_catalogs = {}  # DB_PATH -> Catalog ล่าสุด
+_catalog_lock = threading.Lock()
+
+
+def _active_flag(value) -> bool:
+    """ค่า is_active ในตาราง (NULL หรืออ่านไม่ได้ = เปิด)"""
+    try:
+        return value is None or int(value) != 0
+    except (TypeError, ValueError):
+        return True
+
+
+def catalog_visible(series, episode=None) -> bool:
+    """กฎการมองเห็นเดียวของทั้งระบบ (หน้าเว็บ, /stream, /api/v1): เรื่องต้องเปิดอยู่ และตอนถ้าระบุก็ต้องเปิดอยู่
+
+    ``series`` / ``episode`` เป็นแถวจาก DB หรือ record ใน Catalog ก็ได้
+    """
+    if series is None or not _active_flag(series["is_active"]):
+        return False
+    return episode is None or _active_flag(episode["is_active"])
+
+
+class _CatalogRecord:
+    """แถวแบบอ่านอย่างเดียวที่ใช้แทน sqlite3.Row ได้ (row['key'], keys(), dict(row))"""
+
+    __slots__ = ()
+    FIELDS = ()
+
+    def __init__(self, row):
+        for key in self.FIELDS:
+            setattr(self, key, row[key])
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+
+class CatalogSeries(_CatalogRecord):
+    """เรื่องหนึ่งเรื่อง: active = เปิดให้ดู, episodes = ตอนทั้งหมดเรียงตามลำดับตอนแล้ว
+
+    sort_key = (datetime(created_at), id) เรียงจากมากไปน้อยเหมือนหน้าแรก
+    """
+
+    FIELDS = ("id", "title", "description", "thumbnail_url", "created_at", "is_active")
+    __slots__ = FIELDS + ("active", "episodes", "sort_key")
+
+    def __init__(self, row):
+        super().__init__(row)
+        self.active = catalog_visible(self)
+        self.episodes = ()
+        self.sort_key = (row["sorted_at"] or "", self.id)
+
+
+class CatalogEpisode(_CatalogRecord):
+    """ตอนหนึ่งตอน: active = ดูได้จริง (ทั้งตอนและเรื่องของตอนต้องเปิดอยู่)
+
+    sort_key = (ไม่มีเลขตอน, เลขตอน, datetime(created_at), id) เรียงจากน้อยไปมาก
+    """
+
+    FIELDS = (
+        "id", "series_id", "title", "description", "episode_number", "source_type",
+        "video_url", "drive_id", "file_path", "thumbnail_url", "created_at", "is_active",
+    )
+    __slots__ = FIELDS + ("active", "sort_key")
+
+    def __init__(self, row, series: CatalogSeries):
+        super().__init__(row)
+        self.active = catalog_visible(series, self)
+        try:
+            number = int(self.episode_number) if self.episode_number is not None else None
+        except (TypeError, ValueError):
+            number = None
+        self.sort_key = (number is None, number or 0, row["sorted_at"] or "", self.id)
+
+
+class Catalog:
+    """snapshot ของเรื่อง/ตอนทั้งหมด ณ เวอร์ชันหนึ่ง สร้างเสร็จแล้วไม่แก้อีก (อ่านจากหลาย thread ได้)"""
+
+    __slots__ = (
+        "version", "series_list", "visible_series", "series_by_id", "episodes_by_id",
+        "series_changes", "episode_changes",
+    )
+
+    def __init__(self, version: int, series_list: list, episodes_by_id: dict, changes: dict | None = None):
+        self.version = version
+        # เรียงเรื่องใหม่สุดก่อน เหมือนหน้าแรก
+        self.series_list = tuple(series_list)
+        self.visible_series = tuple(series for series in series_list if series.active)
+        self.series_by_id = {series.id: series for series in series_list}
+        self.episodes_by_id = episodes_by_id
+        # id -> epoch ที่เปลี่ยนล่าสุด (รวมเรื่อง/ตอนที่ถูกลบไปแล้ว)
+        changes = changes or {}
+        self.series_changes = changes.get("series", {})
+        self.episode_changes = changes.get("episode", {})
+
+    def series(self, series_id: int) -> CatalogSeries | None:
+        return self.series_by_id.get(series_id)
+
+    def episode(self, series_id: int, episode_id: int) -> CatalogEpisode | None:
+        episode = self.episodes_by_id.get(episode_id)
+        if episode is None or episode.series_id != series_id:
+            return None
+        return episode
+
+
+def load_catalog(conn: sqlite3.Connection) -> Catalog:
+    """อ่านเรื่อง/ตอนทั้งหมดแล้วสร้าง Catalog
+
+    อ่าน epoch ก่อนข้อมูล ถ้ามีการแก้ระหว่างอ่าน epoch ใน DB จะต่างจากที่จำไว้แล้วถูกสร้างใหม่รอบถัดไป
+    """
+    version = read_cache_epoch(conn, "catalog")
+    # เรียงใน Python ด้วย sort_key ตัวเดียวกับที่ cursor ของ API ใช้ ลำดับจึงตรงกันเสมอ
+    series_list = sorted(
+        (
+            CatalogSeries(row)
+            for row in conn.execute(
+                f"SELECT {', '.join(CatalogSeries.FIELDS)}, datetime(created_at) AS sorted_at FROM series"
+            )
+        ),
+        key=lambda series: series.sort_key,
+        reverse=True,
+    )
+    by_id = {series.id: series for series in series_list}
+
+    grouped = {}
+    episodes_by_id = {}
+    for row in conn.execute(
+        f"SELECT {', '.join(CatalogEpisode.FIELDS)}, datetime(created_at) AS sorted_at FROM episodes"
+    ):
+        series = by_id.get(row["series_id"])
+        if series is None:
+            continue
+        episode = CatalogEpisode(row, series)
+        grouped.setdefault(series.id, []).append(episode)
+        episodes_by_id[episode.id] = episode
+
+    for series_id, episodes in grouped.items():
+        by_id[series_id].episodes = tuple(sorted(episodes, key=lambda episode: episode.sort_key))
+
+    changes = {}
+    for row in conn.execute("SELECT kind, item_id, version FROM catalog_changes"):
+        changes.setdefault(row["kind"], {})[row["item_id"]] = row["version"]
+    return Catalog(version, series_list, episodes_by_id, changes)
+
+
+def get_catalog() -> Catalog:
+    """snapshot ปัจจุบันของ catalog ใน DB ของแอป (สร้างใหม่เมื่อ epoch ของ "catalog" เปลี่ยน)"""
+    db_path = settings.DB_PATH
+    sync_cache_epochs(db_path)
+    catalog = _catalogs.get(db_path)
+    if catalog is not None and catalog.version == cache_epoch("catalog", db_path):
+        return catalog
+
+    with _catalog_lock:
+        # thread อื่นอาจเพิ่งสร้างใหม่ไปแล้วระหว่างรอ lock
+        catalog = _catalogs.get(db_path)
+        if catalog is not None and catalog.version == cache_epoch("catalog", db_path):
+            return catalog
+        try:
+            conn = get_db_connection(db_path)
+            try:
+                loaded = load_catalog(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            # DB ไม่ว่างชั่วคราว ใช้ snapshot เดิมไปก่อน
+            if catalog is None:
+                raise
+            return catalog
+        _catalogs[db_path] = loaded
+        note_cache_epoch("catalog", loaded.version)
+        return loaded
+
+
+# ---------- ดัชนีคำนำหน้าสำหรับแนะนำชื่อเรื่อง/ตอนขณะพิมพ์ (/search/suggest) ----------
+# เก็บ (ชื่อที่ normalize แล้ว, ...) เรียงไว้ใน list เดียว หาคำนำหน้าด้วย bisect ไม่ต้องไล่ให้คะแนนทุกเรื่องแบบ /search
+# แต่ละชื่อใส่ไว้หลาย key: ทั้งชื่อ และตั้งแต่ต้นแต่ละคำ ("s2" ก็เจอ "มหาเวทย์ผนึกมาร S2")
+# ดัชนีผูกกับ version ของ Catalog เมื่อ catalog เปลี่ยนจะแก้เฉพาะเรื่อง/ตอนที่อยู่ใน catalog_changes หลัง version เดิม
+
+# เลขไทย -> เลขอารบิก ให้ "ภาค ๒" กับ "ภาค 2" ตรงกัน
+_THAI_DIGITS = str.maketrans("๐๑๒๓๔๕๖๗๘๙", "0123456789")
+
+_suggest_indexes = {}  # DB_PATH -> SuggestIndex
+_suggest_lock = threading.Lock()
+
+
+def normalize_title(text) -> str:
+    """รูปแบบกลางของชื่อสำหรับเทียบคำนำหน้า
+
+    NFKC (ตัวอักษรเต็มความกว้าง, สระอำที่พิมพ์เป็นนิคหิต+สระอา ให้เป็นแบบเดียวกัน), casefold ตัวละติน,
+    เลขไทยเป็นเลขอารบิก, เครื่องหมาย/ช่องว่างทุกแบบเป็นช่องว่างเดียว และตัดอักขระควบคุม (เช่น zero-width space)
+    """
+    text = unicodedata.normalize("NFKC", text or "").casefold().translate(_THAI_DIGITS)
+    chars = []
+    for ch in text:
+        category = unicodedata.category(ch)[0]
+        if category in "PSZ":
+            chars.append(" ")
+        elif category != "C":
+            chars.append(ch)
+    return " ".join("".join(chars).split())
+
+
+def _title_keys(title) -> set:
+    """key ทั้งหมดของชื่อหนึ่งชื่อ: ชื่อเต็ม และส่วนท้ายที่เริ่มจากต้นแต่ละคำ"""
+    words = normalize_title(title).split(" ")
+    return {" ".join(words[i:]) for i in range(len(words)) if words[i]}
+
+
+class SuggestIndex:
+    """ดัชนีคำนำหน้าของ Catalog เวอร์ชันหนึ่ง
+
+    series = [(key, series_id)], episodes = [(key, series_id, episode_id)] เรียงตาม key
+    มีเฉพาะเรื่อง/ตอนที่ catalog_visible
+    """
+
+    __slots__ = ("version", "series", "episodes")
+
+    def __init__(self, version: int, series: list, episodes: list):
+        self.version = version
+        self.series = series
+        self.episodes = episodes
+
+    def lookup(self, prefix: str, limit: int) -> tuple:
+        """คืน ([series_id], [(series_id, episode_id)]) ที่ขึ้นต้นด้วย prefix (normalize แล้ว) รวมไม่เกิน limit"""
+        series_ids = _prefix_scan(self.series, prefix, limit, lambda entry: entry[1])
+        episode_ids = _prefix_scan(
+            self.episodes, prefix, limit - len(series_ids), lambda entry: (entry[1], entry[2])
+        )
+        return series_ids, episode_ids
+
+
+def _prefix_scan(entries: list, prefix: str, limit: int, ident) -> list:
+    found = []
+    if limit <= 0:
+        return found
+    seen = set()
+    # (prefix,) น้อยกว่าทุก tuple ที่ขึ้นต้นด้วย prefix
+    for i in range(bisect.bisect_left(entries, (prefix,)), len(entries)):
+        entry = entries[i]
+        if not entry[0].startswith(prefix):
+            break
+        item = ident(entry)
+        if item not in seen:
+            seen.add(item)
+            found.append(item)
+            if len(found) >= limit:
+                break
+    return found
+
+
+def _suggest_series_entries(series: CatalogSeries) -> list:
+    if not series.active:
+        return []
+    return [(key, series.id) for key in _title_keys(series.title)]
+
+
+def _suggest_episode_entries(episode: CatalogEpisode) -> list:
+    if not episode.active:
+        return []
+    return [(key, episode.series_id, episode.id) for key in _title_keys(episode.title)]
+
+
+def build_suggest_index(catalog: Catalog) -> SuggestIndex:
+    series, episodes = [], []
+    for item in catalog.series_list:
+        series += _suggest_series_entries(item)
+        for episode in item.episodes:
+            episodes += _suggest_episode_entries(episode)
+    series.sort()
+    episodes.sort()
+    return SuggestIndex(catalog.version, series, episodes)
+
+
+def update_suggest_index(index: SuggestIndex, catalog: Catalog) -> SuggestIndex:
+    """สร้างดัชนีของ catalog ใหม่จากดัชนีเดิม โดย normalize ใหม่เฉพาะเรื่อง/ตอนที่เปลี่ยนหลัง index.version
+
+    เรื่องที่เปลี่ยน (เช่นถูกปิด) ทำให้ทุกตอนของเรื่องนั้นต้องคำนวณใหม่ด้วย
+    """
+    since = index.version
+    series_ids = {item_id for item_id, version in catalog.series_changes.items() if version > since}
+    episode_ids = {item_id for item_id, version in catalog.episode_changes.items() if version > since}
+
+    series = [entry for entry in index.series if entry[1] not in series_ids]
+    episodes = [
+        entry for entry in index.episodes if entry[1] not in series_ids and entry[2] not in episode_ids
+    ]
+    added_series, added_episodes = [], []
+    for series_id in series_ids:
+        item = catalog.series(series_id)
+        if item is not None:
+            added_series += _suggest_series_entries(item)
+            for episode in item.episodes:
+                added_episodes += _suggest_episode_entries(episode)
+    for episode_id in episode_ids:
+        episode = catalog.episodes_by_id.get(episode_id)
+        if episode is not None and episode.series_id not in series_ids:
+            added_episodes += _suggest_episode_entries(episode)
+
+    # list เดิมเรียงอยู่แล้ว แทรกของใหม่ (ซึ่งมีไม่กี่รายการ) ทีละตัว
+    for entry in sorted(added_series):
+        bisect.insort(series, entry)
+    for entry in sorted(added_episodes):
+        bisect.insort(episodes, entry)
+    return SuggestIndex(catalog.version, series, episodes)
+
+
+def get_suggest_index(catalog: Catalog) -> SuggestIndex:
+    """ดัชนีของ catalog ที่ส่งมา (แก้ต่อจากดัชนีเดิมของ DB เดียวกันถ้า catalog ใหม่กว่า)"""
+    db_path = settings.DB_PATH
+    index = _suggest_indexes.get(db_path)
+    if index is not None and index.version == catalog.version:
+        return index
+
+    with _suggest_lock:
+        index = _suggest_indexes.get(db_path)
+        if index is not None and index.version == catalog.version:
+            return index
+        if index is None or index.version > catalog.version:
+            # ยังไม่เคยสร้าง หรือ catalog เก่ากว่าดัชนี (เช่นคืนค่า DB จากไฟล์สำรอง) สร้างใหม่ทั้งหมด
+            index = build_suggest_index(catalog)
+        else:
+            index = update_suggest_index(index, catalog)
+        _suggest_indexes[db_path] = index
+        return index
+
+
+# ---------- แบนด์วิดท์ที่สตรีมออกไป (ต่อตอน/เรื่อง/ผู้ใช้) ----------
+# นับเฉพาะไบต์ที่ส่งถึงผู้ชมจริง (รวม Range และการเชื่อมต่อที่ถูกตัดกลางทาง)
+# สะสมในหน่วยความจำของแต่ละ worker แล้วบวกลงตาราง rollup ใน videos.db ทุก BANDWIDTH_FLUSH_INTERVAL วินาที
+# (รอบเดียวกันนี้เขียน last_access/hit ของไฟล์แคชที่ cache_touch() จดไว้ด้วย)
+
+_bandwidth_lock = threading.Lock()
+_bandwidth_episodes = {}  # (DB_PATH, episode_id, series_id, hour) -> [bytes, estimated_bytes, requests]
+_bandwidth_users = {}  # (DB_PATH, user_id, day) -> [bytes, estimated_bytes, requests]
+_bandwidth_last_flush = 0.0
+
+# เรื่องยอดนิยม (คำนวณจาก rollup) จำไว้ต่อ process อ่านใหม่ทุก HOT_SERIES_REFRESH_INTERVAL วินาที
+HOT_SERIES_REFRESH_INTERVAL = 300
+_hot_series = {}  # DB_PATH -> (เวลาที่อ่าน, frozenset ของ series_id)
+
+
+def bandwidth_record(episode_id: int, series_id: int, user_id: int | None, sent_bytes: int,
+                     estimated: bool = False):
+    """จดไบต์ของ request หนึ่ง ``estimated`` = ไม่รู้ยอดจริง (proxy ส่งแทน) ``sent_bytes`` คือช่วงที่ขอ"""
+    now = datetime.utcnow()
+    hour = now.strftime("%Y-%m-%d %H:00")
+    day = now.strftime("%Y-%m-%d")
+    db_path = settings.DB_PATH
+    column = 1 if estimated else 0
+    with _bandwidth_lock:
+        totals = _bandwidth_episodes.setdefault((db_path, episode_id, series_id, hour), [0, 0, 0])
+        totals[column] += sent_bytes
+        totals[2] += 1
+        if user_id:
+            totals = _bandwidth_users.setdefault((db_path, user_id, day), [0, 0, 0])
+            totals[column] += sent_bytes
+            totals[2] += 1
+    bandwidth_flush()
+
+
+def bandwidth_flush(force: bool = False):
+    """บวกยอดที่สะสมไว้ลง videos.db (ถ้าเขียนไม่สำเร็จ เก็บไว้รวมกับรอบถัดไป)"""
+    global _bandwidth_last_flush
+
+    with _bandwidth_lock:
+        now = time.monotonic()
+        if not force and now - _bandwidth_last_flush < settings.BANDWIDTH_FLUSH_INTERVAL:
+            return
+        _bandwidth_last_flush = now
+        pending_episodes = dict(_bandwidth_episodes)
+        pending_users = dict(_bandwidth_users)
+        _bandwidth_episodes.clear()
+        _bandwidth_users.clear()
+
+    # การจดไฟล์แคชที่ค้างจาก cache_touch() ใช้รอบเขียนเดียวกัน
+    cache_flush_touches()
+    # แยกยอดตามฐานข้อมูล (แต่ละแอปที่ create_app() สร้างมี DB_PATH ของตัวเอง)
+    by_db = {}
+    for key, values in pending_episodes.items():
+        by_db.setdefault(key[0], ([], []))[0].append(key[1:] + tuple(values))
+    for key, values in pending_users.items():
+        by_db.setdefault(key[0], ([], []))[1].append(key[1:] + tuple(values))
+    for db_path, (episode_rows, user_rows) in by_db.items():
+        try:
+            _bandwidth_write(db_path, episode_rows, user_rows)
+        except sqlite3.Error as e:
+            app.logger.warning("bandwidth flush failed: %s", e)
+            with _bandwidth_lock:
+                for pending, target in ((pending_episodes, _bandwidth_episodes), (pending_users, _bandwidth_users)):
+                    for key, values in pending.items():
+                        if key[0] != db_path:
+                            continue
+                        totals = target.setdefault(key, [0, 0, 0])
+                        for index, value in enumerate(values):
+                            totals[index] += value
+
+
+def _bandwidth_write(db_path: str, episode_rows: list, user_rows: list):
+    conn = get_db_connection(db_path)
+    try:
+        conn.executemany(
+            """
+            INSERT INTO bandwidth_episode_hourly (episode_id, series_id, hour, bytes, estimated_bytes, requests)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (episode_id, hour) DO UPDATE SET
+                bytes = bytes + excluded.bytes,
+                estimated_bytes = estimated_bytes + excluded.estimated_bytes,
+                requests = requests + excluded.requests
+            """,
+            episode_rows,
+        )
+        conn.executemany(
+            """
+            INSERT INTO bandwidth_user_daily (user_id, day, bytes, estimated_bytes, requests)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, day) DO UPDATE SET
+                bytes = bytes + excluded.bytes,
+                estimated_bytes = estimated_bytes + excluded.estimated_bytes,
+                requests = requests + excluded.requests
+            """,
+            user_rows,
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def bandwidth_since(hours: int) -> str:
+    """ค่า hour (รูปแบบเดียวกับในตาราง rollup) ของ ``hours`` ชั่วโมงก่อนหน้า"""
+    return (datetime.utcnow() - timedelta(hours=hours)).strftime("%Y-%m-%d %H:00")
+
+
+def hot_series_ids() -> frozenset:
+    """id ของเรื่องที่ใช้แบนด์วิดท์มากที่สุด HOT_SERIES_COUNT เรื่องใน HOT_SERIES_WINDOW_HOURS ล่าสุด"""
+    if settings.HOT_SERIES_COUNT <= 0:
+        return frozenset()
+
+    db_path = settings.DB_PATH
+    now = time.monotonic()
+    checked, hot = _hot_series.get(db_path, (None, frozenset()))
+    if checked is not None and now - checked < HOT_SERIES_REFRESH_INTERVAL:
+        return hot
+    _hot_series[db_path] = (now, hot)
+
+    try:
+        conn = get_db_connection()
+        try:
+            rows = conn.execute(
+                """
+                SELECT series_id FROM bandwidth_episode_hourly
+                WHERE hour >= ?
+                GROUP BY series_id
+                ORDER BY SUM(bytes + estimated_bytes) DESC
+                LIMIT ?
+                """,
+                (bandwidth_since(settings.HOT_SERIES_WINDOW_HOURS), settings.HOT_SERIES_COUNT),
+            ).fetchall()
+        finally:
+            conn.close()
+        hot = frozenset(row["series_id"] for row in rows)
+        _hot_series[db_path] = (now, hot)
+    except sqlite3.Error:
+        pass
+    return hot
+
+
+def _flush_bandwidth_at_exit():
+    try:
+        bandwidth_flush(force=True)
+    except Exception:
+        pass
+
+
+atexit.register(_flush_bandwidth_at_exit)
+
+
+# ---------- จำกัดสตรีมต่อผู้ใช้ (จำนวนพร้อมกัน + ไบต์ต่อวินาที) ----------
+# นับเป็น "การดู" (ผู้ใช้ + ตอน) ไม่ใช่ Range request: player ขอ Range ซ้อนกันหลายครั้งต่อการดูหนึ่งครั้ง
+# (seek, probe moov atom) ทุก request ของการดูเดียวกันใช้ lease เดียวกันที่จำไว้ในหน่วยความจำของ process
+# สถานะกลางอยู่ใน runtime.db (stream_leases / stream_buckets) ทุก worker เห็นตรงกัน แตะ DB ตอนเริ่มการดูใหม่ใน process นี้
+# และ (ถ้าตั้ง STREAM_MAX_CONCURRENT) ตอน request สุดท้ายของการดูจบ ให้ worker อื่นรู้ว่าช่องว่างแล้ว
+# ต่ออายุทุก STREAM_LEASE_TTL / 3 ระหว่างส่ง และขอ token ครั้งละ STREAM_TOKEN_GRANT_BYTES
+# การดูที่ไม่มี request ค้างเกิน STREAM_LEASE_IDLE_GRACE วินาทีถือว่าจบแล้ว (เปิดตอนถัดไปต่อได้ ไม่ต้องรอ TTL)
+# ผู้ใช้ที่เริ่มการดูใหม่รับช่วงการดูที่ว่างอยู่ของตัวเองใน process นี้ได้ทันที
+# ถ้า runtime.db ใช้ไม่ได้ จะปล่อยให้สตรีมต่อ (ไม่ให้ตัวจำกัดทำให้ดูวิดีโอไม่ได้ทั้งระบบ)
+
+class StreamLimitExceeded(RuntimeError):
+    """ผู้ใช้เปิดสตรีมพร้อมกันเกิน หรือใช้แบนด์วิดท์เกินโควตา (ตอบ 429)"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+_stream_limit_lock = threading.Lock()
+_playbacks = {}  # (RUNTIME_DB_PATH, user_id, episode_id) -> StreamLease ของการดูนั้นใน process นี้
+_stream_blocked = {}  # (RUNTIME_DB_PATH, user_id) -> time.time() ที่จะกลับมาสตรีมได้ (หลังโดนจำกัดแบนด์วิดท์)
+
+
+# ค่าตั้งที่ StreamLease จำไว้ใช้นอก app context
+_STREAM_LEASE_SETTINGS = (
+    "RUNTIME_DB_PATH", "STREAM_LEASE_TTL", "STREAM_LEASE_IDLE_GRACE", "STREAM_TOKEN_GRANT_BYTES",
+    "STREAM_MAX_CONCURRENT", "STREAM_USER_RATE_BYTES", "STREAM_USER_BURST_BYTES",
+)
+
+
+def stream_limits_enabled() -> bool:
+    return settings.STREAM_MAX_CONCURRENT > 0 or settings.STREAM_USER_RATE_BYTES > 0
+
+
+def _stream_burst(config=None) -> float:
+    config = config or settings
+    return float(config.STREAM_USER_BURST_BYTES or config.STREAM_USER_RATE_BYTES * 10)
+
+
+def _refill_stream_tokens(row, now: float, config=None) -> float:
+    config = config or settings
+    if row is None:
+        return _stream_burst(config)
+    return min(_stream_burst(config), row["tokens"] + (now - row["updated"]) * config.STREAM_USER_RATE_BYTES)
+
+
+def _take_stream_tokens(conn: sqlite3.Connection, user_id: int, amount: float, now: float,
+                        config=None) -> float:
+    """หัก token จาก bucket กลางของผู้ใช้ (ติดลบได้ = ต้องรอ) คืนยอดคงเหลือ ต้องอยู่ใน transaction"""
+    row = conn.execute(
+        "SELECT tokens, updated FROM stream_buckets WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    tokens = _refill_stream_tokens(row, now, config) - amount
+    conn.execute(
+        """
+        INSERT INTO stream_buckets (user_id, tokens, updated) VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated
+        """,
+        (user_id, tokens, now),
+    )
+    return tokens
+
+
+class StreamLease:
+    """สิทธิ์การดูหนึ่งครั้งของผู้ใช้ (แถวใน stream_leases ของ process นี้) ใช้ร่วมกันทุก Range request ของตอนนั้น
+
+    ถือ token ที่ขอจาก bucket กลางไว้ ขอครั้งละ STREAM_TOKEN_GRANT_BYTES และต่ออายุ lease ไปในคราวเดียวกัน
+    การดูหนึ่งครั้งจึงแตะ runtime.db แค่ทุก ๆ ไม่กี่ MB (หรือทุก STREAM_LEASE_TTL / 3 วินาที) ไม่ใช่ทุกก้อน
+    consume() ถูกเรียกระหว่างส่ง body ซึ่งอยู่นอก app context จึงจำค่าตั้งของแอปที่สร้าง lease ไว้ใน ``config``
+    """
+
+    def __init__(self, user_id: int, episode_id: int, now: float, config=None):
+        self.config = config or SimpleNamespace(
+            **{key: getattr(settings, key) for key in _STREAM_LEASE_SETTINGS}
+        )
+        self.user_id = user_id
+        self.episode_id = episode_id
+        self.lease_id = None
+        self.granted = 0
+        self.heartbeat = now
+        self.last_used = now
+        self.active = 1  # request ที่กำลังใช้ lease นี้อยู่
+        self.ready = threading.Event()
+        self.error = None  # StreamLimitExceeded ถ้าการจองใน runtime.db ไม่ผ่าน
+        self._lock = threading.Lock()
+
+    def idle_expired(self, now: float) -> bool:
+        return self.active <= 0 and now - self.last_used >= self.config.STREAM_LEASE_IDLE_GRACE
+
+    def consume(self, amount: int) -> float:
+        """ใช้ ``amount`` ไบต์ คืนจำนวนวินาทีที่ต้องรอก่อนส่ง (0 = ส่งได้เลย)"""
+        config = self.config
+        now = time.time()
+        wait = 0.0
+        with self._lock:
+            self.last_used = now
+            need_grant = config.STREAM_USER_RATE_BYTES > 0 and amount > self.granted
+            if need_grant or now - self.heartbeat >= config.STREAM_LEASE_TTL / 3:
+                try:
+                    conn = get_runtime_db(config.RUNTIME_DB_PATH)
+                    try:
+                        conn.execute("BEGIN IMMEDIATE")
+                        if need_grant:
+                            grant = max(amount - self.granted, config.STREAM_TOKEN_GRANT_BYTES)
+                            tokens = _take_stream_tokens(conn, self.user_id, grant, now, config)
+                            self.granted += grant
+                            # รอเฉพาะส่วนที่จะส่งตอนนี้ ส่วนที่ขอเผื่อไว้ค่อยไปรอตอนขอครั้งถัดไป
+                            # (ถ้าไม่ได้ใช้ คืน bucket ตอนการดูนี้หมดอายุ)
+                            deficit = -(tokens + self.granted - amount)
+                            if deficit > 0:
+                                wait = deficit / config.STREAM_USER_RATE_BYTES
+                        if self.lease_id is not None:
+                            conn.execute(
+                                "UPDATE stream_leases SET heartbeat = ? WHERE id = ?",
+                                (now + wait, self.lease_id),
+                            )
+                        conn.commit()
+                    finally:
+                        conn.close()
+                except sqlite3.Error as e:
+                    app.logger.warning("stream limiter unavailable: %s", e)
+                    self.granted = max(self.granted, amount)
+                self.heartbeat = now + wait
+            if config.STREAM_USER_RATE_BYTES > 0:
+                self.granted -= amount
+        return wait
+
+
+def acquire_stream(user_id: int | None, episode_id: int) -> StreamLease | None:
+    """จองสิทธิ์การดูตอนนี้ให้ผู้ใช้ (request ถัดไปของการดูเดียวกันใช้ lease เดิมโดยไม่แตะ DB)
+
+    raise StreamLimitExceeded ถ้าเปิดดูตอนอื่นพร้อมกันเกินจำนวน หรือแบนด์วิดท์ค้างเกิน STREAM_RATE_MAX_WAIT วินาที
+    คืน None ถ้าไม่ได้เปิดตัวจำกัด ต้องเรียก release_stream() เมื่อ request จบ
+    """
+    if not user_id or not stream_limits_enabled():
+        return None
+
+    now = time.time()
+    runtime_db_path = settings.RUNTIME_DB_PATH
+    key = (runtime_db_path, user_id, episode_id)
+    with _stream_limit_lock:
+        blocked_until = _stream_blocked.get((runtime_db_path, user_id), 0)
+        if blocked_until > now:
+            raise StreamLimitExceeded("ใช้แบนด์วิดท์เกินโควตา กรุณารอสักครู่", blocked_until - now)
+        lease = _playbacks.get(key)
+        shared = lease is not None and not lease.idle_expired(now)
+        if shared:
+            lease.active += 1
+            lease.last_used = now
+        else:
+            # การดูตอนอื่นของผู้ใช้คนนี้ที่ไม่มี request ค้างอยู่ (เช่นดูจบแล้วกดตอนถัดไป) ถูกรับช่วงไปเลย
+            expired = [
+                k for k, other in _playbacks.items()
+                if other.idle_expired(now) or (k[:2] == key[:2] and other.active <= 0)
+            ]
+            expired = [_playbacks.pop(k) for k in expired]
+            playing = [other for k, other in _playbacks.items() if k[:2] == key[:2]]
+            if settings.STREAM_MAX_CONCURRENT and len(playing) >= settings.STREAM_MAX_CONCURRENT:
+                oldest = min(other.heartbeat for other in playing)
+                raise StreamLimitExceeded(
+                    "เปิดวิดีโอพร้อมกันเกินจำนวนที่กำหนด", oldest + settings.STREAM_LEASE_TTL - now
+                )
+            lease = _playbacks[key] = StreamLease(user_id, episode_id, now)
+
+    if shared:
+        # request แรกของการดูนี้อาจกำลังจองใน runtime.db อยู่ รอผลเดียวกัน
+        lease.ready.wait()
+        if lease.error is not None:
+            release_stream(lease)
+            raise lease.error
+        return lease
+
+    try:
+        conn = get_runtime_db()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # lease ที่ไม่ได้ต่ออายุ (worker ตาย / ผู้ชมหยุดดู) ถือว่าจบแล้ว
+            conn.execute("DELETE FROM stream_leases WHERE heartbeat < ?", (now - settings.STREAM_LEASE_TTL,))
+            for old in expired:
+                if old.lease_id is not None:
+                    conn.execute("DELETE FROM stream_leases WHERE id = ?", (old.lease_id,))
+                if old.granted > 0:
+                    # คืน token ที่ขอเผื่อไว้แต่ไม่ได้ใช้
+                    conn.execute(
+                        "UPDATE stream_buckets SET tokens = MIN(?, tokens + ?) WHERE user_id = ?",
+                        (_stream_burst(), old.granted, old.user_id),
+                    )
+            if settings.STREAM_MAX_CONCURRENT:
+                # ตอนเดียวกันที่เปิดอยู่ใน worker อื่นคือการดูเดียวกัน ไม่นับเพิ่ม
+                playing, oldest = conn.execute(
+                    """
+                    SELECT COUNT(DISTINCT episode_id), MIN(heartbeat) FROM stream_leases
+                    WHERE user_id = ? AND episode_id != ?
+                    """,
+                    (user_id, episode_id),
+                ).fetchone()
+                if playing >= settings.STREAM_MAX_CONCURRENT:
+                    conn.rollback()
+                    # ลองใหม่เมื่อการดูที่เก่าที่สุดหมดอายุ (การดูที่ว่างอยู่หมดอายุภายใน STREAM_LEASE_IDLE_GRACE)
+                    raise StreamLimitExceeded(
+                        "เปิดวิดีโอพร้อมกันเกินจำนวนที่กำหนด", oldest + settings.STREAM_LEASE_TTL - now
+                    )
+            if settings.STREAM_USER_RATE_BYTES:
+                tokens = _take_stream_tokens(conn, user_id, 0, now)
+                wait = -tokens / settings.STREAM_USER_RATE_BYTES
+                if wait > settings.STREAM_RATE_MAX_WAIT:
+                    conn.rollback()
+                    retry_after = wait - settings.STREAM_RATE_MAX_WAIT
+                    with _stream_limit_lock:
+                        _stream_blocked[key[:2]] = now + retry_after
+                    raise StreamLimitExceeded("ใช้แบนด์วิดท์เกินโควตา กรุณารอสักครู่", retry_after)
+            cur = conn.execute(
+                """
+                INSERT INTO stream_leases (user_id, episode_id, pid, started_at, heartbeat)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (user_id, episode_id, os.getpid(), now, now),
+            )
+            conn.commit()
+            lease.lease_id = cur.lastrowid
+        finally:
+            conn.close()
+    except StreamLimitExceeded as e:
+        lease.error = e
+        with _stream_limit_lock:
+            if _playbacks.get(key) is lease:
+                del _playbacks[key]
+        lease.ready.set()
+        raise
+    except sqlite3.Error as e:
+        app.logger.warning("stream limiter unavailable: %s", e)
+    lease.ready.set()
+    return lease
+
+
+def release_stream(lease: StreamLease | None):
+    """request นี้เลิกใช้ lease แล้ว การดูยังถือสิทธิ์ต่ออีก STREAM_LEASE_IDLE_GRACE วินาที
+
+    ถ้าจำกัดจำนวนการดูไว้ request สุดท้ายที่จบเลื่อน heartbeat ใน runtime.db ให้หมดอายุหลังช่วงนั้น
+    worker อื่นจึงเห็นว่าการดูนี้จบแล้วโดยไม่ต้องรอ STREAM_LEASE_TTL
+    """
+    if lease is None:
+        return
+    now = time.time()
+    with _stream_limit_lock:
+        lease.active -= 1
+        lease.last_used = now
+        idle = lease.active <= 0
+    config = lease.config
+    if not idle or not config.STREAM_MAX_CONCURRENT or lease.lease_id is None:
+        return
+    with lease._lock:
+        if lease.active > 0:
+            # มี request ใหม่ของการดูเดียวกันเข้ามาแล้ว
+            return
+        heartbeat = now - config.STREAM_LEASE_TTL + config.STREAM_LEASE_IDLE_GRACE
+        try:
+            conn = get_runtime_db(config.RUNTIME_DB_PATH)
+            try:
+                conn.execute(
+                    "UPDATE stream_leases SET heartbeat = MIN(heartbeat, ?) WHERE id = ?",
+                    (heartbeat, lease.lease_id),
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            app.logger.warning("stream limiter unavailable: %s", e)
+            return
+        # request ถัดไปของการดูนี้ (ถ้ามี) ต่ออายุใน DB ตั้งแต่ก้อนแรก
+        lease.heartbeat = min(lease.heartbeat, heartbeat)
+
+
+def stream_limit_response(exc: StreamLimitExceeded) -> Response:
+    return Response(
+        str(exc),
+        status=429,
+        headers={"Retry-After": str(exc.retry_after)},
+        mimetype="text/plain",
+    )
+
+
+def stream_limit_state(user_id: int) -> dict:
+    """สถานะตัวจำกัดของผู้ใช้ (สำหรับหน้าแอดมิน)"""
+    now = time.time()
+    state = {
+        "enabled": stream_limits_enabled(),
+        "max_concurrent": settings.STREAM_MAX_CONCURRENT,
+        "rate_bytes": settings.STREAM_USER_RATE_BYTES,
+        "burst_bytes": _stream_burst() if settings.STREAM_USER_RATE_BYTES else 0,
+        "leases": [],
+        "playbacks": 0,
+        "tokens": None,
+        "wait_seconds": 0.0,
+    }
+    try:
+        conn = get_runtime_db()
+        try:
+            state["leases"] = conn.execute(
+                """
+                SELECT l.*, ? - l.started_at AS age FROM stream_leases l
+                WHERE l.user_id = ? AND l.heartbeat >= ?
+                ORDER BY l.started_at
+                """,
+                (now, user_id, now - settings.STREAM_LEASE_TTL),
+            ).fetchall()
+            # ตอนเดียวกันหลาย worker = การดูเดียวกัน
+            state["playbacks"] = len({lease["episode_id"] for lease in state["leases"]})
+            if settings.STREAM_USER_RATE_BYTES:
+                row = conn.execute(
+                    "SELECT tokens, updated FROM stream_buckets WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                state["tokens"] = _refill_stream_tokens(row, now)
+                state["wait_seconds"] = max(0.0, -state["tokens"] / settings.STREAM_USER_RATE_BYTES)
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+    return state
+
+
+def reset_stream_limits(user_id: int):
+    """ล้าง lease และ bucket ของผู้ใช้ (เช่น หลัง worker ตายแล้ว lease ค้าง)"""
+    runtime_db_path = settings.RUNTIME_DB_PATH
+    with _stream_limit_lock:
+        _stream_blocked.pop((runtime_db_path, user_id), None)
+        for key in [key for key in _playbacks if key[:2] == (runtime_db_path, user_id)]:
+            del _playbacks[key]
+    conn = get_runtime_db()
+    try:
+        conn.execute("DELETE FROM stream_leases WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM stream_buckets WHERE user_id = ?", (user_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ---------- บีบอัด response ที่เป็นข้อความ (gzip / brotli) ----------
+# HTML ภาษาไทยเป็น UTF-8 ตัวละ 3 ไบต์ และ JSON สำรองข้อมูลซ้ำชื่อคีย์ทุกแถว จึงบีบได้หลายเท่า
+# - เลือก br (ถ้าติดตั้งโมดูล brotli) หรือ gzip ตาม Accept-Encoding ของ client
+# - เฉพาะ text/* และ JSON/JS/XML ไม่แตะวิดีโอ/รูปภาพ (บีบมาแล้วในตัว) และ response แบบ Range (206)
+# - body ที่รู้ขนาดบีบทีเดียวทั้งก้อน และจำผลไว้ตาม hash ของเนื้อหา หน้าเดิมจาก catalog snapshot
+#   (หน้าแรก, /api/v1 ฯลฯ) จึงไม่ต้องบีบซ้ำทุก request
+# - body แบบ generator หรือใหญ่เกิน COMPRESS_BUFFER_MAX บีบทีละก้อนระหว่างส่ง ไม่ต้องรอทั้ง response
+# - ครอบด้านในของ MetricsMiddleware ไบต์ใน metrics จึงเป็นไบต์หลังบีบที่ส่งออกไปจริง
+
+_COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml")
+
+_compress_cache = OrderedDict()  # (encoding, ระดับการบีบ, digest ของ body) -> body ที่บีบแล้ว
+_compress_cache_size = 0
+_compress_cache_lock = threading.Lock()
+
+
+def negotiate_encoding(accept_encoding) -> str | None:
+    """เลือก content-coding จาก Accept-Encoding (q สูงสุด, เท่ากันเลือก br ก่อน gzip) None = ส่งแบบไม่บีบ"""
+    if not accept_encoding:
+        return None
+    accepted = parse_accept_header(accept_encoding)
+    best, best_q = None, 0
+    for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+        q = accepted.quality(encoding)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress_level(encoding: str, config=None) -> int:
+    """ระดับการบีบของ ``encoding`` ตามค่าตั้งของแอป (COMPRESS_BROTLI_QUALITY / COMPRESS_GZIP_LEVEL)"""
+    config = config or current_app.config
+    return config["COMPRESS_BROTLI_QUALITY"] if encoding == "br" else config["COMPRESS_GZIP_LEVEL"]
+
+
+def _compressor(encoding: str, level: int):
+    """คืน (compress(chunk), finish()) ของตัวบีบแบบ stream"""
+    if encoding == "br":
+        obj = brotli.Compressor(quality=level)
+        return obj.process, obj.finish
+    # wbits 31 = deflate ห่อด้วย header/trailer ของ gzip
+    obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return obj.compress, obj.flush
+
+
+def compress_body(body: bytes, encoding: str, level: int, cache_bytes: int = 0) -> bytes:
+    """บีบ body ทั้งก้อน ถ้าเคยบีบเนื้อหาเดียวกันไว้ในแคช (ขนาดรวมไม่เกิน ``cache_bytes``) ก็ใช้ผลเดิม"""
+    global _compress_cache_size
+
+    key = None
+    if cache_bytes > 0:
+        key = (encoding, level, hashlib.sha256(body).digest())
+        with _compress_cache_lock:
+            cached = _compress_cache.get(key)
+            if cached is not None:
+                _compress_cache.move_to_end(key)
+                return cached
+
+    compress, finish = _compressor(encoding, level)
+    data = compress(body) + finish()
+
+    # ก้อนใหญ่ไม่เก็บ กันไม่ให้ไล่หน้าเล็ก ๆ ที่ถูกเรียกบ่อยออกจากแคชทั้งหมด
+    if key is not None and len(data) <= cache_bytes // 8:
+        with _compress_cache_lock:
+            if key not in _compress_cache:
+                _compress_cache[key] = data
+                _compress_cache_size += len(data)
+                while _compress_cache_size > cache_bytes:
+                    _, old = _compress_cache.popitem(last=False)
+                    _compress_cache_size -= len(old)
+    return data
+
+
+def reset_compress_cache():
+    global _compress_cache_size
+
+    with _compress_cache_lock:
+        _compress_cache.clear()
+        _compress_cache_size = 0
+
+
+def _should_compress(status: str, headers: Headers) -> bool:
+    code = int(status.split(" ", 1)[0])
+    if code < 200 or code in (204, 206, 304):
+        return False
+    if "Content-Encoding" in headers or "Content-Range" in headers:
+        return False
+    # proxy ด้านหน้าจะส่งไฟล์แทน body (STREAM_OFFLOAD)
+    if "X-Accel-Redirect" in headers or "X-Sendfile" in headers:
+        return False
+    if "no-transform" in headers.get("Cache-Control", "").lower():
+        return False
+    mimetype = headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+    return mimetype.startswith(_COMPRESSIBLE_TYPES)
+
+
+class _CompressedBody:
+    """บีบ body แบบ generator ทีละก้อนระหว่างส่ง และปิด body เดิมเมื่อ server ปิด response"""
+
+    def __init__(self, body, encoding, level):
+        self.body = body
+        self.encoding = encoding
+        self.level = level
+
+    def __iter__(self):
+        compress, finish = _compressor(self.encoding, self.level)
+        for chunk in self.body:
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+
+    def close(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
+
+
+class CompressionMiddleware:
+    """WSGI middleware: บีบ body ของ response ที่เป็นข้อความตาม Accept-Encoding
+
+    ทำงานนอก app context จึงอ่านค่าตั้งจาก ``flask_app.config`` ของแอปที่ครอบอยู่
+    """
+
+    def __init__(self, wsgi_app, flask_app):
+        self.wsgi_app = wsgi_app
+        self.config = flask_app.config
+
+    def __call__(self, environ, start_response):
+        config = self.config
+        # HEAD ต้องได้ header ชุดเดียวกับ GET แต่ไม่มี body ให้บีบ ส่งตามเดิม
+        if not config["COMPRESS_ENABLED"] or environ.get("REQUEST_METHOD") == "HEAD":
+            return self.wsgi_app(environ, start_response)
+
+        captured = []
+
+        def deferred_start_response(status, headers, exc_info=None):
+            # ยังไม่ส่ง header จนกว่าจะรู้ว่าจะบีบหรือไม่ (Flask ไม่ใช้ write() ที่ได้จาก start_response)
+            captured[:] = [status, headers, exc_info]
+            return None
+
+        body = self.wsgi_app(environ, deferred_start_response)
+        status, header_list, exc_info = captured
+        headers = Headers(header_list)
+        if not _should_compress(status, headers):
+            start_response(status, header_list, exc_info)
+            return body
+
+        # cache ระหว่างทางต้องแยกเก็บตาม Accept-Encoding แม้ response นี้จะไม่ได้บีบ
+        vary = headers.get("Vary", "")
+        if "accept-encoding" not in vary.lower():
+            headers["Vary"] = f"{vary}, Accept-Encoding" if vary else "Accept-Encoding"
+
+        encoding = negotiate_encoding(environ.get("HTTP_ACCEPT_ENCODING"))
+        length = headers.get("Content-Length", type=int)
+        if encoding is None or (length is not None and length < config["COMPRESS_MIN_SIZE"]):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return body
+
+        etag, weak = unquote_etag(headers.get("ETag"))
+        if etag is not None and not weak:
+            # เนื้อหาที่บีบแล้วไม่ใช่ไบต์เดียวกับต้นฉบับ ETag แบบ strong จึงต้องลดเป็น weak
+            headers["ETag"] = quote_etag(etag, weak=True)
+
+        level = compress_level(encoding, config)
+        if length is not None and length <= config["COMPRESS_BUFFER_MAX"]:
+            try:
+                data = b"".join(body)
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+            compressed = compress_body(data, encoding, level, config["COMPRESS_CACHE_BYTES"])
+            if len(compressed) >= len(data):
+                # บีบแล้วไม่เล็กลง ส่งต้นฉบับ (ETag แบบ weak ยังใช้ได้)
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                return [data]
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return [compressed]
+
+        headers["Content-Encoding"] = encoding
+        headers.remove("Content-Length")
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return _CompressedBody(body, encoding, level)
+
+
+# ---------- Metrics ต่อ route (รวมทุก worker ผ่าน runtime.db) ----------
+# แต่ละ process สะสมตัวเลขในหน่วยความจำ แล้วค่อยบวกเพิ่มลง runtime.db ทุก METRICS_FLUSH_INTERVAL วินาที
+# /admin/metrics อ่านผลรวมจาก runtime.db จึงเห็นครบทุก worker ของ gunicorn
+
+# ขอบบนของช่อง histogram เวลาตอบ (วินาที)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+RUNTIME_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics_requests (
+    endpoint TEXT NOT NULL,
+    method TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    duration_sum REAL NOT NULL DEFAULT 0,
+    bytes_sum INTEGER NOT NULL DEFAULT 0,
+    queries_sum INTEGER NOT NULL DEFAULT 0,
+    query_time_sum REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (endpoint, method, status)
+);
+CREATE TABLE IF NOT EXISTS metrics_latency (
+    endpoint TEXT NOT NULL,
+    le TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (endpoint, le)
+);
+CREATE TABLE IF NOT EXISTS metrics_inflight (
+    pid INTEGER NOT NULL,
+    endpoint TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (pid, endpoint)
+);
+CREATE TABLE IF NOT EXISTS profiler_settings (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    enabled INTEGER NOT NULL DEFAULT 0,
+    mode TEXT NOT NULL DEFAULT 'sampling',
+    endpoints TEXT NOT NULL DEFAULT '',
+    sample_rate REAL NOT NULL DEFAULT 0.1
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    duration_ms REAL NOT NULL,
+    file TEXT NOT NULL,
+    top_functions TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stream_leases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    episode_id INTEGER NOT NULL,
+    pid INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    heartbeat REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_stream_leases_user ON stream_leases (user_id);
+CREATE TABLE IF NOT EXISTS stream_buckets (
+    user_id INTEGER PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS slow_queries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    logged_at TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    duration_ms REAL NOT NULL,
+    queries INTEGER,
+    sql TEXT
+);
+"""
+
+_runtime_db_ready = set()  # RUNTIME_DB_PATH ที่สร้างตารางแล้วใน process นี้
+# connection ที่เปิดค้างไว้หนึ่งตัวต่อ process ((pid, path) -> connection) ไม่ได้ใช้งาน แค่กันไม่ให้ close() ของ
+# connection อื่นเป็นตัวสุดท้าย ซึ่งจะทำ checkpoint + ลบไฟล์ WAL ทุกครั้ง (ช้ากว่าคำสั่งที่ทำจริงหลายเท่า)
+# ของ process แม่ที่ติดมาหลัง fork ห้ามปิดในลูก จึงเก็บแยกตาม pid
+_runtime_db_keepers = {}
+_metrics_lock = threading.Lock()
+# คีย์ขึ้นต้นด้วย RUNTIME_DB_PATH ของแอปที่รับ request (แต่ละแอปจาก create_app() เขียนลง runtime.db ของตัวเอง)
+_metrics_requests = {}  # (RUNTIME_DB_PATH, endpoint, method, status) -> [count, duration, bytes, queries, query_time]
+_metrics_latency = {}  # (RUNTIME_DB_PATH, endpoint, le) -> count
+_metrics_inflight = {}  # (RUNTIME_DB_PATH, endpoint) -> จำนวน request ที่กำลังทำอยู่ใน process นี้
+_metrics_last_flush = 0.0
+
+
+def get_runtime_db(path: str | None = None) -> sqlite3.Connection:
+    """connection ไปยัง runtime.db (สร้างตารางให้ครั้งแรกของแต่ละ process)
+
+    ``path`` ใช้เมื่อเรียกนอก app context (เช่น ระหว่างส่ง body) ไม่ระบุ = RUNTIME_DB_PATH ของแอปปัจจุบัน
+    """
+    path = path or settings.RUNTIME_DB_PATH
+    conn = sqlite3.connect(path, timeout=5)
+    conn.row_factory = sqlite3.Row
+    # ข้อมูลใน runtime.db ทิ้งได้ ไม่ต้อง fsync ทุก commit (WAL + NORMAL ยังไม่เสียหายแม้ไฟดับ)
+    conn.execute("PRAGMA synchronous = NORMAL")
+    if path not in _runtime_db_ready:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(RUNTIME_SCHEMA)
+        _runtime_db_ready.add(path)
+    if (os.getpid(), path) not in _runtime_db_keepers:
+        keeper = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        keeper.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()  # เปิดไฟล์ + WAL จริง
+        _runtime_db_keepers[(os.getpid(), path)] = keeper
+    return conn
+
+
+def log_slow_query(endpoint: str, sql: str | None, seconds: float, kind: str = "execute",
+                   queries: int | None = None):
+    """บันทึก slow query (หรือ request ที่ใช้ query เกินงบ) ลง ring buffer ใน runtime.db"""
+    try:
+        conn = get_runtime_db()
+        try:
+            cur = conn.execute(
+                """
+                INSERT INTO slow_queries (logged_at, endpoint, kind, duration_ms, queries, sql)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    datetime.utcnow().isoformat(timespec="seconds"), endpoint, kind,
+                    round(seconds * 1000, 2), queries, " ".join((sql or "").split())[:2000],
+                ),
+            )
+            # เก็บแค่ SLOW_QUERY_LOG_SIZE รายการล่าสุด
+            conn.execute(
+                "DELETE FROM slow_queries WHERE id <= ?", (cur.lastrowid - settings.SLOW_QUERY_LOG_SIZE,)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        app.logger.warning("slow query [%s] %.1f ms %s", endpoint, seconds * 1000, sql)
+
+
+def _latency_bucket(seconds: float) -> str:
+    for bound in LATENCY_BUCKETS:
+        if seconds <= bound:
+            return f"{bound:g}"
+    return "+Inf"
+
+
+def metrics_request_started(endpoint: str):
+    key = (settings.RUNTIME_DB_PATH, endpoint)
+    with _metrics_lock:
+        _metrics_inflight[key] = _metrics_inflight.get(key, 0) + 1
+
+
+def metrics_request_finished(endpoint: str, method: str, status: int, duration: float,
+                             sent_bytes: int, queries: int = 0, query_time: float = 0.0):
+    path = settings.RUNTIME_DB_PATH
+    with _metrics_lock:
+        _metrics_inflight[(path, endpoint)] = max(0, _metrics_inflight.get((path, endpoint), 0) - 1)
+        totals = _metrics_requests.setdefault((path, endpoint, method, status), [0, 0.0, 0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] += sent_bytes
+        totals[3] += queries
+        totals[4] += query_time
+        bucket = (path, endpoint, _latency_bucket(duration))
+        _metrics_latency[bucket] = _metrics_latency.get(bucket, 0) + 1
+    metrics_flush()
+
+
+def metrics_flush(force: bool = False):
+    """บวกตัวเลขที่สะสมไว้ลง runtime.db (ถ้าเขียนไม่สำเร็จ เก็บไว้รวมกับรอบถัดไป)"""
+    global _metrics_last_flush
+
+    with _metrics_lock:
+        now = time.monotonic()
+        if not force and now - _metrics_last_flush < settings.METRICS_FLUSH_INTERVAL:
+            return
+        _metrics_last_flush = now
+        pending_requests = dict(_metrics_requests)
+        pending_latency = dict(_metrics_latency)
+        inflight = dict(_metrics_inflight)
+        _metrics_requests.clear()
+        _metrics_latency.clear()
+
+    paths = {key[0] for key in pending_requests} | {key[0] for key in inflight}
+    for path in paths:
+        try:
+            _metrics_write(
+                path,
+                [key[1:] + tuple(values) for key, values in pending_requests.items() if key[0] == path],
+                [key[1:] + (count,) for key, count in pending_latency.items() if key[0] == path],
+                [(os.getpid(), key[1], value) for key, value in inflight.items() if key[0] == path],
+            )
+        except sqlite3.Error:
+            with _metrics_lock:
+                for key, values in pending_requests.items():
+                    if key[0] != path:
+                        continue
+                    totals = _metrics_requests.setdefault(key, [0, 0.0, 0, 0, 0.0])
+                    for i, value in enumerate(values):
+                        totals[i] += value
+                for key, count in pending_latency.items():
+                    if key[0] == path:
+                        _metrics_latency[key] = _metrics_latency.get(key, 0) + count
+
+
+def _metrics_write(path: str, request_rows: list, latency_rows: list, inflight_rows: list):
+    conn = get_runtime_db(path)
+    try:
+        conn.executemany(
+            """
+            INSERT INTO metrics_requests
+                (endpoint, method, status, count, duration_sum, bytes_sum, queries_sum, query_time_sum)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (endpoint, method, status) DO UPDATE SET
+                count = count + excluded.count,
+                duration_sum = duration_sum + excluded.duration_sum,
+                bytes_sum = bytes_sum + excluded.bytes_sum,
+                queries_sum = queries_sum + excluded.queries_sum,
+                query_time_sum = query_time_sum + excluded.query_time_sum
+            """,
+            request_rows,
+        )
+        conn.executemany(
+            """
+            INSERT INTO metrics_latency (endpoint, le, count) VALUES (?, ?, ?)
+            ON CONFLICT (endpoint, le) DO UPDATE SET count = count + excluded.count
+            """,
+            latency_rows,
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO metrics_inflight (pid, endpoint, value) VALUES (?, ?, ?)",
+            inflight_rows,
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def load_metrics() -> dict:
+    """อ่าน metrics รวมทุก worker จาก runtime.db (ล้างแถว in-flight ของ process ที่ตายไปแล้ว)"""
+    metrics_flush(force=True)
+    conn = get_runtime_db()
+    requests_rows = conn.execute(
+        "SELECT * FROM metrics_requests ORDER BY endpoint, method, status"
+    ).fetchall()
+    latency_rows = conn.execute("SELECT * FROM metrics_latency").fetchall()
+    inflight_rows = conn.execute("SELECT * FROM metrics_inflight").fetchall()
+
+    dead = {row["pid"] for row in inflight_rows if not _pid_alive(row["pid"])}
+    if dead:
+        conn.executemany("DELETE FROM metrics_inflight WHERE pid = ?", [(pid,) for pid in dead])
+        conn.commit()
+    conn.close()
+
+    inflight = {}
+    for row in inflight_rows:
+        if row["pid"] not in dead:
+            inflight[row["endpoint"]] = inflight.get(row["endpoint"], 0) + row["value"]
+
+    latency = {}
+    for row in latency_rows:
+        latency.setdefault(row["endpoint"], {})[row["le"]] = row["count"]
+
+    return {
+        "requests": [dict(row) for row in requests_rows],
+        "latency": latency,
+        "inflight": inflight,
+    }
+
+
+def _cumulative_buckets(counts: dict) -> list:
+    """[(le, จำนวนสะสม)] เรียงตามขอบบน ปิดท้ายด้วย +Inf แบบที่ Prometheus ต้องการ"""
+    running = 0
+    result = []
+    for bound in LATENCY_BUCKETS:
+        running += counts.get(f"{bound:g}", 0)
+        result.append((f"{bound:g}", running))
+    result.append(("+Inf", running + counts.get("+Inf", 0)))
+    return result
+
+
+def _prom_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(data: dict) -> str:
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    family("myseries_http_requests_total", "counter", "HTTP requests by endpoint, method and status.")
+    for row in data["requests"]:
+        lines.append(
+            f'myseries_http_requests_total{{endpoint="{_prom_label(row["endpoint"])}",'
+            f'method="{row["method"]}",status="{row["status"]}"}} {row["count"]}'
+        )
+
+    per_endpoint = {}
+    for row in data["requests"]:
+        totals = per_endpoint.setdefault(row["endpoint"], [0, 0.0, 0, 0, 0.0])
+        for i, key in enumerate(("count", "duration_sum", "bytes_sum", "queries_sum", "query_time_sum")):
+            totals[i] += row[key]
+
+    family("myseries_http_request_duration_seconds", "histogram",
+           "Time from request start until the response body was fully sent.")
+    for endpoint, totals in per_endpoint.items():
+        label = _prom_label(endpoint)
+        for le, count in _cumulative_buckets(data["latency"].get(endpoint, {})):
+            lines.append(f'myseries_http_request_duration_seconds_bucket{{endpoint="{label}",le="{le}"}} {count}')
+        lines.append(f'myseries_http_request_duration_seconds_sum{{endpoint="{label}"}} {totals[1]:.6f}')
+        lines.append(f'myseries_http_request_duration_seconds_count{{endpoint="{label}"}} {totals[0]}')
+
+    family("myseries_http_response_bytes_total", "counter", "Response body bytes sent.")
+    for endpoint, totals in per_endpoint.items():
+        lines.append(f'myseries_http_response_bytes_total{{endpoint="{_prom_label(endpoint)}"}} {totals[2]}')
+
+    family("myseries_sqlite_queries_total", "counter", "SQLite statements executed while handling requests.")
+    for endpoint, totals in per_endpoint.items():
+        lines.append(f'myseries_sqlite_queries_total{{endpoint="{_prom_label(endpoint)}"}} {totals[3]}')
+
+    family("myseries_sqlite_query_seconds_total", "counter", "Time spent in SQLite while handling requests.")
+    for endpoint, totals in per_endpoint.items():
+        lines.append(f'myseries_sqlite_query_seconds_total{{endpoint="{_prom_label(endpoint)}"}} {totals[4]:.6f}')
+
+    family("myseries_http_requests_in_flight", "gauge", "Requests currently being handled, all workers.")
+    for endpoint, value in sorted(data["inflight"].items()):
+        lines.append(f'myseries_http_requests_in_flight{{endpoint="{_prom_label(endpoint)}"}} {value}')
+
+    return "\n".join(lines) + "\n"
+
+
+def _histogram_quantile(counts: dict, q: float):
+    cumulative = _cumulative_buckets(counts)
+    total = cumulative[-1][1]
+    if not total:
+        return None
+    for le, count in cumulative:
+        if count >= q * total:
+            return None if le == "+Inf" else float(le)
+    return None
+
+
+def metrics_summary(data: dict) -> list:
+    """สรุปต่อ endpoint สำหรับหน้าแอดมิน เรียงตามเวลารวมที่ใช้มากสุดก่อน"""
+    summary = {}
+    for row in data["requests"]:
+        item = summary.setdefault(row["endpoint"], {
+            "endpoint": row["endpoint"], "requests": 0, "errors": 0, "total_seconds": 0.0,
+            "bytes": 0, "queries": 0, "query_seconds": 0.0, "statuses": {},
+        })
+        item["requests"] += row["count"]
+        if row["status"] >= 500:
+            item["errors"] += row["count"]
+        item["total_seconds"] += row["duration_sum"]
+        item["bytes"] += row["bytes_sum"]
+        item["queries"] += row["queries_sum"]
+        item["query_seconds"] += row["query_time_sum"]
+        item["statuses"][str(row["status"])] = item["statuses"].get(str(row["status"]), 0) + row["count"]
+
+    for endpoint, item in summary.items():
+        n = item["requests"] or 1
+        counts = data["latency"].get(endpoint, {})
+        p50, p95 = _histogram_quantile(counts, 0.5), _histogram_quantile(counts, 0.95)
+        item.update(
+            avg_ms=round(item["total_seconds"] / n * 1000, 2),
+            p50_ms_le=None if p50 is None else p50 * 1000,
+            p95_ms_le=None if p95 is None else p95 * 1000,
+            queries_per_request=round(item["queries"] / n, 2),
+            query_ms_per_request=round(item["query_seconds"] / n * 1000, 2),
+            in_flight=data["inflight"].get(endpoint, 0),
+        )
+    return sorted(summary.values(), key=lambda item: item["total_seconds"], reverse=True)
+
+
+class _MeteredBody:
+    """ห่อ body ของ response เพื่อนับไบต์ที่ส่งจริง และบันทึก metrics ตอน server ปิด response"""
+
+    def __init__(self, flask_app, body, environ, status_holder, started):
+        self.flask_app = flask_app
+        self.body = body
+        self.environ = environ
+        self.status_holder = status_holder
+        self.started = started
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            with self.flask_app.app_context():
+                _finish_request_metrics(self.environ, self.status_holder, self.started, self.sent)
+
+
+def _finish_request_metrics(environ, status_holder, started, sent_bytes):
+    endpoint = environ.get("myseries.endpoint")
+    if endpoint is None:
+        # request ที่ไม่ผ่าน before_request (เช่น error ก่อน dispatch)
+        endpoint = "unmatched"
+        metrics_request_started(endpoint)
+    status = int(status_holder[0].split(" ", 1)[0]) if status_holder else 500
+    queries, query_time = environ.get("myseries.sql") or (0, 0.0)
+    metrics_request_finished(
+        endpoint, environ.get("REQUEST_METHOD", "GET"), status,
+        time.perf_counter() - started, sent_bytes, queries, query_time,
+    )
+
+
+class MetricsMiddleware:
+    """WSGI middleware: จับเวลาจนส่ง body ครบ (รวมไฟล์วิดีโอที่สตรีม) ไม่ใช่แค่ตอน view คืนค่า"""
+
+    def __init__(self, wsgi_app, flask_app):
+        self.wsgi_app = wsgi_app
+        self.flask_app = flask_app
+
+    def __call__(self, environ, start_response):
+        if not self.flask_app.config["METRICS_ENABLED"]:
+            return self.wsgi_app(environ, start_response)
+
+        started = time.perf_counter()
+        status_holder = []
+
+        def metered_start_response(status, headers, exc_info=None):
+            status_holder[:] = [status]
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, metered_start_response)
+        except BaseException:
+            with self.flask_app.app_context():
+                _finish_request_metrics(environ, status_holder, started, 0)
+            raise
+        return _MeteredBody(self.flask_app, body, environ, status_holder, started)
+
+
+def _install_middleware(flask_app: Flask):
+    """ครอบ wsgi_app ของแอปด้วย middleware ทั้งหมด (บีบอัดอยู่ด้านใน metrics จึงนับไบต์หลังบีบ)"""
+    flask_app.wsgi_app = CompressionMiddleware(flask_app.wsgi_app, flask_app)
+    flask_app.wsgi_app = MetricsMiddleware(flask_app.wsgi_app, flask_app)
+
+
+_install_middleware(app)
+
+
+@app.before_request
+def metrics_before_request():
+    if settings.METRICS_ENABLED:
+        endpoint = request.endpoint or "unmatched"
+        request.environ["myseries.endpoint"] = endpoint
+        metrics_request_started(endpoint)
+
+
+@app.teardown_request
+def metrics_teardown_request(exc):
+    # g หายไปก่อนส่ง body จึงฝากจำนวน/เวลา SQL ไว้ใน environ ให้ middleware อ่านตอนจบ
+    stats = g.get("sql_stats")
+    if stats:
+        request.environ["myseries.sql"] = tuple(stats)
+
+
+def _flush_metrics_at_exit():
+    try:
+        metrics_flush(force=True)
+    except Exception:
+        pass
+
+
+atexit.register(_flush_metrics_at_exit)
+
+
+# ---------- Profiler ของ request จริง (เปิด/ปิดจากหน้าแอดมิน) ----------
+# ค่าตั้งอยู่ใน runtime.db ให้ทุก worker เห็นตรงกัน แต่ละ worker จำค่าไว้และอ่านใหม่ทุก
+# PROFILER_REFRESH_INTERVAL วินาที ตอนปิดอยู่ request ปกติจึงแค่เทียบเวลาครั้งเดียว ไม่แตะ DB
+
+_profiler_settings = {}  # RUNTIME_DB_PATH -> (เวลาที่อ่าน, None = ปิด ไม่งั้นเป็น dict ค่าตั้ง)
+
+
+def load_profiler_settings() -> dict:
+    conn = get_runtime_db()
+    row = conn.execute("SELECT * FROM profiler_settings WHERE id = 1").fetchone()
+    conn.close()
+    if row is None:
+        return {"enabled": False, "mode": "sampling", "endpoints": "", "sample_rate": 0.1}
+    return {
+        "enabled": bool(row["enabled"]),
+        "mode": row["mode"],
+        "endpoints": row["endpoints"],
+        "sample_rate": row["sample_rate"],
+    }
+
+
+def active_profiler_settings():
+    """ค่าตั้งของ profiler ถ้าเปิดอยู่ (None = ปิด) อ่านจาก runtime.db ไม่บ่อยกว่า PROFILER_REFRESH_INTERVAL"""
+    path = settings.RUNTIME_DB_PATH
+    now = time.monotonic()
+    checked, profiler = _profiler_settings.get(path, (None, None))
+    if checked is not None and now - checked < settings.PROFILER_REFRESH_INTERVAL:
+        return profiler
+    _profiler_settings[path] = (now, profiler)
+    try:
+        profiler = load_profiler_settings()
+    except sqlite3.Error:
+        return profiler
+    if profiler["enabled"]:
+        profiler["endpoint_set"] = {e.strip() for e in profiler["endpoints"].split(",") if e.strip()}
+    else:
+        profiler = None
+    _profiler_settings[path] = (now, profiler)
+    return profiler
+
+
+class StackSampler(threading.Thread):
+    """เก็บ stack ของ thread เป้าหมายทุก ๆ interval วินาที นับเป็น collapsed stack (ใช้ทำ flame graph)"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                key = ";".join(reversed(names))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _save_profile(endpoint: str, path: str, mode: str, duration: float, collector):
+    """เขียนไฟล์ profile + สรุปฟังก์ชันที่ใช้เวลามากสุดลง runtime.db แล้วลบไฟล์เก่าที่เกิน PROFILE_KEEP"""
+    import pstats
+
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+    if mode == "cprofile":
+        filename = f"{stamp}-{endpoint}-{os.getpid()}.pstats"
+        collector.dump_stats(os.path.join(settings.PROFILE_DIR, filename))
+        stats = pstats.Stats(collector).sort_stats("tottime")
+        top = []
+        for func in stats.fcn_list[:15]:
+            calls, _, tottime, cumtime, _ = stats.stats[func]
+            top.append({
+                "function": pstats.func_std_string(func),
+                "calls": calls,
+                "self_ms": round(tottime * 1000, 2),
+                "total_ms": round(cumtime * 1000, 2),
+            })
+    else:
+        filename = f"{stamp}-{endpoint}-{os.getpid()}.collapsed"
+        with open(os.path.join(settings.PROFILE_DIR, filename), "w", encoding="utf-8") as f:
+            for stack, count in sorted(collector.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        total = sum(collector.stacks.values()) or 1
+        self_samples = {}
+        for stack, count in collector.stacks.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            self_samples[leaf] = self_samples.get(leaf, 0) + count
+        top = [
+            {"function": name, "samples": count, "self_pct": round(count * 100 / total, 1)}
+            for name, count in sorted(self_samples.items(), key=lambda item: item[1], reverse=True)[:15]
+        ]
+
+    conn = get_runtime_db()
+    conn.execute(
+        """
+        INSERT INTO profiles (created_at, endpoint, path, mode, duration_ms, file, top_functions)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            datetime.utcnow().isoformat(timespec="seconds"), endpoint, path, mode,
+            round(duration * 1000, 2), filename, json.dumps(top, ensure_ascii=False),
+        ),
+    )
+    old = conn.execute(
+        "SELECT id, file FROM profiles ORDER BY id DESC LIMIT -1 OFFSET ?", (settings.PROFILE_KEEP,)
+    ).fetchall()
+    for row in old:
+        try:
+            os.remove(os.path.join(settings.PROFILE_DIR, row["file"]))
+        except OSError:
+            pass
+    conn.executemany("DELETE FROM profiles WHERE id = ?", [(row["id"],) for row in old])
+    conn.commit()
+    conn.close()
+
+
+@app.before_request
+def profiler_before_request():
+    profiler = active_profiler_settings()
+    if profiler is None:
+        return
+    endpoint = request.endpoint or "unmatched"
+    if profiler["endpoint_set"] and endpoint not in profiler["endpoint_set"]:
+        return
+    if random.random() >= profiler["sample_rate"]:
+        return
+
+    if profiler["mode"] == "cprofile":
+        import cProfile
+
+        collector = cProfile.Profile()
+        try:
+            collector.enable()
+        except ValueError:
+            # มี profiler อื่นทำงานอยู่ใน process นี้แล้ว
+            return
+    else:
+        collector = StackSampler(threading.get_ident(), settings.PROFILER_SAMPLE_INTERVAL)
+        collector.start()
+    g.profile = (profiler["mode"], collector, time.perf_counter())
+
+
+@app.teardown_request
+def profiler_teardown_request(exc):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    mode, collector, started = profile
+    if mode == "cprofile":
+        collector.disable()
+    else:
+        collector.stop()
+    try:
+        _save_profile(
+            request.endpoint or "unmatched", request.full_path.rstrip("?"), mode,
+            time.perf_counter() - started, collector,
+        )
+    except (OSError, sqlite3.Error) as e:
+        app.logger.warning("บันทึก profile ไม่สำเร็จ: %s", e)
+
+
+def is_admin() -> bool:
+    return bool(session.get("is_admin"))
+
+
+def admin_required():
+    if not is_admin():
+        flash("ต้องเข้าสู่ระบบแอดมินก่อน", "error")
+        return False
+    return True
+
+
+
+# ฟังก์ชันจัดการสถานะผู้ใช้ทั่วไป
+def get_current_user():
+    user_id = session.get("user_id")
+    if not user_id:
+        return None
+    conn = get_db_connection()
+    user = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    conn.close()
+    return user
+
+
+def login_user(user_row):
+    session["user_id"] = user_row["id"]
+    session["username"] = user_row["username"]
+
+
+def logout_user():
+    session.pop("user_id", None)
+    session.pop("username", None)
+
+
+def user_login_required(view_func):
+    @wraps(view_func)
     def wrapped_view(*args, **kwargs):
         if not session.get("user_id"):
             # ถ้ายังไม่ได้ล็อกอิน ให้ไปหน้าเข้าสู่ระบบผู้ใช้
@@ -330,12 +4017,7 @@ def user_login_required(view_func):
 
 @app.route("/")
 def index():
-    conn = get_db_connection()
-    series_list = conn.execute(
-        "SELECT * FROM series ORDER BY datetime(created_at) DESC"
-    ).fetchall()
-    conn.close()
-    return render_template("index.html", series_list=series_list)
+    return render_template("index.html", series_list=get_catalog().series_list)
 
 
 
@@ -346,20 +4028,33 @@ def search():
     if not query:
         return redirect(url_for("index"))
 
+    main_keyword, ranked = rank_series(query, get_catalog().series_list)
+    results = [row for _, row in ranked]  # แสดงทุกเรื่อง แต่จัดอันดับให้เรื่องที่ตรงสุดอยู่ด้านบน
+
+    return render_template(
+        "search_results.html",
+        query=query,
+        main_keyword=main_keyword,
+        series_list=results,
+    )
+
+
+def rank_series(query: str, series_rows) -> tuple:
+    """ให้คะแนนทุกเรื่องกับคำค้น (ใช้ทั้งหน้า /search และ /api/v1/search)
+
+    คืน (คำหลัก, [(คะแนน, เรื่อง), ...] เรียงคะแนนมากไปน้อย) คะแนน 0 = ไม่ตรงเลย
+    """
     # ตัดคำอย่างง่าย: เอาคำหลัก เช่น "มหาเวทย์ผนึกมาร" จาก "มหาเวทย์ผนึกมาร S2"
     tokens = query.split()
     keywords = [t for t in tokens if not re.fullmatch(r"[sS]\d+", t)]
     main_keyword = max(keywords, key=len) if keywords else query
 
-    conn = get_db_connection()
-    series_rows = conn.execute("SELECT * FROM series").fetchall()
-    conn.close()
+    q = query.lower()
+    mk = main_keyword.lower()
 
     def score(row):
         title = (row["title"] or "").lower()
         desc = (row["description"] or "").lower()
-        q = query.lower()
-        mk = main_keyword.lower()
 
         if title == q:
             base = 4
@@ -374,72 +4069,80 @@ def search():
 
         return base
 
-    sorted_rows = sorted(series_rows, key=score, reverse=True)
-    results = sorted_rows  # แสดงทุกเรื่อง แต่จัดอันดับให้เรื่องที่ตรงสุดอยู่ด้านบน
+    # เรียงตาม id ก่อน เรื่องที่คะแนนเท่ากันจะอยู่ลำดับเดิม
+    scored = [(score(row), row) for row in sorted(series_rows, key=lambda row: row["id"])]
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return main_keyword, scored
 
-    return render_template(
-        "search_results.html",
-        query=query,
-        main_keyword=main_keyword,
-        series_list=results,
-    )
+
+@app.route("/search/suggest")
+def search_suggest():
+    """คำแนะนำขณะพิมพ์ในช่องค้นหา: เรื่องที่ชื่อขึ้นต้นด้วยคำที่พิมพ์ก่อน แล้วตามด้วยตอน (รวมไม่เกิน SUGGEST_LIMIT)"""
+    prefix = normalize_title(request.args.get("q", ""))
+    try:
+        limit = max(1, min(int(request.args.get("limit", settings.SUGGEST_LIMIT)), settings.SUGGEST_LIMIT))
+    except ValueError:
+        raise ApiError("limit ต้องเป็นตัวเลข")
+
+    catalog = get_catalog()
+
+    def build():
+        if not prefix:
+            return {"suggestions": []}
+        series_ids, episode_ids = get_suggest_index(catalog).lookup(prefix, limit)
+        suggestions = []
+        for series_id in series_ids:
+            series = catalog.series(series_id)
+            suggestions.append({
+                "type": "series",
+                "id": series.id,
+                "title": series.title,
+                "url": url_for("series_detail", series_id=series.id),
+            })
+        for series_id, episode_id in episode_ids:
+            episode = catalog.episode(series_id, episode_id)
+            suggestions.append({
+                "type": "episode",
+                "id": episode.id,
+                "series_id": series_id,
+                "title": episode.title,
+                "series_title": catalog.series(series_id).title,
+                "url": url_for("watch_episode", series_id=series_id, episode_id=episode.id),
+            })
+        return {"suggestions": suggestions}
+
+    return _api_respond(catalog, build)
 
 @app.route("/series/<int:series_id>")
 def series_detail(series_id):
-    conn = get_db_connection()
-    series = conn.execute(
-        "SELECT * FROM series WHERE id = ?", (series_id,)
-    ).fetchone()
+    series = get_catalog().series(series_id)
     if series is None:
-        conn.close()
         flash("ไม่พบเรื่องนี้", "error")
         return redirect(url_for("index"))
 
-    episodes = conn.execute(
-        """
-        SELECT * FROM episodes
-        WHERE series_id = ?
-        ORDER BY episode_number IS NULL, episode_number, datetime(created_at)
-        """,
-        (series_id,),
-    ).fetchall()
-    conn.close()
-    return render_template("series_detail.html", series=series, episodes=episodes)
+    return render_template("series_detail.html", series=series, episodes=series.episodes)
 
 
 @app.route("/series/<int:series_id>/episode/<int:episode_id>")
 @user_login_required
 def watch_episode(series_id, episode_id):
-    conn = get_db_connection()
-    series = conn.execute(
-        "SELECT * FROM series WHERE id = ?", (series_id,)
-    ).fetchone()
-    episode = conn.execute(
-        "SELECT * FROM episodes WHERE id = ? AND series_id = ?",
-        (episode_id, series_id),
-    ).fetchone()
-    conn.close()
+    catalog = get_catalog()
+    series = catalog.series(series_id)
+    episode = catalog.episode(series_id, episode_id)
 
     if series is None or episode is None:
         flash("ไม่พบตอนนี้", "error")
         return redirect(url_for("index"))
 
-    # ตรวจสอบสถานะเปิด/ปิด
-    series_active = 1
-    try:
-        if "is_active" in series.keys() and series["is_active"] is not None:
-            series_active = int(series["is_active"])
-    except Exception:
-        series_active = 1
-
-    episode_active = 1
-    try:
-        if "is_active" in episode.keys() and episode["is_active"] is not None:
-            episode_active = int(episode["is_active"])
-    except Exception:
-        episode_active = 1
+    # ตอนหรือเรื่องถูกปิด (active มาจาก catalog_visible ตอนสร้าง snapshot)
+    blocked = not episode.active
 
-    blocked = (series_active == 0) or (episode_active == 0)
+    # โหลดไฟล์ของตอนถัดไปไว้ล่วงหน้า (ผู้ชมส่วนใหญ่ดูต่อตอนถัดไป)
+    if not blocked:
+        try:
+            prefetch_next_episodes(series_id, episode_id)
+        except Exception:
+            pass
 
     # บันทึกประวัติการดู (เฉพาะเมื่อผู้ใช้ล็อกอินแล้ว)
     user_id = session.get("user_id")
@@ -455,13 +4158,343 @@ def watch_episode(series_id, episode_id):
         except Exception:
             pass
 
+    # ลิงก์สตรีมแบบลงชื่อ: Range request ของ player ไม่ต้องเช็ก session / DB ซ้ำ
+    stream_url = None
+    if user_id and not blocked and episode["file_path"] and settings.STREAM_TOKEN_TTL > 0:
+        stream_url = url_for(
+            "stream_episode", episode_id=episode_id, st=mint_stream_token(episode, user_id)
+        )
+
     # ผู้ใช้ยังเข้าได้ปกติ แต่ถ้า blocked == True จะขึ้นข้อความในหน้า watch.html แทนวิดีโอ
-    return render_template("watch.html", series=series, episode=episode, blocked=blocked)
+    return render_template(
+        "watch.html", series=series, episode=episode, blocked=blocked, stream_url=stream_url
+    )
 
 
-@app.route("/stream/<int:episode_id>")
-@user_login_required
-def stream_episode(episode_id):
+# ---------- JSON API ของ catalog (/api/v1, อ่านอย่างเดียว) ----------
+# สำหรับแอปมือถือ อ่านจาก Catalog snapshot ทั้งหมด (ไม่รัน SQL) และใช้ catalog_visible เหมือนหน้าดูวิดีโอ/สตรีม
+# - ?fields=id,title เลือกเฉพาะฟิลด์ที่ต้องการ
+# - ลิสต์แบ่งหน้าด้วย cursor (ส่ง next_cursor กลับมาเป็น ?cursor=) ชี้ตำแหน่งด้วย sort_key ไม่ใช่ offset
+#   มีการเพิ่ม/ลบระหว่างไล่หน้าก็ไม่ข้ามหรือซ้ำ
+# - ETag ผูกกับ epoch ของ catalog ถ้ายังไม่มีอะไรเปลี่ยนได้ 304 โดยไม่ต้องสร้าง body
+# - /api/v1/changes?changes_since=<version> ส่งเฉพาะเรื่อง/ตอนที่เปลี่ยนหลัง version ที่ client มีอยู่
+
+API_SERIES_FIELDS = ("id", "title", "description", "thumbnail_url", "created_at")
+API_EPISODE_FIELDS = ("id", "series_id", "title", "description", "episode_number", "thumbnail_url", "created_at")
+
+
+class ApiError(RuntimeError):
+    """คำขอ /api/v1 ไม่ถูกต้องหรือไม่พบข้อมูล (ตอบเป็น JSON {"error": ...})"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+@app.errorhandler(ApiError)
+def api_error_response(exc: ApiError):
+    return _api_json({"error": str(exc)}, status=exc.status)
+
+
+def _api_json(data, status: int = 200) -> Response:
+    # ไม่ escape ภาษาไทยเป็น \uXXXX และไม่มีช่องว่าง ให้ payload เล็กที่สุด
+    body = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return Response(body, status=status, mimetype="application/json")
+
+
+def _api_respond(catalog: Catalog, build) -> Response:
+    """ตอบ JSON ที่ขึ้นกับ catalog อย่างเดียว ETag ตรงกับ If-None-Match = 304 โดยไม่เรียก build()"""
+    etag = f"catalog-v1-{catalog.version}"
+    # เทียบแบบ weak: ถ้า response ถูกบีบ ETag ที่ client ส่งกลับมาจะเป็น W/"..."
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = _api_json(build())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def _api_fields(param: str, allowed: tuple) -> tuple:
+    raw = request.args.get(param, "")
+    if not raw.strip():
+        return allowed
+    fields = tuple(dict.fromkeys(field.strip() for field in raw.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ApiError(f"ไม่รู้จักฟิลด์ {', '.join(unknown)} (ใช้ได้: {', '.join(allowed)})")
+    return fields
+
+
+def _api_project(record, fields: tuple) -> dict:
+    item = {}
+    for field in fields:
+        value = record[field]
+        # รูปปกที่อัปโหลดเก็บเป็น path ใต้ static ส่ง URL ให้ client ใช้ได้เลย
+        if field == "thumbnail_url":
+            value = cover_url(value)
+        item[field] = value
+    return item
+
+
+def _encode_cursor(key) -> str:
+    raw = json.dumps(list(key), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _decode_cursor(raw: str) -> tuple:
+    """กลับด้านของ _encode_cursor (cursor ผิดรูปแบบ = ValueError/TypeError)"""
+    return tuple(json.loads(base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4))))
+
+
+def _api_page(items, sort_key, descending: bool = False):
+    """ตัดหน้าถัดจาก ?cursor= ออกจาก ``items`` (เรียงตาม sort_key แล้ว) คืน (หน้า, next_cursor)"""
+    limit = request.args.get("limit", type=int) or settings.API_PAGE_SIZE
+    limit = max(1, min(limit, settings.API_MAX_PAGE_SIZE))
+
+    start = 0
+    raw = request.args.get("cursor")
+    if raw:
+        try:
+            cursor = _decode_cursor(raw)
+            # รายการหลัง cursor คือช่วงท้ายของลิสต์ที่เรียงแล้ว หาจุดเริ่มด้วย bisect
+            if descending:
+                start = bisect.bisect_left(items, True, key=lambda item: sort_key(item) < cursor)
+            else:
+                start = bisect.bisect_left(items, True, key=lambda item: sort_key(item) > cursor)
+        except (ValueError, TypeError):
+            raise ApiError("cursor ไม่ถูกต้อง") from None
+
+    page = items[start:start + limit]
+    next_cursor = _encode_cursor(sort_key(page[-1])) if start + limit < len(items) else None
+    return page, next_cursor
+
+
+def _api_visible_series(catalog: Catalog, series_id: int) -> CatalogSeries:
+    series = catalog.series(series_id)
+    if series is None or not series.active:
+        raise ApiError("ไม่พบเรื่องนี้", 404)
+    return series
+
+
+@app.route("/api/v1/series")
+def api_series_list():
+    catalog = get_catalog()
+    fields = _api_fields("fields", API_SERIES_FIELDS)
+
+    def build():
+        page, next_cursor = _api_page(
+            catalog.visible_series, lambda series: series.sort_key, descending=True
+        )
+        return {
+            "version": catalog.version,
+            "items": [_api_project(series, fields) for series in page],
+            "next_cursor": next_cursor,
+        }
+
+    return _api_respond(catalog, build)
+
+
+@app.route("/api/v1/series/<int:series_id>")
+def api_series_detail(series_id):
+    catalog = get_catalog()
+    series = _api_visible_series(catalog, series_id)
+    fields = _api_fields("fields", API_SERIES_FIELDS)
+
+    return _api_respond(catalog, lambda: {
+        "version": catalog.version,
+        "item": _api_project(series, fields),
+        "episode_count": sum(1 for episode in series.episodes if episode.active),
+    })
+
+
+@app.route("/api/v1/series/<int:series_id>/episodes")
+def api_series_episodes(series_id):
+    catalog = get_catalog()
+    series = _api_visible_series(catalog, series_id)
+    fields = _api_fields("fields", API_EPISODE_FIELDS)
+
+    def build():
+        episodes = [episode for episode in series.episodes if episode.active]
+        page, next_cursor = _api_page(episodes, lambda episode: episode.sort_key)
+        return {
+            "version": catalog.version,
+            "items": [_api_project(episode, fields) for episode in page],
+            "next_cursor": next_cursor,
+        }
+
+    return _api_respond(catalog, build)
+
+
+@app.route("/api/v1/search")
+def api_search():
+    query = request.args.get("q", "").strip()
+    if not query:
+        raise ApiError("ต้องระบุคำค้น ?q=")
+    catalog = get_catalog()
+    fields = _api_fields("fields", API_SERIES_FIELDS)
+
+    def build():
+        main_keyword, ranked = rank_series(query, catalog.visible_series)
+        # ต่างจากหน้า /search ตรงที่ส่งเฉพาะเรื่องที่ตรงกับคำค้นจริง (คะแนน > 0)
+        matches = [((-score, series.id), score, series) for score, series in ranked if score > 0]
+        page, next_cursor = _api_page(matches, lambda match: match[0])
+        return {
+            "version": catalog.version,
+            "main_keyword": main_keyword,
+            "items": [{**_api_project(series, fields), "score": score} for _, score, series in page],
+            "next_cursor": next_cursor,
+        }
+
+    return _api_respond(catalog, build)
+
+
+@app.route("/api/v1/changes")
+def api_changes():
+    """เรื่อง/ตอนที่เปลี่ยนหลัง ``changes_since`` (ค่า version จากคำตอบครั้งก่อน)
+
+    - series / episodes: รายการที่เพิ่มหรือแก้ (เรื่องที่เปลี่ยนจะส่งตอนที่ดูได้ทั้งหมดของเรื่องมาด้วย)
+    - deleted: id ที่ถูกลบหรือถูกปิด client ต้องลบออก (ลบเรื่อง = ลบตอนของเรื่องนั้นด้วย)
+    - reset = true: ส่งทั้ง catalog มา client ต้องแทนข้อมูลเดิมทั้งหมด (changes_since=0 หรือ version ไม่ตรงกับ DB นี้)
+    """
+    since = request.args.get("changes_since", type=int)
+    if since is None:
+        raise ApiError("ต้องระบุ changes_since (0 = โหลดทั้งหมด)")
+    catalog = get_catalog()
+    series_fields = _api_fields("fields", API_SERIES_FIELDS)
+    episode_fields = _api_fields("episode_fields", API_EPISODE_FIELDS)
+
+    def build():
+        reset = since <= 0 or since > catalog.version
+        if reset:
+            changed_series = catalog.visible_series
+            changed_episodes = [
+                episode for series in changed_series for episode in series.episodes if episode.active
+            ]
+            deleted_series, deleted_episodes = [], []
+        else:
+            changed_series, deleted_series = [], []
+            episode_ids = {
+                episode_id for episode_id, version in catalog.episode_changes.items() if version > since
+            }
+            for series_id, version in catalog.series_changes.items():
+                if version <= since:
+                    continue
+                series = catalog.series(series_id)
+                if series is not None and series.active:
+                    changed_series.append(series)
+                    # เรื่องที่กลับมาเปิด: ตอนของเรื่องไม่ได้ถูกแก้ แต่ client ลบทิ้งไปแล้วตอนเรื่องถูกปิด
+                    episode_ids.update(episode.id for episode in series.episodes)
+                else:
+                    deleted_series.append(series_id)
+
+            changed_episodes, deleted_episodes = [], []
+            for episode_id in episode_ids:
+                episode = catalog.episodes_by_id.get(episode_id)
+                if episode is not None and episode.active:
+                    changed_episodes.append(episode)
+                else:
+                    deleted_episodes.append(episode_id)
+            changed_series.sort(key=lambda series: series.sort_key, reverse=True)
+            changed_episodes.sort(key=lambda episode: (episode.series_id, episode.sort_key))
+
+        return {
+            "version": catalog.version,
+            "reset": reset,
+            "series": [_api_project(series, series_fields) for series in changed_series],
+            "episodes": [_api_project(episode, episode_fields) for episode in changed_episodes],
+            "deleted": {"series": sorted(deleted_series), "episodes": sorted(deleted_episodes)},
+        }
+
+    return _api_respond(catalog, build)
+
+
+# ---------- ลิงก์สตรีมแบบลงชื่อ (ไม่ต้องเช็ก session / DB ทุก Range request) ----------
+# watch_episode ออก token ที่ผูก ตอน, ผู้ใช้, เวลาหมดอายุ และ path ไฟล์ที่ตรวจแล้ว
+# player ขอ Range ซ้ำเป็นร้อยครั้งต่อการดูหนึ่งครั้ง แต่ละครั้งตรวจแค่ HMAC
+# token หมดอายุ/ไม่ถูกต้อง จะย้อนกลับไปใช้ session + resolve_stream_file แบบเดิม
+
+def _stream_token_keys() -> list:
+    keys = [key.strip().encode() for key in settings.STREAM_TOKEN_KEYS.split(",") if key.strip()]
+    if not keys:
+        keys = [hmac.new(str(settings.SECRET_KEY).encode(), b"stream-token", hashlib.sha256).digest()]
+    return keys
+
+
+def _stream_token_signature(key: bytes, payload: str) -> str:
+    digest = hmac.new(key, payload.encode("ascii"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+def mint_stream_token(episode, user_id: int, ttl: int | None = None) -> str:
+    """สร้าง token สำหรับ /stream/<id>?st=... ของ ``episode`` (แถวจาก episodes)"""
+    claims = {
+        "e": episode["id"],
+        "s": episode["series_id"],
+        "u": user_id,
+        "x": int(time.time()) + (settings.STREAM_TOKEN_TTL if ttl is None else ttl),
+        "f": episode["file_path"],
+        "g": 1 if episode["source_type"] == "gdrive" else 0,
+    }
+    payload = base64.urlsafe_b64encode(
+        json.dumps(claims, separators=(",", ":")).encode("utf-8")
+    ).rstrip(b"=").decode("ascii")
+    return f"{payload}.{_stream_token_signature(_stream_token_keys()[0], payload)}"
+
+
+def verify_stream_token(token: str | None, episode_id: int) -> dict | None:
+    """คืน claims ถ้า token ลงชื่อด้วย key ที่ยังใช้อยู่ ตรงกับตอนนี้ และยังไม่หมดอายุ (ไม่แตะ DB)"""
+    if not token or settings.STREAM_TOKEN_TTL <= 0:
+        return None
+    payload, _, signature = token.partition(".")
+    if not payload or not signature:
+        return None
+
+    valid = False
+    for key in _stream_token_keys():
+        # ตรวจครบทุก key เสมอ เวลาที่ใช้ไม่ขึ้นกับว่า key ไหนตรง
+        valid |= hmac.compare_digest(_stream_token_signature(key, payload), signature)
+    if not valid:
+        return None
+
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except ValueError:
+        return None
+    if claims.get("e") != episode_id or claims.get("x", 0) < time.time():
+        return None
+    return claims
+
+
+def stream_token_file(claims: dict) -> str | None:
+    """key ของไฟล์ใน token คืน None ถ้าไฟล์ไม่อยู่แล้ว (เช่น ถูกลบออกจากแคช ต้องใช้ resolve_stream_file)
+
+    เรื่อง/ตอนที่ถูกปิดหลังออก token จะ abort(403) ทันที (ตรวจจาก snapshot ของ catalog ไม่รัน SQL)
+    """
+    episode = get_catalog().episode(claims.get("s"), claims.get("e"))
+    if episode is None:
+        abort(404)
+    if not episode.active:
+        abort(403)
+
+    file_path = claims.get("f")
+    # ไฟล์ของตอนถูกเปลี่ยนหลังออก token ใช้ไฟล์ใหม่จาก resolve_stream_file
+    if not file_path or file_path != episode.file_path:
+        return None
+    info = video_storage().stat(file_path)
+    if info is None:
+        return None
+    if claims.get("g"):
+        cache_touch(file_path, size=info.size)
+    return file_path
+
+
+def resolve_stream_file(episode_id: int):
+    """
+    หา key ไฟล์วิดีโอของตอนในที่เก็บสำหรับสตรีม (ใช้ร่วมกันทั้ง Flask และ asgi.py) คืน (file_path, episode)
+    - abort(404) ถ้าไม่พบตอน/ไฟล์, abort(403) ถ้าเรื่องหรือตอนถูกปิด
+    - ไม่ต้องมี request context
+    """
     conn = get_db_connection()
     episode = conn.execute(
         "SELECT * FROM episodes WHERE id = ?", (episode_id,)
@@ -479,22 +4512,8 @@ def stream_episode(episode_id):
     if episode is None or series is None:
         abort(404)
 
-    # ถ้าเรื่องหรืออตอนถูกปิด จะไม่ให้สตรีมวิดีโอ
-    series_active = 1
-    try:
-        if "is_active" in series.keys() and series["is_active"] is not None:
-            series_active = int(series["is_active"])
-    except Exception:
-        series_active = 1
-
-    episode_active = 1
-    try:
-        if "is_active" in episode.keys() and episode["is_active"] is not None:
-            episode_active = int(episode["is_active"])
-    except Exception:
-        episode_active = 1
-
-    if series_active == 0 or episode_active == 0:
+    # ถ้าเรื่องหรือตอนถูกปิด จะไม่ให้สตรีมวิดีโอ
+    if not catalog_visible(series, episode):
         abort(403)
 
     # ---------------------------
@@ -503,12 +4522,8 @@ def stream_episode(episode_id):
     # และเป็นตอนแบบ Google Drive ให้ลองโหลดใหม่อัตโนมัติ
     # ---------------------------
     file_path = episode["file_path"]
-    if file_path and not os.path.isabs(file_path):
-        abs_path = os.path.join(BASE_DIR, file_path)
-    else:
-        abs_path = file_path
-
-    if not abs_path or not os.path.exists(abs_path):
+    # stat ที่ได้ถูกจำไว้ (S3) send_video_file จึงไม่ต้องถามซ้ำ
+    if not file_path or video_storage().stat(file_path) is None:
         # ลองดาวน์โหลดใหม่จาก Google Drive ถ้าเป็นตอนโหมด gdrive
         source_type = None
         drive_id = None
@@ -523,26 +4538,349 @@ def stream_episode(episode_id):
 
         if source_type == "gdrive" and drive_id:
             try:
-                # ดาวน์โหลดไฟล์ใหม่
-                new_file = download_drive_file(drive_id, episode["series_id"])
-                # เก็บ path แบบ relative ลง DB เพื่อใช้ครั้งต่อไป
-                rel_path = os.path.relpath(new_file, BASE_DIR)
-                conn2 = get_db_connection()
-                conn2.execute(
-                    "UPDATE episodes SET file_path = ? WHERE id = ?",
-                    (rel_path, episode["id"]),
-                )
-                conn2.commit()
-                conn2.close()
-                abs_path = new_file
+                # ดาวน์โหลดไฟล์ใหม่ (ถ้า prefetch กำลังโหลดไฟล์นี้อยู่จะรอผลจากตัวนั้น)
+                file_path = rehydrate_drive_episode(episode)
             except Exception:
                 abort(404)
         else:
             abort(404)
+    elif episode["source_type"] == "gdrive":
+        cache_touch(file_path)
+
+    return file_path, episode
+
+
+class CountingFileBody:
+    """body ของไฟล์ช่วง [start, end) ในที่เก็บ ที่นับไบต์ที่ส่งถึงผู้ชมจริง แล้วเรียก on_close(ไบต์) ตอนปิด
+
+    ก้อนหนึ่งนับว่าส่งแล้วเมื่อ server ขอก้อนถัดไป (เขียนก้อนก่อนหน้าลง socket สำเร็จ)
+    หรือเมื่ออ่านครบช่วง ผู้ชมที่ตัดการเชื่อมต่อกลางทางจึงถูกนับเท่าที่ได้รับจริง
+    server อ่าน body หลัง request จบ (นอก app context) จึงจำที่เก็บและแอปไว้ตั้งแต่ตอนสร้าง
+    """
+
+    def __init__(self, key: str, start: int, end: int, on_close=None, lease=None):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.on_close = on_close
+        self.lease = lease
+        self.storage = video_storage()
+        self.chunk_size = settings.STREAM_CHUNK_SIZE
+        self.app = current_app._get_current_object()
+        self.sent = 0
+        self._chunks = None
+        self._closed = False
+
+    def __iter__(self):
+        pending = 0
+        self._chunks = self.storage.open_range(self.key, self.start, self.end, self.chunk_size)
+        for chunk in self._chunks:
+            self.sent += pending
+            pending = len(chunk)
+            if self.lease is not None:
+                # คุมแบนด์วิดท์ต่อผู้ใช้ด้วยการหน่วงก่อนส่งก้อนถัดไป
+                wait = self.lease.consume(pending)
+                if wait > 0:
+                    time.sleep(wait)
+            yield chunk
+        self.sent += pending
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._chunks is not None:
+            # ปิดไฟล์ / คืน connection ของ S3 ทันทีที่ผู้ชมตัดการเชื่อมต่อ
+            self._chunks.close()
+        release_stream(self.lease)
+        if self.on_close is not None:
+            with self.app.app_context():
+                try:
+                    self.on_close(self.sent)
+                except Exception as e:
+                    app.logger.warning("stream on_close failed: %s", e)
+
+
+def send_video_file(file_path: str, on_close=None, lease=None) -> Response:
+    """ส่งไฟล์วิดีโอจากที่เก็บ (รองรับ Range / If-Range / If-Modified-Since) ด้วย CountingFileBody
+
+    ใช้แทน send_file: ใต้ gunicorn ตัวห่อ Range ของ Werkzeug seek ``wsgi.file_wrapper`` ไม่ได้
+    จึงอ่านไฟล์ตั้งแต่ต้นจนถึงช่วงที่ขอทุกครั้งที่ผู้ชมเลื่อนไปกลางเรื่อง (และใช้กับ S3 ไม่ได้อยู่แล้ว)
+    """
+    try:
+        info = video_storage().stat(file_path)
+    except MediaStorageError:
+        info = None
+    if info is None:
+        release_stream(lease)
+        abort(404)
+    size = info.size
+    last_modified = datetime.utcfromtimestamp(int(info.mtime))
+
+    requested = request.range
+    if_range = request.if_range
+    if requested is not None and (if_range.etag or if_range.date):
+        # ไม่มี ETag ให้เทียบ และถ้าไฟล์เปลี่ยนหลังเวลาที่ผู้ชมถือไว้ ส่งไฟล์ทั้งก้อนแทน
+        if if_range.date is None or if_range.date.replace(tzinfo=None) != last_modified:
+            requested = None
+
+    status, start, end = 200, 0, size
+    headers = {"Accept-Ranges": "bytes"}
+    if requested is not None:
+        span = requested.range_for_length(size)
+        if span is None:
+            release_stream(lease)
+            if on_close is not None:
+                on_close(0)
+            return Response(status=416, headers={"Content-Range": f"bytes */{size}"})
+        status, (start, end) = 206, span
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+
+    response = Response(
+        CountingFileBody(file_path, start, end, on_close, lease),
+        status=status,
+        headers=headers,
+        mimetype="video/mp4",
+        direct_passthrough=True,
+    )
+    response.last_modified = last_modified
+    if status == 200:
+        # 304 ถ้าไฟล์ไม่เปลี่ยน (body ถูกปิดโดยไม่ได้อ่าน นับเป็น 0 ไบต์)
+        response.make_conditional(request.environ)
+    return response
+
+
+def offload_video_file(file_path: str, on_close=None, lease=None) -> Response | None:
+    """ตอบ X-Accel-Redirect / X-Sendfile ให้ proxy ส่งไฟล์เอง (proxy จัดการ Range ให้)
+    คืน None ถ้าไม่ได้เปิด STREAM_OFFLOAD หรือไฟล์ไม่อยู่ใต้ VIDEO_ROOT ในเครื่อง (ให้ send_video_file ส่งเองแทน)
+
+    worker ไม่เห็นไบต์ที่ส่งจริง จึงจดช่วงที่ขอเป็นยอดประมาณ (estimated_bytes) แล้วคืนสิทธิ์สตรีมทันที
+    ไม่หักทั้งช่วงจาก bucket กลาง (player เปิดด้วย bytes=0- แล้วตัดทิ้งเป็นปกติ) หักแค่ไม่เกิน
+    STREAM_TOKEN_GRANT_BYTES ต่อ request ความเร็วจริงให้ nginx คุมต่อการเชื่อมต่อด้วย X-Accel-Limit-Rate
+    (X-Sendfile คุมความเร็วไม่ได้ จึงใช้คู่กับ STREAM_USER_RATE_BYTES ไม่ได้ ดู _boot)
+    """
+    if settings.STREAM_OFFLOAD not in ("nginx", "sendfile"):
+        return None
+    abs_path = video_storage().local_path(file_path)
+    if abs_path is None:
+        return None
+    real_path = os.path.realpath(abs_path)
+    rel_path = os.path.relpath(real_path, os.path.realpath(settings.VIDEO_ROOT))
+    if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep):
+        return None
+    try:
+        size = os.path.getsize(real_path)
+    except OSError:
+        return None
 
-    return send_file(abs_path, mimetype="video/mp4", as_attachment=False)
+    expected = size
+    if request.method == "HEAD":
+        expected = 0
+    elif request.range is not None:
+        span = request.range.range_for_length(size)
+        expected = span[1] - span[0] if span else 0
+
+    headers = {}
+    if settings.STREAM_OFFLOAD == "nginx":
+        headers["X-Accel-Redirect"] = (
+            settings.STREAM_OFFLOAD_PREFIX.rstrip("/") + "/" + quote(rel_path.replace(os.sep, "/"))
+        )
+        if settings.STREAM_USER_RATE_BYTES > 0:
+            headers["X-Accel-Limit-Rate"] = str(settings.STREAM_USER_RATE_BYTES)
+    else:
+        headers["X-Sendfile"] = real_path
+
+    if lease is not None and expected:
+        # ไม่รอ token ตรงนี้ (worker ไม่ได้ส่งเอง) bucket ที่ติดลบทำให้การดูใหม่ได้ 429 ใน acquire_stream
+        lease.consume(min(expected, lease.config.STREAM_TOKEN_GRANT_BYTES))
+    release_stream(lease)
+    if on_close is not None:
+        on_close(expected, estimated=True)
+    return Response(status=200, headers=headers, mimetype="video/mp4")
+
+
+@app.route("/stream/<int:episode_id>")
+def stream_episode(episode_id):
+    claims = verify_stream_token(request.args.get("st"), episode_id)
+    if claims is None:
+        return _stream_episode_with_session(episode_id)
+    return _stream_episode(episode_id, claims["u"], claims)
+
+
+@user_login_required
+def _stream_episode_with_session(episode_id):
+    return _stream_episode(episode_id, session.get("user_id"))
+
+
+def _stream_episode(episode_id: int, user_id: int, claims: dict | None = None):
+    # เช็กโควตาก่อนงานที่แพง (อ่าน DB / โหลดไฟล์ Drive) ผู้ใช้ที่เกินได้ 429 เร็วที่สุด
+    try:
+        lease = acquire_stream(user_id, episode_id)
+    except StreamLimitExceeded as e:
+        return stream_limit_response(e)
+
+    try:
+        file_path = stream_token_file(claims) if claims is not None else None
+        if file_path is not None:
+            episode = {"id": claims["e"], "series_id": claims["s"]}
+        else:
+            file_path, episode = resolve_stream_file(episode_id)
+    except Exception:
+        release_stream(lease)
+        raise
+
+    def account(sent_bytes, estimated=False):
+        bandwidth_record(episode["id"], episode["series_id"], user_id, sent_bytes, estimated)
+
+    offloaded = offload_video_file(file_path, on_close=account, lease=lease)
+    if offloaded is not None:
+        return offloaded
+    return send_video_file(file_path, on_close=account, lease=lease)
+
+
+
+
+# ---------- แฮชรหัสผ่านใน process pool (ไม่แย่ง CPU/GIL กับ thread ที่ส่งหน้าเว็บ/วิดีโอ) ----------
+# scrypt/PBKDF2 ตั้งใจให้ช้า ถ้ารันใน thread ของ request ช่วงที่คนล็อกอินพร้อมกันมาก ๆ worker ทุกตัวจะติดแฮชอยู่
+# จึงส่งไปทำใน ProcessPoolExecutor ขนาด PASSWORD_HASH_WORKERS ของแต่ละ worker (สร้างตอนใช้ครั้งแรก หลัง fork)
+# งานที่รอ/กำลังทำเกิน PASSWORD_HASH_QUEUE_LIMIT ตอบ 503 ทันที ดีกว่าให้ request ค้างจนหมดเวลา
+# process ลูก (forkserver/spawn) import สคริปต์หลักซ้ำ สคริปต์ที่ import app แล้วสมัคร/ล็อกอินจึงต้องมี
+# if __name__ == "__main__" (หรือตั้ง PASSWORD_HASH_WORKERS=0)
+
+class PasswordHashBusy(RuntimeError):
+    """มีงานแฮชรหัสผ่านค้างเต็มคิว (ตอบ 503 พร้อม Retry-After)"""
+
+    def __init__(self, message: str = "ขณะนี้มีผู้เข้าสู่ระบบจำนวนมาก กรุณาลองใหม่อีกครั้งในอีกสักครู่",
+                 retry_after: int = 2):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# pool เดียวต่อ process ใช้ร่วมกันทุกแอป (แย่ง CPU ชุดเดียวกันอยู่แล้ว) ขนาดตามแอปที่แฮชก่อน
+# ส่วนคิว/เวลารอ/วิธีแฮชอ่านจากค่าตั้งของแอปที่เรียกทุกครั้ง
+_password_pool = None
+_password_pool_lock = threading.Lock()
+_password_inflight = 0
+
+
+def _get_password_pool() -> ProcessPoolExecutor:
+    global _password_pool
+    # lock ถูกถือโดยผู้เรียกแล้ว
+    if _password_pool is None:
+        # forkserver: process ลูกไม่ได้ copy thread / connection / lock ของ worker ไปด้วย
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        _password_pool = ProcessPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS, mp_context=context)
+    return _password_pool
+
+
+def _password_job_done(future):
+    global _password_inflight
+
+    with _password_pool_lock:
+        _password_inflight -= 1
 
 
+def _run_password_job(fn, *args):
+    """รัน fn(*args) ใน pool (หรือใน thread นี้ถ้าปิด pool) คิวเต็ม/รอนานเกิน/pool พัง = PasswordHashBusy
+
+    งานนับว่าค้างอยู่จนกว่า pool จะทำเสร็จจริง (done callback) ไม่ใช่แค่จน request เลิกรอ
+    งานที่ request เลิกรอไปแล้วยังถือ process ใน pool อยู่ จึงต้องกันช่องไว้จนกว่าจะเสร็จ
+    """
+    global _password_inflight, _password_pool
+
+    if settings.PASSWORD_HASH_WORKERS <= 0:
+        return fn(*args)
+
+    with _password_pool_lock:
+        if _password_inflight >= settings.PASSWORD_HASH_QUEUE_LIMIT:
+            raise PasswordHashBusy()
+        _password_inflight += 1
+        pool = _get_password_pool()
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _password_job_done(None)
+        _drop_password_pool(pool)
+        raise PasswordHashBusy() from None
+    except BaseException:
+        _password_job_done(None)
+        raise
+    future.add_done_callback(_password_job_done)
+    try:
+        return future.result(timeout=settings.PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        # ยกเลิกได้เฉพาะงานที่ยังไม่ถึง process ลูก งานที่กำลังทำถือช่องไว้จนเสร็จ
+        future.cancel()
+        raise PasswordHashBusy() from None
+    except BrokenProcessPool:
+        # process ลูกตาย (เช่นโดน OOM kill) ตอบ 503 รอบนี้ ครั้งหน้าสร้าง pool ใหม่ (ไม่แฮชใน thread ของ request)
+        _drop_password_pool(pool)
+        raise PasswordHashBusy() from None
+
+
+def _drop_password_pool(pool: ProcessPoolExecutor):
+    global _password_pool
+
+    app.logger.warning("password hash pool broken, recreating")
+    with _password_pool_lock:
+        if _password_pool is pool:
+            _password_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def hash_password(password: str) -> str:
+    return _run_password_job(generate_password_hash, password, settings.PASSWORD_HASH_METHOD)
+
+
+def verify_password(pwhash: str, password: str) -> bool:
+    return _run_password_job(check_password_hash, pwhash, password)
+
+
+def password_method_prefix(method: str) -> str:
+    """คำนำหน้าแบบเต็มที่ werkzeug เขียนลงใน hash ของ ``method`` (ไม่ต้องแฮชจริง)
+
+    "scrypt" เฉย ๆ ถูกเขียนเป็น "scrypt:32768:8:1" และ "pbkdf2" เป็น "pbkdf2:sha256:<รอบเริ่มต้น>"
+    """
+    name, *args = method.split(":")
+    if name == "scrypt" and not args:
+        return "scrypt:32768:8:1"
+    if name == "pbkdf2" and len(args) < 2:
+        return f"pbkdf2:{args[0] if args else 'sha256'}:{DEFAULT_PBKDF2_ITERATIONS}"
+    return method
+
+
+def password_needs_rehash(pwhash: str) -> bool:
+    """hash นี้สร้างด้วยวิธี/ค่า cost อื่นที่ไม่ใช่ PASSWORD_HASH_METHOD ปัจจุบัน"""
+    return (pwhash or "").split("$", 1)[0] != password_method_prefix(settings.PASSWORD_HASH_METHOD)
+
+
+def shutdown_password_pool():
+    global _password_pool
+
+    with _password_pool_lock:
+        pool, _password_pool = _password_pool, None
+    if pool is not None:
+        # รอ process ลูกปิดเอง (ไม่งั้น semaphore ของคิวค้างจน resource_tracker เตือนตอนออก)
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+atexit.register(shutdown_password_pool)
+
+
+@app.errorhandler(PasswordHashBusy)
+def password_hash_busy(exc: PasswordHashBusy):
+    flash(str(exc), "error")
+    if request.endpoint in ("user_login", "user_register"):
+        response = current_app.make_response(
+            (render_template(f"{request.endpoint}.html"), 503)
+        )
+    else:
+        # หน้าบัญชี/จัดการผู้ใช้ต้องใช้ข้อมูลผู้ใช้ประกอบ กลับไปที่หน้าเดิมแทน
+        response = redirect(request.full_path, code=303)
+    response.headers["Retry-After"] = str(exc.retry_after)
+    return response
 
 
 # ------------- ระบบผู้ใช้ทั่วไป: สมัคร, ล็อกอิน, เปลี่ยนรหัส, ประวัติการดู -------------
@@ -568,9 +4906,10 @@ def user_register():
         elif password != password_confirm:
             flash("รหัสผ่านใหม่และยืนยันรหัสผ่านไม่ตรงกัน", "error")
         else:
+            # แฮชก่อนเปิด connection (คิวแฮชเต็ม = PasswordHashBusy จะได้ไม่ทิ้ง connection ค้าง)
+            hashed = hash_password(password)
             conn = get_db_connection()
             try:
-                hashed = generate_password_hash(password)
                 user_key = generate_user_key()
                 conn.execute(
                     "INSERT INTO users (username, password, plain_password, user_key, created_at) VALUES (?, ?, ?, ?, ?)",
@@ -584,8 +4923,29 @@ def user_register():
                 conn.close()
                 flash("ชื่อผู้ใช้นี้มีอยู่ในระบบแล้ว", "error")
 
-    return render_template("user_register.html")
+    return render_template("user_register.html")
+
+
+
+def rehash_password_on_login(user, password: str):
+    """รหัสผ่านถูกต้องแล้วแต่ hash ยังเป็นวิธี/cost เดิม: แฮชใหม่ด้วย PASSWORD_HASH_METHOD เก็บแทน
 
+    คิวแฮชเต็มก็ข้ามไปก่อน (ให้ล็อกอินได้ แล้วค่อยแฮชใหม่ครั้งหน้า)
+    """
+    try:
+        if not password_needs_rehash(user["password"]):
+            return
+        hashed = hash_password(password)
+    except PasswordHashBusy:
+        return
+    conn = get_db_connection()
+    # เงื่อนไข password เดิม: ถ้าระหว่างนี้มีการเปลี่ยนรหัสผ่าน ไม่เขียนทับ
+    conn.execute(
+        "UPDATE users SET password = ? WHERE id = ? AND password = ?",
+        (hashed, user["id"], user["password"]),
+    )
+    conn.commit()
+    conn.close()
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -612,9 +4972,10 @@ def user_login():
 
         if user is None:
             flash("ไม่พบบัญชีผู้ใช้นี้", "error")
-        elif not check_password_hash(user["password"], password):
+        elif not verify_password(user["password"], password):
             flash("รหัสผ่านไม่ถูกต้อง", "error")
         else:
+            rehash_password_on_login(user, password)
             login_user(user)
             flash("เข้าสู่ระบบสำเร็จ", "success")
             return redirect(next_url)
@@ -646,15 +5007,16 @@ def user_account():
 
             if not current_password or not new_password or not confirm_password:
                 flash("กรุณากรอกข้อมูลให้ครบ", "error")
-            elif not check_password_hash(user["password"], current_password):
+            elif not verify_password(user["password"], current_password):
                 flash("รหัสผ่านเดิมไม่ถูกต้อง", "error")
             elif new_password != confirm_password:
                 flash("รหัสผ่านใหม่และยืนยันรหัสผ่านไม่ตรงกัน", "error")
             else:
+                hashed = hash_password(new_password)
                 conn = get_db_connection()
                 conn.execute(
                     "UPDATE users SET password = ?, plain_password = ? WHERE id = ?",
-                    (generate_password_hash(new_password), new_password, user["id"]),
+                    (hashed, new_password, user["id"]),
                 )
                 conn.commit()
                 conn.close()
@@ -762,25 +5124,101 @@ def admin_account():
     )
 
 
+# ค้นหาผู้ใช้ (หน้าแอดมิน): เรียงสมัครล่าสุดก่อน แบ่งหน้าด้วย cursor (datetime(created_at), id)
+# - คำค้นที่หน้าตาเป็น key ("U" + hex) หาแบบคำนำหน้าผ่าน idx_users_user_key ก่อน
+# - คำค้นตั้งแต่ 3 ตัวอักษร หาผ่าน users_search (trigram) ถ้าได้ไม่เกิน _USER_SEARCH_CANDIDATES แถว
+#   ดึงเฉพาะแถวเหล่านั้นมาเรียง ถ้าคำค้นกว้างกว่านั้น (เช่น "user") ไล่ idx_users_created ตามลำดับ
+#   แถวที่ตรงมีหนาแน่นอยู่แล้วจึงได้ครบหน้าโดยอ่านไม่กี่พันแถว
+# - คำค้นสั้นกว่า 3 ตัวอักษร (trigram ใช้ไม่ได้) ไล่ตามลำดับแบบเดียวกัน
+
+_USER_KEY_PREFIX = re.compile(r"[Uu][0-9A-Fa-f]{3,16}")
+_USER_SEARCH_CANDIDATES = 2000
+_USER_ORDER = "ORDER BY datetime(created_at) DESC, id DESC"
+_USER_SEARCH_IDS = (
+    "SELECT rowid FROM users_search WHERE username LIKE :like "
+    "UNION ALL SELECT rowid FROM users_search WHERE user_key LIKE :like"
+)
+
+
+def _has_user_search(conn) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_search'"
+    ).fetchone() is not None
+
+
+def search_users(conn, q: str, limit: int, after: tuple | None = None) -> tuple:
+    """ผู้ใช้ที่ username หรือ user_key มี q อยู่ (q ว่าง = ทุกคน) คืน (แถว, cursor ของหน้าถัดไปหรือ None)
+
+    ``after`` คือ (datetime(created_at), id) ของแถวสุดท้ายในหน้าก่อน
+    """
+    params = {"limit": limit + 1}
+    page = ""
+    if after is not None:
+        params["after_at"], params["after_id"] = after
+        page = "AND datetime(created_at) <= :after_at AND (datetime(created_at) < :after_at OR id < :after_id)"
+    select = "SELECT *, datetime(created_at) AS sorted_at FROM users"
+
+    rows = None
+    if q and _USER_KEY_PREFIX.fullmatch(q):
+        # key ทุกตัวเป็นตัวพิมพ์ใหญ่ (generate_user_key / backfill_user_keys) จึงหาเป็นช่วงใน index ได้
+        params["key_from"], params["key_to"] = q.upper(), q.upper() + "\uffff"
+        key_range = "user_key >= :key_from AND user_key < :key_to"
+        # ตัดสินจากว่ามี key นี้อยู่หรือไม่ (ไม่ขึ้นกับหน้า) ทุกหน้าของคำค้นเดียวกันจะได้ใช้ทางเดียวกัน
+        # ไม่มี = อาจเป็นส่วนหนึ่งของชื่อผู้ใช้ ค้นแบบปกติต่อ
+        if conn.execute(f"SELECT 1 FROM users WHERE {key_range} LIMIT 1", params).fetchone():
+            rows = conn.execute(
+                f"{select} WHERE {key_range} {page} {_USER_ORDER} LIMIT :limit", params
+            ).fetchall()
+
+    if rows is None and q:
+        params["like"] = f"%{q}%"
+        if len(q) >= 3 and _has_user_search(conn):
+            matched = conn.execute(
+                f"SELECT count(*) FROM ({_USER_SEARCH_IDS} LIMIT {_USER_SEARCH_CANDIDATES + 1})", params
+            ).fetchone()[0]
+            if matched <= _USER_SEARCH_CANDIDATES:
+                rows = conn.execute(
+                    f"{select} WHERE id IN ({_USER_SEARCH_IDS}) {page} {_USER_ORDER} LIMIT :limit",
+                    params,
+                ).fetchall()
+        if rows is None:
+            rows = conn.execute(
+                f"{select} WHERE (username LIKE :like OR user_key LIKE :like) {page} {_USER_ORDER} LIMIT :limit",
+                params,
+            ).fetchall()
+    elif rows is None:
+        rows = conn.execute(f"{select} WHERE 1 {page} {_USER_ORDER} LIMIT :limit", params).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor((rows[-1]["sorted_at"], rows[-1]["id"]))
+    return rows, next_cursor
+
+
 @app.route("/admin/users")
 def admin_users():
     if not admin_required():
         return redirect(url_for("admin_login"))
 
     q = request.args.get("q", "").strip()
+    after = None
+    raw = request.args.get("after")
+    if raw:
+        try:
+            after = _decode_cursor(raw)
+            if len(after) != 2:
+                raise ValueError(raw)
+        except (ValueError, TypeError):
+            flash("ลิงก์หน้าถัดไปไม่ถูกต้อง เริ่มจากหน้าแรก", "error")
+            return redirect(url_for("admin_users", q=q or None))
+
     conn = get_db_connection()
-    if q:
-        like = f"%{q}%"
-        users = conn.execute(
-            "SELECT * FROM users WHERE username LIKE ? OR user_key LIKE ? ORDER BY datetime(created_at) DESC",
-            (like, like),
-        ).fetchall()
-    else:
-        users = conn.execute(
-            "SELECT * FROM users ORDER BY datetime(created_at) DESC LIMIT 100"
-        ).fetchall()
+    users, next_cursor = search_users(conn, q, settings.ADMIN_USERS_PAGE_SIZE, after)
     conn.close()
-    return render_template("admin_users.html", users=users, q=q)
+    return render_template(
+        "admin_users.html", users=users, q=q, next_cursor=next_cursor, paged=after is not None
+    )
 
 
 @app.route("/admin/users/<int:user_id>", methods=["GET", "POST"])
@@ -807,7 +5245,7 @@ def admin_user_detail(user_id):
             else:
                 try:
                     if new_password:
-                        hashed = generate_password_hash(new_password)
+                        hashed = hash_password(new_password)
                         conn.execute(
                             "UPDATE users SET username = ?, password = ?, plain_password = ? WHERE id = ?",
                             (new_username, hashed, new_password, user_id),
@@ -821,6 +5259,10 @@ def admin_user_detail(user_id):
                     flash("อัปเดตบัญชีผู้ใช้เรียบร้อยแล้ว", "success")
                 except sqlite3.IntegrityError:
                     flash("ชื่อผู้ใช้นี้มีอยู่ในระบบแล้ว", "error")
+                except PasswordHashBusy:
+                    # คิวแฮชเต็ม ตอบ 503 ผ่าน errorhandler แต่ต้องคืน connection ก่อน
+                    conn.close()
+                    raise
 
         elif action == "reset_key":
             new_key = generate_user_key()
@@ -855,6 +5297,13 @@ def admin_user_detail(user_id):
                 conn.commit()
                 flash("ลบประวัติการดูตอนนี้เรียบร้อยแล้ว", "success")
 
+        elif action == "reset_stream_limits":
+            try:
+                reset_stream_limits(user_id)
+                flash("ล้างสถานะการสตรีมของผู้ใช้นี้เรียบร้อยแล้ว", "success")
+            except sqlite3.Error:
+                flash("ล้างสถานะการสตรีมไม่สำเร็จ", "error")
+
         elif action == "delete_history_series":
             # ลบประวัติการดูรายเรื่อง (ทุกตอนของเรื่องนี้ที่ผู้ใช้นี้เคยดู)
             series_id = request.form.get("series_id")
@@ -883,7 +5332,12 @@ def admin_user_detail(user_id):
     ).fetchall()
     conn.close()
 
-    return render_template("admin_user_detail.html", user=user, history=history)
+    return render_template(
+        "admin_user_detail.html",
+        user=user,
+        history=history,
+        stream_state=stream_limit_state(user_id),
+    )
 @app.route("/admin/series", methods=["GET", "POST"])
 def admin_series():
     if not admin_required():
@@ -918,15 +5372,8 @@ def admin_series():
                 base, ext = os.path.splitext(filename)
                 ext = ext.lower() or ".jpg"
 
-                series_cover_dir = os.path.join(COVER_ROOT, f"series_{series_id}")
-                os.makedirs(series_cover_dir, exist_ok=True)
-
                 safe_name = f"cover_{series_id}_{int(datetime.utcnow().timestamp())}{ext}"
-                save_path = os.path.join(series_cover_dir, safe_name)
-                cover_file.save(save_path)
-
-                rel_path_from_static = f"covers/series_{series_id}/{safe_name}"
-                thumbnail_value = rel_path_from_static
+                thumbnail_value = store_cover(cover_file, f"covers/series_{series_id}/{safe_name}")
 
             elif thumbnail_url_input:
                 thumbnail_value = thumbnail_url_input
@@ -1023,29 +5470,16 @@ def admin_edit_series(series_id):
 
         thumbnail_value = series["thumbnail_url"]
 
-        # ถ้าอัปโหลดรูปใหม่ ให้ลบรูปเก่าที่เป็นไฟล์ใน static ออกก่อน
+        # ถ้าอัปโหลดรูปใหม่ ให้ลบรูปเก่าที่อัปโหลดไว้ออกก่อน
         if cover_file and cover_file.filename:
-            if thumbnail_value and not str(thumbnail_value).startswith("http"):
-                old_path = os.path.join(BASE_DIR, "static", thumbnail_value)
-                try:
-                    if os.path.exists(old_path):
-                        os.remove(old_path)
-                except Exception:
-                    pass
+            delete_cover(thumbnail_value)
 
             filename = os.path.basename(cover_file.filename)
             base, ext = os.path.splitext(filename)
             ext = ext.lower() or ".jpg"
 
-            series_cover_dir = os.path.join(COVER_ROOT, f"series_{series_id}")
-            os.makedirs(series_cover_dir, exist_ok=True)
-
             safe_name = f"cover_{series_id}_{int(datetime.utcnow().timestamp())}{ext}"
-            save_path = os.path.join(series_cover_dir, safe_name)
-            cover_file.save(save_path)
-
-            rel_path_from_static = f"covers/series_{series_id}/{safe_name}"
-            thumbnail_value = rel_path_from_static
+            thumbnail_value = store_cover(cover_file, f"covers/series_{series_id}/{safe_name}")
 
         # ถ้าไม่อัปโหลดไฟล์ แต่ใส่ลิงก์ใหม่ ให้ใช้ลิงก์นั้นแทน
         elif thumbnail_url_input:
@@ -1075,27 +5509,19 @@ def admin_delete_series(series_id):
 
     conn = get_db_connection()
     episodes = conn.execute(
-        "SELECT file_path FROM episodes WHERE series_id = ?", (series_id,)
+        "SELECT id, file_path, thumbnail_url FROM episodes WHERE series_id = ?", (series_id,)
     ).fetchall()
 
-    for ep in episodes:
-        fp = ep["file_path"]
-        if fp:
-            if not os.path.isabs(fp):
-                fp_full = os.path.join(BASE_DIR, fp)
-            else:
-                fp_full = fp
-            try:
-                if os.path.exists(fp_full):
-                    os.remove(fp_full)
-            except Exception:
-                pass
-
     conn.execute("DELETE FROM series WHERE id = ?", (series_id,))
+
+    # ลบแถวตอนก่อน (cascade) แล้วค่อยปล่อยไฟล์ ไฟล์ที่เรื่องอื่นยังใช้อยู่จะไม่ถูกลบ
+    for ep in episodes:
+        release_video_file(conn, ep["file_path"])
     conn.commit()
     conn.close()
 
-    series_dir = os.path.join(VIDEO_ROOT, f"series_{series_id}")
+    # โฟลเดอร์วิดีโอแบบเก่า (ก่อนมี blob store) มีแต่ในเครื่อง
+    series_dir = os.path.join(settings.VIDEO_ROOT, f"series_{series_id}")
     if os.path.isdir(series_dir):
         try:
             import shutil
@@ -1103,13 +5529,14 @@ def admin_delete_series(series_id):
         except Exception:
             pass
 
-    cover_dir = os.path.join(COVER_ROOT, f"series_{series_id}")
-    if os.path.isdir(cover_dir):
-        try:
-            import shutil
-            shutil.rmtree(cover_dir)
-        except Exception:
-            pass
+    # รูปปกของเรื่องและของทุกตอนในเรื่อง
+    try:
+        cover_storage().delete_prefix(f"covers/series_{series_id}")
+        for ep in episodes:
+            delete_cover(ep["thumbnail_url"])
+            cover_storage().delete_prefix(f"covers/episodes/ep_{ep['id']}")
+    except (OSError, MediaStorageError) as e:
+        app.logger.warning("delete covers of series %s failed: %s", series_id, e)
 
     flash("ลบเรื่องและตอนทั้งหมดเรียบร้อยแล้ว", "success")
     return redirect(url_for("admin_series"))
@@ -1163,14 +5590,13 @@ def admin_episodes(series_id):
                 return redirect(url_for("admin_episodes", series_id=series_id))
 
             try:
-                file_real = download_drive_file(drive_id, series_id)
+                file_path = download_drive_file(drive_id, series_id)
             except Exception as e:
                 flash(str(e), "error")
                 return redirect(url_for("admin_episodes", series_id=series_id))
 
-            rel_path = os.path.relpath(file_real, BASE_DIR)
-            file_path = rel_path
             source_type = "gdrive"
+            cache_touch(file_path, hit=False, force=True)
 
         elif mode == "upload":
             file = request.files.get("file")
@@ -1182,15 +5608,17 @@ def admin_episodes(series_id):
             base, ext = os.path.splitext(filename)
             ext = ext.lower() or ".mp4"
 
-            series_dir = os.path.join(VIDEO_ROOT, f"series_{series_id}")
-            os.makedirs(series_dir, exist_ok=True)
-
-            safe_name = f"{base}_{int(datetime.utcnow().timestamp())}{ext}"
-            save_path = os.path.join(series_dir, safe_name)
+            # พักไฟล์ไว้ก่อน แล้วย้ายเข้า blob store (ไฟล์ซ้ำจะใช้ของเดิม)
+            os.makedirs(settings.BLOB_TMP_ROOT, exist_ok=True)
+            save_path = os.path.join(settings.BLOB_TMP_ROOT, f"upload_{os.urandom(8).hex()}{ext}")
             file.save(save_path)
 
-            rel_path = os.path.relpath(save_path, BASE_DIR)
-            file_path = rel_path
+            try:
+                file_path = blob_store_file(save_path, ext)
+            except MediaStorageError as e:
+                os.remove(save_path)
+                flash(str(e), "error")
+                return redirect(url_for("admin_episodes", series_id=series_id))
             source_type = "upload"
 
         else:
@@ -1222,8 +5650,12 @@ def admin_episodes(series_id):
             ),
         )
         episode_id = cur.lastrowid
+        blob_acquire(conn, file_path)
         conn.commit()
 
+        if source_type == "gdrive":
+            cache_enforce_quota(keep=file_path)
+
         thumb_value = None
 
         if cover_file and cover_file.filename:
@@ -1231,14 +5663,8 @@ def admin_episodes(series_id):
             base, ext = os.path.splitext(filename)
             ext = ext.lower() or ".jpg"
 
-            ep_dir = os.path.join(EPISODE_COVER_ROOT, f"ep_{episode_id}")
-            os.makedirs(ep_dir, exist_ok=True)
-
             safe_name = f"ep_{episode_id}_{int(datetime.utcnow().timestamp())}{ext}"
-            save_path = os.path.join(ep_dir, safe_name)
-            cover_file.save(save_path)
-
-            thumb_value = f"covers/episodes/ep_{episode_id}/{safe_name}"
+            thumb_value = store_cover(cover_file, f"covers/episodes/ep_{episode_id}/{safe_name}")
 
         elif thumbnail_url_input:
             thumb_value = thumbnail_url_input
@@ -1352,19 +5778,6 @@ def admin_edit_episode(episode_id):
         new_drive_id = ep["drive_id"]
         new_file_path = ep["file_path"]
 
-        def delete_old_file(path):
-            if not path:
-                return
-            if not os.path.isabs(path):
-                fp_full = os.path.join(BASE_DIR, path)
-            else:
-                fp_full = path
-            try:
-                if os.path.exists(fp_full):
-                    os.remove(fp_full)
-            except Exception:
-                pass
-
         if mode == "keep":
             pass
         elif mode == "direct":
@@ -1374,9 +5787,7 @@ def admin_edit_episode(episode_id):
                 conn.close()
                 return redirect(url_for("admin_edit_episode", episode_id=episode_id))
 
-            if new_source_type in ("gdrive", "upload"):
-                delete_old_file(new_file_path)
-                new_file_path = None
+            new_file_path = None
 
             new_source_type = "direct"
             new_video_url = video_url
@@ -1395,19 +5806,15 @@ def admin_edit_episode(episode_id):
                 conn.close()
                 return redirect(url_for("admin_edit_episode", episode_id=episode_id))
 
-            if new_source_type in ("gdrive", "upload"):
-                delete_old_file(new_file_path)
-
             try:
-                file_real = download_drive_file(drive_id, ep["series_id"])
+                new_file_path = download_drive_file(drive_id, ep["series_id"])
             except Exception as e:
                 flash(str(e), "error")
                 conn.close()
                 return redirect(url_for("admin_edit_episode", episode_id=episode_id))
 
-            rel_path = os.path.relpath(file_real, BASE_DIR)
-            new_file_path = rel_path
             new_source_type = "gdrive"
+            cache_touch(new_file_path, hit=False, force=True)
             new_drive_id = drive_id
             new_video_url = None
 
@@ -1418,22 +5825,21 @@ def admin_edit_episode(episode_id):
                 conn.close()
                 return redirect(url_for("admin_edit_episode", episode_id=episode_id))
 
-            if new_source_type in ("gdrive", "upload"):
-                delete_old_file(new_file_path)
-
             filename = os.path.basename(file.filename)
             base, ext = os.path.splitext(filename)
             ext = ext.lower() or ".mp4"
 
-            series_dir = os.path.join(VIDEO_ROOT, f"series_{ep['series_id']}")
-            os.makedirs(series_dir, exist_ok=True)
-
-            safe_name = f"{base}_{int(datetime.utcnow().timestamp())}{ext}"
-            save_path = os.path.join(series_dir, safe_name)
+            os.makedirs(settings.BLOB_TMP_ROOT, exist_ok=True)
+            save_path = os.path.join(settings.BLOB_TMP_ROOT, f"upload_{os.urandom(8).hex()}{ext}")
             file.save(save_path)
 
-            rel_path = os.path.relpath(save_path, BASE_DIR)
-            new_file_path = rel_path
+            try:
+                new_file_path = blob_store_file(save_path, ext)
+            except MediaStorageError as e:
+                os.remove(save_path)
+                flash(str(e), "error")
+                conn.close()
+                return redirect(url_for("admin_edit_episode", episode_id=episode_id))
             new_source_type = "upload"
             new_video_url = None
             new_drive_id = None
@@ -1442,6 +5848,11 @@ def admin_edit_episode(episode_id):
             conn.close()
             return redirect(url_for("admin_edit_episode", episode_id=episode_id))
 
+        # ผูกไฟล์ใหม่ก่อนแล้วค่อยปล่อยไฟล์เดิม (ถ้าเป็นไฟล์เดียวกันจะไม่ถูกลบ)
+        if new_file_path != ep["file_path"]:
+            blob_acquire(conn, new_file_path)
+            release_video_file(conn, ep["file_path"], exclude_episode_id=episode_id)
+
         conn.execute(
             """
             UPDATE episodes
@@ -1464,29 +5875,14 @@ def admin_edit_episode(episode_id):
         old_thumb = ep["thumbnail_url"]
 
         if cover_file and cover_file.filename:
-            if old_thumb and not str(old_thumb).startswith("http"):
-                if not os.path.isabs(old_thumb):
-                    old_full = os.path.join(BASE_DIR, "static", old_thumb)
-                else:
-                    old_full = old_thumb
-                try:
-                    if os.path.exists(old_full):
-                        os.remove(old_full)
-                except Exception:
-                    pass
+            delete_cover(old_thumb)
 
             filename = os.path.basename(cover_file.filename)
             base2, ext2 = os.path.splitext(filename)
             ext2 = ext2.lower() or ".jpg"
 
-            ep_dir = os.path.join(EPISODE_COVER_ROOT, f"ep_{episode_id}")
-            os.makedirs(ep_dir, exist_ok=True)
-
             safe_name2 = f"ep_{episode_id}_{int(datetime.utcnow().timestamp())}{ext2}"
-            save_path2 = os.path.join(ep_dir, safe_name2)
-            cover_file.save(save_path2)
-
-            thumb_value = f"covers/episodes/ep_{episode_id}/{safe_name2}"
+            thumb_value = store_cover(cover_file, f"covers/episodes/ep_{episode_id}/{safe_name2}")
         elif thumbnail_url_input:
             thumb_value = thumbnail_url_input
 
@@ -1523,28 +5919,15 @@ def admin_delete_episode(episode_id):
     thumb = ep["thumbnail_url"]
     series_id = ep["series_id"]
 
-    if file_path:
-        if not os.path.isabs(file_path):
-            fp_full = os.path.join(BASE_DIR, file_path)
-        else:
-            fp_full = file_path
-        try:
-            if os.path.exists(fp_full):
-                os.remove(fp_full)
-        except Exception:
-            pass
+    # ลบไฟล์วิดีโอเมื่อไม่มีตอนอื่นใช้ไฟล์เดียวกันแล้ว
+    release_video_file(conn, file_path, exclude_episode_id=episode_id)
 
-    # ลบไฟล์ปกตอนถ้าเป็นไฟล์ใน static
-    if thumb and not str(thumb).startswith("http"):
-        thumb_full = os.path.join(BASE_DIR, "static", thumb)
+    # ลบไฟล์ปกตอนถ้าเป็นรูปที่อัปโหลดไว้ (รวมโฟลเดอร์ ep_... ของตอนนี้)
+    if is_stored_cover(thumb):
+        delete_cover(thumb)
         try:
-            if os.path.exists(thumb_full):
-                os.remove(thumb_full)
-            # ลบโฟลเดอร์เปล่า ep_... ด้วย
-            ep_dir = os.path.dirname(thumb_full)
-            if os.path.isdir(ep_dir) and not os.listdir(ep_dir):
-                os.rmdir(ep_dir)
-        except Exception:
+            cover_storage().delete_prefix(f"covers/episodes/ep_{episode_id}")
+        except (OSError, MediaStorageError):
             pass
 
     conn.execute("DELETE FROM episodes WHERE id = ?", (episode_id,))
@@ -1555,7 +5938,296 @@ def admin_delete_episode(episode_id):
     return redirect(url_for("admin_episodes", series_id=series_id))
 
 
+# ---------- แคชวิดีโอ (หน้าแอดมิน) ----------
+@app.route("/admin/cache")
+def admin_cache():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    stats = get_cache_stats()
+    conn = get_db_connection()
+    series_rows = conn.execute(
+        """
+        SELECT s.id, s.title, p.series_id IS NOT NULL AS pinned,
+               (
+                   SELECT COALESCE(SUM(c.size), 0) FROM video_cache c
+                   WHERE c.file_path IN (
+                       SELECT e.file_path FROM episodes e WHERE e.series_id = s.id
+                   )
+               ) AS cached_bytes
+        FROM series s
+        LEFT JOIN video_cache_pins p ON p.series_id = s.id
+        ORDER BY pinned DESC, cached_bytes DESC, datetime(s.created_at) DESC
+        """
+    ).fetchall()
+    conn.close()
+    return render_template("admin_cache.html", stats=stats, series_list=series_rows)
+
+
+@app.route("/admin/cache/series/<int:series_id>/pin", methods=["POST"])
+def admin_cache_toggle_pin(series_id):
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    conn = get_db_connection()
+    pinned = conn.execute(
+        "SELECT series_id FROM video_cache_pins WHERE series_id = ?", (series_id,)
+    ).fetchone()
+    if pinned:
+        conn.execute("DELETE FROM video_cache_pins WHERE series_id = ?", (series_id,))
+        flash("เลิกปักหมุดเรื่องนี้ในแคชแล้ว", "success")
+    else:
+        conn.execute(
+            "INSERT INTO video_cache_pins (series_id, pinned_at) VALUES (?, ?)",
+            (series_id, datetime.utcnow().isoformat()),
+        )
+        flash("ปักหมุดเรื่องนี้แล้ว ไฟล์ของเรื่องนี้จะไม่ถูกลบออกจากแคช", "success")
+    conn.commit()
+    conn.close()
+    return redirect(url_for("admin_cache"))
+
+
+@app.route("/admin/cache/trim", methods=["POST"])
+def admin_cache_trim():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    evicted = cache_enforce_quota()
+    flash(f"ลบไฟล์ออกจากแคช {evicted} ไฟล์", "success")
+    return redirect(url_for("admin_cache"))
+
+
+# ---------- รายงานแบนด์วิดท์ (หน้าแอดมิน) ----------
+@app.route("/admin/bandwidth")
+def admin_bandwidth():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    days = min(max(request.args.get("days", 7, type=int) or 7, 1), 90)
+    # ยอดที่ยังค้างใน worker นี้ลง DB ก่อน (worker อื่นจะตามมาภายใน BANDWIDTH_FLUSH_INTERVAL)
+    bandwidth_flush(force=True)
+    since_hour = bandwidth_since(days * 24)
+    since_day = since_hour[:10]
+
+    conn = get_db_connection()
+    totals = conn.execute(
+        """
+        SELECT COALESCE(SUM(bytes), 0) AS bytes, COALESCE(SUM(estimated_bytes), 0) AS estimated_bytes,
+               COALESCE(SUM(requests), 0) AS requests
+        FROM bandwidth_episode_hourly WHERE hour >= ?
+        """,
+        (since_hour,),
+    ).fetchone()
+    daily = conn.execute(
+        """
+        SELECT substr(hour, 1, 10) AS day, SUM(bytes) AS bytes, SUM(estimated_bytes) AS estimated_bytes,
+               SUM(requests) AS requests
+        FROM bandwidth_episode_hourly WHERE hour >= ?
+        GROUP BY day ORDER BY day DESC
+        """,
+        (since_hour,),
+    ).fetchall()
+    top_series = conn.execute(
+        """
+        SELECT b.series_id, s.title, SUM(b.bytes) AS bytes, SUM(b.estimated_bytes) AS estimated_bytes,
+               SUM(b.requests) AS requests
+        FROM bandwidth_episode_hourly b
+        LEFT JOIN series s ON s.id = b.series_id
+        WHERE b.hour >= ?
+        GROUP BY b.series_id ORDER BY bytes + estimated_bytes DESC LIMIT 20
+        """,
+        (since_hour,),
+    ).fetchall()
+    top_episodes = conn.execute(
+        """
+        SELECT b.episode_id, e.title, e.episode_number, s.title AS series_title,
+               SUM(b.bytes) AS bytes, SUM(b.estimated_bytes) AS estimated_bytes, SUM(b.requests) AS requests
+        FROM bandwidth_episode_hourly b
+        LEFT JOIN episodes e ON e.id = b.episode_id
+        LEFT JOIN series s ON s.id = b.series_id
+        WHERE b.hour >= ?
+        GROUP BY b.episode_id ORDER BY bytes + estimated_bytes DESC LIMIT 20
+        """,
+        (since_hour,),
+    ).fetchall()
+    top_users = conn.execute(
+        """
+        SELECT b.user_id, u.username, u.user_key, SUM(b.bytes) AS bytes,
+               SUM(b.estimated_bytes) AS estimated_bytes, SUM(b.requests) AS requests
+        FROM bandwidth_user_daily b
+        LEFT JOIN users u ON u.id = b.user_id
+        WHERE b.day >= ?
+        GROUP BY b.user_id ORDER BY bytes + estimated_bytes DESC LIMIT 20
+        """,
+        (since_day,),
+    ).fetchall()
+    conn.close()
+
+    return render_template(
+        "admin_bandwidth.html",
+        days=days,
+        totals=totals,
+        daily=daily,
+        top_series=top_series,
+        top_episodes=top_episodes,
+        top_users=top_users,
+        hot_series=hot_series_ids(),
+        hot_window_hours=settings.HOT_SERIES_WINDOW_HOURS,
+    )
+
+
+# ---------- Metrics (หน้าแอดมิน / Prometheus) ----------
+def metrics_token_ok() -> bool:
+    auth = request.headers.get("Authorization", "")
+    return bool(settings.METRICS_TOKEN) and hmac.compare_digest(auth, f"Bearer {settings.METRICS_TOKEN}")
+
+
+@app.route("/admin/metrics")
+def admin_metrics():
+    # Prometheus scrape ด้วย METRICS_TOKEN ได้ ไม่ต้องมี session แอดมิน
+    if not metrics_token_ok() and not admin_required():
+        return redirect(url_for("admin_login"))
+
+    return Response(
+        render_prometheus(load_metrics()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+@app.route("/admin/metrics.json")
+def admin_metrics_json():
+    if not metrics_token_ok() and not admin_required():
+        return redirect(url_for("admin_login"))
+
+    data = load_metrics()
+    return jsonify(
+        endpoints=metrics_summary(data),
+        in_flight=sum(data["inflight"].values()),
+        generated_at=datetime.utcnow().isoformat(),
+    )
+
+
+@app.route("/admin/slow-queries", methods=["GET", "POST"])
+def admin_slow_queries():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    conn = get_runtime_db()
+    if request.method == "POST":
+        conn.execute("DELETE FROM slow_queries")
+        conn.commit()
+        conn.close()
+        flash("ล้าง slow query log แล้ว", "success")
+        return redirect(url_for("admin_slow_queries"))
+
+    entries = conn.execute(
+        "SELECT * FROM slow_queries ORDER BY id DESC LIMIT ?", (settings.SLOW_QUERY_LOG_SIZE,)
+    ).fetchall()
+    conn.close()
+    return render_template(
+        "admin_slow_queries.html",
+        entries=entries,
+        slow_ms=settings.SQL_SLOW_MS,
+        budget=settings.SQL_QUERY_BUDGET,
+        enforce=settings.SQL_BUDGET_ENFORCE,
+    )
+
+
+# ---------- Profiler (หน้าแอดมิน) ----------
+@app.route("/admin/profiler", methods=["GET", "POST"])
+def admin_profiler():
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    conn = get_runtime_db()
+    if request.method == "POST":
+        action = request.form.get("action", "save")
+        if action == "clear":
+            for row in conn.execute("SELECT file FROM profiles").fetchall():
+                try:
+                    os.remove(os.path.join(settings.PROFILE_DIR, row["file"]))
+                except OSError:
+                    pass
+            conn.execute("DELETE FROM profiles")
+            flash("ลบ profile ทั้งหมดแล้ว", "success")
+        else:
+            mode = request.form.get("mode", "sampling")
+            if mode not in ("sampling", "cprofile"):
+                mode = "sampling"
+            try:
+                sample_rate = min(100.0, max(0.0, float(request.form.get("sample_percent", "10")))) / 100
+            except ValueError:
+                sample_rate = 0.1
+            endpoints = ",".join(
+                e.strip() for e in request.form.get("endpoints", "").split(",") if e.strip()
+            )
+            enabled = 1 if request.form.get("enabled") else 0
+            conn.execute(
+                """
+                INSERT INTO profiler_settings (id, enabled, mode, endpoints, sample_rate)
+                VALUES (1, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    enabled = excluded.enabled, mode = excluded.mode,
+                    endpoints = excluded.endpoints, sample_rate = excluded.sample_rate
+                """,
+                (enabled, mode, endpoints, sample_rate),
+            )
+            # worker นี้ใช้ค่าใหม่ทันที worker อื่นภายใน PROFILER_REFRESH_INTERVAL วินาที
+            _profiler_settings.pop(settings.RUNTIME_DB_PATH, None)
+            flash("บันทึกการตั้งค่า profiler แล้ว", "success")
+        conn.commit()
+        conn.close()
+        return redirect(url_for("admin_profiler"))
+
+    profiles = conn.execute("SELECT * FROM profiles ORDER BY id DESC LIMIT 100").fetchall()
+    conn.close()
+
+    return render_template(
+        "admin_profiler.html",
+        settings=load_profiler_settings(),
+        profiles=[dict(row, top=json.loads(row["top_functions"])) for row in profiles],
+        endpoints=sorted(current_app.view_functions),
+        refresh_interval=settings.PROFILER_REFRESH_INTERVAL,
+    )
+
+
+@app.route("/admin/profiler/<int:profile_id>/download")
+def admin_profiler_download(profile_id):
+    if not admin_required():
+        return redirect(url_for("admin_login"))
+
+    conn = get_runtime_db()
+    row = conn.execute("SELECT file FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+    conn.close()
+    if row is None:
+        abort(404)
+
+    path = os.path.abspath(os.path.join(settings.PROFILE_DIR, row["file"]))
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, as_attachment=True, download_name=row["file"])
+
+
 # ---------- ระบบสำรอง/คืนค่า ----------
+def count_missing_videos(conn: sqlite3.Connection) -> int:
+    """จำนวนไฟล์ของตอนแบบอัปโหลดที่ไม่มีในที่เก็บ (ไฟล์สำรองมีแค่ข้อมูล ไม่มีตัวไฟล์วิดีโอ)
+
+    ตอนแบบ gdrive ไม่นับ เพราะโหลดกลับมาเองตอนมีคนดู ถ้าถามที่เก็บไม่ได้คืน 0
+    """
+    rows = conn.execute(
+        """
+        SELECT DISTINCT file_path FROM episodes
+        WHERE source_type = 'upload' AND file_path IS NOT NULL AND file_path != ''
+        """
+    ).fetchall()
+    try:
+        storage = video_storage()
+        return sum(1 for row in rows if not storage.exists(row["file_path"]))
+    except MediaStorageError as e:
+        app.logger.warning("check restored videos failed: %s", e)
+        return 0
+
+
 @app.route("/admin/backup", methods=["GET", "POST"])
 def admin_backup():
     if not admin_required():
@@ -1595,8 +6267,6 @@ def admin_backup():
                 series_list = data.get("series", []) or []
                 episodes_list = data.get("episodes", []) or []
 
-                ensure_episode_thumbnail_column(conn)
-
                 if mode == "replace":
                     cur.execute("DELETE FROM episodes")
                     cur.execute("DELETE FROM series")
@@ -1607,112 +6277,79 @@ def admin_backup():
                     except Exception:
                         pass
 
-                for s in series_list:
-                    sid = s.get("id")
-                    if mode == "merge" and sid is not None:
-                        existing = cur.execute(
-                            "SELECT id FROM series WHERE id = ?", (sid,)
-                        ).fetchone()
-                    else:
-                        existing = None
-
-                    if existing:
-                        cur.execute(
-                            """
-                            UPDATE series
-                            SET title = ?, description = ?, thumbnail_url = ?, created_at = ?
-                            WHERE id = ?
-                            """,
-                            (
-                                s.get("title"),
-                                s.get("description"),
-                                s.get("thumbnail_url"),
-                                s.get("created_at") or datetime.utcnow().isoformat(),
-                                sid,
-                            ),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            INSERT INTO series (id, title, description, thumbnail_url, created_at)
-                            VALUES (?, ?, ?, ?, ?)
-                            """,
-                            (
-                                sid,
-                                s.get("title"),
-                                s.get("description"),
-                                s.get("thumbnail_url"),
-                                s.get("created_at") or datetime.utcnow().isoformat(),
-                            ),
+                # upsert ทีละตาราง: id ซ้ำ = อัปเดต (โหมด merge), ไม่มี id = เพิ่มแถวใหม่
+                cur.executemany(
+                    """
+                    INSERT INTO series (id, title, description, thumbnail_url, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        title = excluded.title,
+                        description = excluded.description,
+                        thumbnail_url = excluded.thumbnail_url,
+                        created_at = excluded.created_at
+                    """,
+                    [
+                        (
+                            s.get("id"),
+                            s.get("title"),
+                            s.get("description"),
+                            s.get("thumbnail_url"),
+                            s.get("created_at") or datetime.utcnow().isoformat(),
                         )
+                        for s in series_list
+                    ],
+                )
 
-                for ep in episodes_list:
-                    eid = ep.get("id")
-                    if mode == "merge" and eid is not None:
-                        existing = cur.execute(
-                            "SELECT id FROM episodes WHERE id = ?", (eid,)
-                        ).fetchone()
-                    else:
-                        existing = None
-
-                    row = (
-                        eid,
-                        ep.get("series_id"),
-                        ep.get("title"),
-                        ep.get("description"),
-                        ep.get("episode_number"),
-                        ep.get("source_type"),
-                        ep.get("video_url"),
-                        ep.get("drive_id"),
-                        ep.get("file_path"),
-                        ep.get("thumbnail_url"),
-                        ep.get("created_at") or datetime.utcnow().isoformat(),
+                cur.executemany(
+                    """
+                    INSERT INTO episodes (
+                        id, series_id, title, description, episode_number,
+                        source_type, video_url, drive_id, file_path,
+                        thumbnail_url, created_at
                     )
-
-                    if existing:
-                        cur.execute(
-                            """
-                            UPDATE episodes
-                            SET series_id = ?, title = ?, description = ?, episode_number = ?,
-                                source_type = ?, video_url = ?, drive_id = ?, file_path = ?,
-                                thumbnail_url = ?, created_at = ?
-                            WHERE id = ?
-                            """,
-                            (
-                                row[1],
-                                row[2],
-                                row[3],
-                                row[4],
-                                row[5],
-                                row[6],
-                                row[7],
-                                row[8],
-                                row[9],
-                                row[10],
-                                row[0],
-                            ),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            INSERT INTO episodes (
-                                id, series_id, title, description, episode_number,
-                                source_type, video_url, drive_id, file_path,
-                                thumbnail_url, created_at
-                            )
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """,
-                            row,
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        series_id = excluded.series_id,
+                        title = excluded.title,
+                        description = excluded.description,
+                        episode_number = excluded.episode_number,
+                        source_type = excluded.source_type,
+                        video_url = excluded.video_url,
+                        drive_id = excluded.drive_id,
+                        file_path = excluded.file_path,
+                        thumbnail_url = excluded.thumbnail_url,
+                        created_at = excluded.created_at
+                    """,
+                    [
+                        (
+                            ep.get("id"),
+                            ep.get("series_id"),
+                            ep.get("title"),
+                            ep.get("description"),
+                            ep.get("episode_number"),
+                            ep.get("source_type"),
+                            ep.get("video_url"),
+                            ep.get("drive_id"),
+                            ep.get("file_path"),
+                            ep.get("thumbnail_url"),
+                            ep.get("created_at") or datetime.utcnow().isoformat(),
                         )
+                        for ep in episodes_list
+                    ],
+                )
+
+                # จำนวนตอนที่อ้างถึงแต่ละไฟล์เปลี่ยนไปตามข้อมูลที่คืนค่า
+                blob_recount(conn)
 
                 msg = "คืนค่าข้อมูลวิดีโอจากไฟล์สำเร็จแล้ว"
+                missing = count_missing_videos(conn)
+                if missing:
+                    msg += f" (ไม่พบไฟล์วิดีโอที่อัปโหลดไว้ในที่เก็บ {missing} ไฟล์)"
 
             elif backup_type == "users":
                 users_list = data.get("users", []) or []
                 history_list = data.get("watch_history", []) or []
 
-                ensure_user_extra_columns(conn)
-
                 if mode == "replace":
                     cur.execute("DELETE FROM watch_history")
                     cur.execute("DELETE FROM users")
@@ -1723,93 +6360,54 @@ def admin_backup():
                     except Exception:
                         pass
 
-                for u in users_list:
-                    uid = u.get("id")
-                    if mode == "merge" and uid is not None:
-                        existing = cur.execute(
-                            "SELECT id FROM users WHERE id = ?", (uid,)
-                        ).fetchone()
-                    else:
-                        existing = None
-
-                    username = u.get("username")
-                    password = u.get("password")
-                    plain_password = u.get("plain_password")
-                    user_key = u.get("user_key")
-                    created_at = u.get("created_at") or datetime.utcnow().isoformat()
-
-                    if existing:
-                        cur.execute(
-                            """
-                            UPDATE users
-                            SET username = ?, password = ?, plain_password = ?, user_key = ?, created_at = ?
-                            WHERE id = ?
-                            """,
-                            (
-                                username,
-                                password,
-                                plain_password,
-                                user_key,
-                                created_at,
-                                uid,
-                            ),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            INSERT INTO users (id, username, password, plain_password, user_key, created_at)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                            """,
-                            (
-                                uid,
-                                username,
-                                password,
-                                plain_password,
-                                user_key,
-                                created_at,
-                            ),
+                cur.executemany(
+                    """
+                    INSERT INTO users (id, username, password, plain_password, user_key, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        username = excluded.username,
+                        password = excluded.password,
+                        plain_password = excluded.plain_password,
+                        user_key = excluded.user_key,
+                        created_at = excluded.created_at
+                    """,
+                    [
+                        (
+                            u.get("id"),
+                            u.get("username"),
+                            u.get("password"),
+                            u.get("plain_password"),
+                            u.get("user_key"),
+                            u.get("created_at") or datetime.utcnow().isoformat(),
                         )
+                        for u in users_list
+                    ],
+                )
 
-                for h in history_list:
-                    hid = h.get("id")
-                    if mode == "merge" and hid is not None:
-                        existing = cur.execute(
-                            "SELECT id FROM watch_history WHERE id = ?", (hid,)
-                        ).fetchone()
-                    else:
-                        existing = None
-
-                    row = (
-                        hid,
-                        h.get("user_id"),
-                        h.get("series_id"),
-                        h.get("episode_id"),
-                        h.get("watched_at") or datetime.utcnow().isoformat(),
-                    )
-
-                    if existing:
-                        cur.execute(
-                            """
-                            UPDATE watch_history
-                            SET user_id = ?, series_id = ?, episode_id = ?, watched_at = ?
-                            WHERE id = ?
-                            """,
-                            (
-                                row[1],
-                                row[2],
-                                row[3],
-                                row[4],
-                                row[0],
-                            ),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            INSERT INTO watch_history (id, user_id, series_id, episode_id, watched_at)
-                            VALUES (?, ?, ?, ?, ?)
-                            """,
-                            row,
+                cur.executemany(
+                    """
+                    INSERT INTO watch_history (id, user_id, series_id, episode_id, watched_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        user_id = excluded.user_id,
+                        series_id = excluded.series_id,
+                        episode_id = excluded.episode_id,
+                        watched_at = excluded.watched_at
+                    """,
+                    [
+                        (
+                            h.get("id"),
+                            h.get("user_id"),
+                            h.get("series_id"),
+                            h.get("episode_id"),
+                            h.get("watched_at") or datetime.utcnow().isoformat(),
                         )
+                        for h in history_list
+                    ],
+                )
+
+                # ไฟล์สำรองรุ่นเก่าอาจไม่มี user_key
+                backfill_user_keys(cur)
 
                 msg = "คืนค่าข้อมูลบัญชีผู้ใช้และประวัติการดูจากไฟล์สำเร็จแล้ว"
 
@@ -1862,7 +6460,6 @@ def admin_backup_download_users():
         return redirect(url_for("admin_login"))
 
     conn = get_db_connection()
-    ensure_user_extra_columns(conn)
     users = conn.execute("SELECT * FROM users").fetchall()
     history = conn.execute("SELECT * FROM watch_history").fetchall()
     conn.close()
@@ -1913,6 +6510,268 @@ def admin_backup_download():
 
 
 
+# ---------- App factory / การบูต worker ----------
+# import โมดูลนี้แค่ประกาศ route เท่านั้น ไม่แตะดิสก์หรือ DB
+# งานตอนเริ่มระบบ (สร้างโฟลเดอร์, ตรวจ schema, warm-up) อยู่ใน create_app()
+# ใช้กับ gunicorn --preload ได้: process แม่เรียก create_app() ครั้งเดียวก่อน fork
+# (ไม่มี connection SQLite ค้างอยู่ตอน fork) แล้ว worker ทุกตัวได้โมดูล/cache ที่อุ่นไว้แล้วไปใช้เลย
+
+# ค่าตั้งใน app.config (ค่าเริ่มต้นอ่านจาก env ด้านล่าง) ที่ create_app(config) เขียนทับได้
+CONFIG_OVERRIDES = (
+    "DB_PATH",
+    "VIDEO_ROOT",
+    "BLOB_ROOT",
+    "BLOB_TMP_ROOT",
+    "MEDIA_STORAGE",
+    "S3_BUCKET",
+    "S3_PREFIX",
+    "S3_ENDPOINT_URL",
+    "S3_REGION",
+    "S3_ACCESS_KEY_ID",
+    "S3_SECRET_ACCESS_KEY",
+    "S3_MULTIPART_CHUNK_SIZE",
+    "S3_UPLOAD_CONCURRENCY",
+    "S3_MAX_CONNECTIONS",
+    "S3_STAT_CACHE_TTL",
+    "VIDEO_CACHE_QUOTA_BYTES",
+    "VIDEO_CACHE_TOUCH_INTERVAL",
+    "DRIVE_DOWNLOAD_URL",
+    "DRIVE_DOWNLOAD_SEGMENTS",
+    "PREFETCH_DEPTH",
+    "PREFETCH_CONCURRENCY",
+    "PREFETCH_BANDWIDTH_BYTES",
+    "PREFETCH_QUEUE_LIMIT",
+    "PREFETCH_DEPTH_HOT",
+    "STREAM_CHUNK_SIZE",
+    "BANDWIDTH_FLUSH_INTERVAL",
+    "HOT_SERIES_WINDOW_HOURS",
+    "HOT_SERIES_COUNT",
+    "STREAM_MAX_CONCURRENT",
+    "STREAM_USER_RATE_BYTES",
+    "STREAM_USER_BURST_BYTES",
+    "STREAM_TOKEN_GRANT_BYTES",
+    "STREAM_RATE_MAX_WAIT",
+    "STREAM_LEASE_TTL",
+    "STREAM_LEASE_IDLE_GRACE",
+    "STREAM_TOKEN_KEYS",
+    "STREAM_TOKEN_TTL",
+    "STREAM_OFFLOAD",
+    "STREAM_OFFLOAD_PREFIX",
+    "CACHE_CHECK_INTERVAL",
+    "API_PAGE_SIZE",
+    "API_MAX_PAGE_SIZE",
+    "SUGGEST_LIMIT",
+    "ADMIN_USERS_PAGE_SIZE",
+    "PASSWORD_HASH_METHOD",
+    "PASSWORD_HASH_WORKERS",
+    "PASSWORD_HASH_QUEUE_LIMIT",
+    "PASSWORD_HASH_TIMEOUT",
+    "COMPRESS_ENABLED",
+    "COMPRESS_MIN_SIZE",
+    "COMPRESS_GZIP_LEVEL",
+    "COMPRESS_BROTLI_QUALITY",
+    "COMPRESS_BUFFER_MAX",
+    "COMPRESS_CACHE_BYTES",
+    "AUTO_MIGRATE",
+    "TURNSTILE_SITE_KEY",
+    "TURNSTILE_SECRET_KEY",
+    "WARM_UP",
+    "JINJA_BYTECODE_CACHE",
+    "JINJA_CACHE_DIR",
+    "TEMPLATE_PRECOMPILE",
+    "RUNTIME_DB_PATH",
+    "METRICS_ENABLED",
+    "METRICS_FLUSH_INTERVAL",
+    "METRICS_TOKEN",
+    "SQL_SLOW_MS",
+    "SLOW_QUERY_LOG_SIZE",
+    "SQL_TRACE",
+    "SQL_QUERY_BUDGET",
+    "SQL_BUDGET_ENFORCE",
+    "PROFILE_DIR",
+    "PROFILE_KEEP",
+    "PROFILER_REFRESH_INTERVAL",
+    "PROFILER_SAMPLE_INTERVAL",
+)
+
+# 0 = ไม่ warm-up ตอนบูต (โมดูล/cache จะถูกโหลดตอนมี request แรกแทน)
+WARM_UP = os.environ.get("WARM_UP", "1") != "0"
+
+# แคช bytecode ของ template บนดิสก์ ใช้ร่วมกันทุก worker และอยู่ข้ามการรีสตาร์ท (0 = ปิด)
+JINJA_BYTECODE_CACHE = os.environ.get("JINJA_BYTECODE_CACHE", "1") != "0"
+JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR", os.path.join(BASE_DIR, ".jinja_cache"))
+# compile template ทุกไฟล์ใน templates/ ตอนบูต (0 = compile ตอนถูกเรียกใช้ครั้งแรก)
+TEMPLATE_PRECOMPILE = os.environ.get("TEMPLATE_PRECOMPILE", "1") != "0"
+
+# ค่าเริ่มต้นของ app.config ทุกแอป (แอปที่ create_app(config) สร้างเริ่มจากชุดนี้แล้วเขียนทับด้วย config)
+app.config.update({key: globals()[key] for key in CONFIG_OVERRIDES})
+
+_boot_lock = threading.Lock()
+
+
+def _clone_app(config: dict) -> Flask:
+    """Flask app ใหม่ที่มี route / hook / error handler ชุดเดียวกับ ``app`` แต่ค่าตั้งเป็นของตัวเอง"""
+    flask_app = Flask(__name__)
+    flask_app.config.update(app.config)
+    flask_app.config.update(config)
+    # path ที่คำนวณจาก VIDEO_ROOT ต้องตามไปด้วย ถ้าไม่ได้กำหนดเอง
+    if "VIDEO_ROOT" in config:
+        if "BLOB_ROOT" not in config:
+            flask_app.config["BLOB_ROOT"] = os.path.join(config["VIDEO_ROOT"], "blobs")
+        if "BLOB_TMP_ROOT" not in config:
+            flask_app.config["BLOB_TMP_ROOT"] = os.path.join(config["VIDEO_ROOT"], "tmp")
+
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint != "static":
+            flask_app.url_map.add(rule.empty())
+            flask_app.view_functions[rule.endpoint] = app.view_functions[rule.endpoint]
+    for name in (
+        "before_request_funcs", "after_request_funcs", "teardown_request_funcs",
+        "template_context_processors", "url_value_preprocessors", "url_default_functions",
+    ):
+        setattr(flask_app, name, {scope: list(funcs) for scope, funcs in getattr(app, name).items()})
+    flask_app.teardown_appcontext_funcs[:] = app.teardown_appcontext_funcs
+    for scope, handlers in app.error_handler_spec.items():
+        for code, by_class in handlers.items():
+            flask_app.error_handler_spec[scope][code].update(by_class)
+    flask_app.jinja_env.filters.update(app.jinja_env.filters)
+    flask_app.cli.commands.update(app.cli.commands)
+    _install_middleware(flask_app)
+    return flask_app
+
+
+def warm_up(flask_app: Flask):
+    """โหลดโมดูลที่ใช้เวลา import นานไว้ล่วงหน้า จะได้ไม่ไปหน่วง request แรก (ต้องอยู่ใน app context)"""
+    import requests  # noqa: F401 (ใช้ตรวจ Turnstile และโหลดไฟล์ Drive)
+
+    try:
+        import gdown  # noqa: F401
+    except ImportError:
+        pass
+
+    # สร้าง jinja environment และ url map ไว้ก่อน
+    flask_app.jinja_env
+    with flask_app.test_request_context():
+        url_for("index")
+
+    # โหลด catalog ใน process แม่ worker ที่ fork ออกไปได้ snapshot นี้ไปใช้เลย
+    get_catalog()
+    close_cache_watchers()
+
+
+def configure_template_cache(flask_app: Flask):
+    """ตั้งค่า bytecode cache ของ Jinja ตาม JINJA_BYTECODE_CACHE / JINJA_CACHE_DIR ของแอป"""
+    config = flask_app.config
+    if config["JINJA_BYTECODE_CACHE"] and config["JINJA_CACHE_DIR"]:
+        from jinja2 import FileSystemBytecodeCache
+
+        os.makedirs(config["JINJA_CACHE_DIR"], exist_ok=True)
+        # jinja เขียนไฟล์ cache แบบ temp + rename หลาย worker ใช้โฟลเดอร์เดียวกันได้
+        flask_app.jinja_env.bytecode_cache = FileSystemBytecodeCache(config["JINJA_CACHE_DIR"])
+    else:
+        flask_app.jinja_env.bytecode_cache = None
+
+
+def precompile_templates(flask_app: Flask) -> int:
+    """โหลด template ทุกไฟล์เข้า cache ของ jinja (และเขียน bytecode ลงดิสก์) คืนจำนวนไฟล์"""
+    names = [name for name in flask_app.jinja_env.list_templates() if name.endswith(".html")]
+    for name in names:
+        flask_app.jinja_env.get_template(name)
+    return len(names)
+
+
+def _boot(flask_app: Flask):
+    """งานตอนเริ่มระบบของแอป (ทำครั้งเดียวต่อแอป)"""
+    with _boot_lock:
+        if flask_app.extensions.get("myseries.booted"):
+            return
+        with flask_app.app_context():
+            if settings.STREAM_OFFLOAD == "sendfile" and settings.STREAM_USER_RATE_BYTES > 0:
+                # X-Sendfile ไม่มี header คุมความเร็วแบบ X-Accel-Limit-Rate ผู้ใช้จะโหลดได้เต็มท่อ
+                raise RuntimeError(
+                    "STREAM_OFFLOAD=sendfile จำกัดแบนด์วิดท์ต่อผู้ใช้ไม่ได้ "
+                    "ใช้ STREAM_OFFLOAD=nginx หรือปิด STREAM_USER_RATE_BYTES"
+                )
+            os.makedirs(settings.VIDEO_ROOT, exist_ok=True)
+            os.makedirs(COVER_ROOT, exist_ok=True)
+            os.makedirs(EPISODE_COVER_ROOT, exist_ok=True)
+
+            init_db()
+            configure_template_cache(flask_app)
+            if settings.TEMPLATE_PRECOMPILE:
+                precompile_templates(flask_app)
+            if settings.WARM_UP:
+                warm_up(flask_app)
+        flask_app.extensions["myseries.booted"] = True
+
+
+def create_app(config: dict | None = None):
+    """เตรียมแอปให้พร้อมรับ request แล้วคืน Flask app
+
+    ไม่ส่ง ``config`` = ใช้ ``app`` ระดับโมดูล (ค่าตั้งจาก env) ส่ง ``config`` = สร้างแอปใหม่ที่มี route ชุดเดียวกัน
+    แต่ ``app.config`` เป็นค่าเริ่มต้นที่เขียนทับด้วย ``config`` (เช่น DB_PATH, VIDEO_ROOT)
+    แอปหลายตัวใน process เดียวกัน (เช่นตอนทดสอบที่ใช้ DB คนละไฟล์) จึงไม่ทับค่าตั้งกัน
+
+    ใช้กับ gunicorn: ``gunicorn -c gunicorn.conf.py`` (preload + app:create_app())
+    """
+    flask_app = _clone_app(config) if config else app
+    _boot(flask_app)
+    return flask_app
+
+
+@app.before_request
+def ensure_booted():
+    # รองรับการรันแบบเดิม (gunicorn app:app) ที่ไม่ได้เรียก create_app()
+    if not current_app.extensions.get("myseries.booted"):
+        _boot(current_app._get_current_object())
+
+
+def _reset_after_fork():
+    # thread และ lock จาก process แม่ใช้ต่อใน process ลูกไม่ได้ ให้เริ่มใหม่หมด
+    global _prefetch_lock, _drive_inflight_lock, _cache_lock
+    global _boot_lock, _metrics_lock, _bandwidth_lock, _stream_limit_lock
+    global _catalog_lock, _cache_coherence_lock, _compress_cache_lock, _suggest_lock
+    global _password_pool, _password_pool_lock, _password_inflight, _media_storage_lock
+
+    _prefetch_executors.clear()
+    _prefetch_lock = threading.Lock()
+    _prefetch_pending.clear()
+    _drive_inflight_lock = threading.Lock()
+    _drive_inflight.clear()
+    _cache_lock = threading.Lock()
+    _cache_pending.clear()
+    _boot_lock = threading.Lock()
+    # ตัวเลขที่ process แม่สะสมไว้ถูก flush โดยแม่เอง ลูกเริ่มนับจากศูนย์
+    _metrics_lock = threading.Lock()
+    _metrics_requests.clear()
+    _metrics_latency.clear()
+    _metrics_inflight.clear()
+    _bandwidth_lock = threading.Lock()
+    _bandwidth_episodes.clear()
+    _bandwidth_users.clear()
+    _stream_limit_lock = threading.Lock()
+    _playbacks.clear()
+    _stream_blocked.clear()
+    _catalog_lock = threading.Lock()
+    _suggest_lock = threading.Lock()
+    # connection เฝ้า data_version ผูกกับ pid ลูกจะเปิดของตัวเองตอนตรวจครั้งแรก
+    _cache_coherence_lock = threading.Lock()
+    _compress_cache_lock = threading.Lock()
+    # pool ของ process แม่ใช้ในลูกไม่ได้ (process ลูกของ pool เป็นของแม่) ลูกสร้างของตัวเองตอนใช้ครั้งแรก
+    _password_pool = None
+    _password_pool_lock = threading.Lock()
+    _password_inflight = 0
+    # connection pool ของ boto3 ใช้ socket ร่วมกับแม่ ลูกสร้าง client ของตัวเองตอนใช้ครั้งแรก
+    _media_storage_lock = threading.Lock()
+    _media_storages.clear()
+    _prefetch_limiters.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    create_app()
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,295 @@
+"""
+โหมดเสิร์ฟแบบ ASGI สำหรับสตรีมวิดีโอ
+
+/stream/<episode_id> ส่งไฟล์ด้วย asyncio (อ่านไฟล์ผ่าน thread pool เล็ก ๆ แล้วส่งต่อแบบไม่บล็อก)
+ผู้ชมหนึ่งคนจึงไม่กิน worker/thread ตลอดความยาววิดีโอ ส่วน path อื่นทั้งหมดส่งต่อให้แอป Flask เดิม
+ไฟล์ในเครื่องอ่านด้วย pread ส่วนที่เก็บแบบ S3 อ่านผ่าน ranged GET ของ MEDIA_STORAGE ทีละก้อน
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.http import parse_cookie, parse_range_header
+
+import app as appmod
+
+# ขนาดก้อนที่อ่านจากไฟล์ต่อครั้ง
+STREAM_CHUNK_SIZE = int(os.environ.get("ASGI_STREAM_CHUNK_SIZE", str(256 * 1024)))
+# จำนวน thread สำหรับอ่านไฟล์วิดีโอ (ใช้ร่วมกันทุกสตรีม)
+STREAM_IO_THREADS = int(os.environ.get("ASGI_STREAM_IO_THREADS", "16"))
+# จำนวน thread ที่รันหน้าเว็บ Flask ปกติ
+WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", "16"))
+
+_STREAM_PATH = re.compile(r"^/stream/(\d+)$")
+
+flask_app = appmod.create_app()
+_wsgi = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+_io_executor = ThreadPoolExecutor(max_workers=STREAM_IO_THREADS, thread_name_prefix="stream-io")
+
+
+def _in_app(fn, *args):
+    """เรียก fn(*args) ใน app context ของ flask_app (ฟังก์ชันของแอปอ่านค่าตั้งจาก current_app.config)"""
+    with flask_app.app_context():
+        return fn(*args)
+
+
+def _header(scope, name: bytes) -> str | None:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def session_user_id(scope):
+    """อ่าน user_id จาก session cookie ของ Flask (ตรวจลายเซ็นเหมือน SecureCookieSessionInterface)"""
+    cookie_header = _header(scope, b"cookie")
+    if not cookie_header:
+        return None
+
+    value = parse_cookie(cookie_header).get(flask_app.config["SESSION_COOKIE_NAME"])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if not value or serializer is None:
+        return None
+
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+    try:
+        data = serializer.loads(value, max_age=max_age)
+    except BadSignature:
+        return None
+    return data.get("user_id")
+
+
+async def _send_http_exception(send, exc: HTTPException):
+    response = exc.get_response()
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [
+            (key.lower().encode("latin-1"), value.encode("latin-1"))
+            for key, value in response.headers.items()
+        ],
+    })
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+
+async def stream_episode(scope, receive, send, episode_id: int, user_id: int, claims=None):
+    # metrics ของสตรีมฝั่ง ASGI นับรวมใน endpoint เดียวกับ Flask
+    started = time.perf_counter()
+    status, sent = 500, 0
+    metrics = flask_app.config["METRICS_ENABLED"]
+    if metrics:
+        _in_app(appmod.metrics_request_started, "stream_episode")
+    try:
+        status, sent = await _stream_file(scope, receive, send, episode_id, user_id, claims)
+    finally:
+        if metrics:
+            _in_app(
+                appmod.metrics_request_finished,
+                "stream_episode", scope["method"], status, time.perf_counter() - started, sent,
+            )
+
+
+async def _stream_file(scope, receive, send, episode_id: int, user_id: int, claims=None):
+    """ส่งไฟล์ของตอน คืน (status, จำนวนไบต์ของ body ที่ส่งไป) และบันทึกแบนด์วิดท์ของตอน/ผู้ใช้"""
+    try:
+        lease = await asyncio.to_thread(_in_app, appmod.acquire_stream, user_id, episode_id)
+    except appmod.StreamLimitExceeded as exc:
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"retry-after", str(exc.retry_after).encode("latin-1")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": str(exc).encode("utf-8")})
+        return 429, 0
+
+    try:
+        file_path = None
+        try:
+            if claims is not None:
+                # ลิงก์แบบลงชื่อ: ใช้ path ใน token และ is_active จาก catalog ในหน่วยความจำ ไม่แตะ videos.db
+                file_path = await asyncio.to_thread(_in_app, appmod.stream_token_file, claims)
+                episode = {"id": claims["e"], "series_id": claims["s"]}
+            if file_path is None:
+                # เช็ก is_active / ดาวน์โหลดไฟล์ Drive ที่หายไป ด้วยโค้ดเดียวกับ Flask (อาจบล็อกนาน จึงรันใน thread)
+                file_path, episode = await asyncio.to_thread(_in_app, appmod.resolve_stream_file, episode_id)
+        except HTTPException as exc:
+            await _send_http_exception(send, exc)
+            return exc.code, 0
+
+        storage = _in_app(appmod.video_storage)
+        abs_path = storage.local_path(file_path)
+        if abs_path is None:
+            status, sent = await _send_object(scope, receive, send, storage, file_path, lease)
+        else:
+            try:
+                fd = os.open(abs_path, os.O_RDONLY)
+            except OSError:
+                await _send_http_exception(send, NotFound())
+                return 404, 0
+            status, sent = await _send_fd(scope, receive, send, fd, lease)
+    finally:
+        if lease is not None:
+            await asyncio.to_thread(appmod.release_stream, lease)
+    # flush ลง videos.db อาจบล็อก จึงรันใน thread
+    await asyncio.to_thread(
+        _in_app, appmod.bandwidth_record, episode["id"], episode["series_id"], user_id, sent
+    )
+    return status, sent
+
+
+def _fd_chunks(fd: int, start: int, end: int):
+    offset = start
+    while offset < end:
+        chunk = os.pread(fd, min(STREAM_CHUNK_SIZE, end - offset), offset)
+        if not chunk:
+            # ไฟล์ถูกตัดสั้นระหว่างส่ง ปิดการตอบกลับเท่าที่มี
+            return
+        offset += len(chunk)
+        yield chunk
+
+
+async def _send_fd(scope, receive, send, fd: int, lease=None):
+    """ส่งไฟล์จาก fd (รองรับ Range/HEAD) คืน (status, ไบต์ที่ส่งสำเร็จ) และปิด fd เมื่อจบ"""
+    try:
+        st = os.fstat(fd)
+        return await _send_chunks(
+            scope, receive, send, st.st_size, st.st_mtime,
+            lambda start, end: _fd_chunks(fd, start, end), lease,
+        )
+    finally:
+        os.close(fd)
+
+
+async def _send_object(scope, receive, send, storage, key: str, lease=None):
+    """ส่งไฟล์จากที่เก็บที่ไม่ใช่ดิสก์ในเครื่อง (S3): GET ช่วงที่ขอครั้งเดียวแล้วส่งต่อทีละก้อน"""
+    try:
+        info = await asyncio.to_thread(storage.stat, key)
+    except appmod.MediaStorageError:
+        info = None
+    if info is None:
+        await _send_http_exception(send, NotFound())
+        return 404, 0
+    return await _send_chunks(
+        scope, receive, send, info.size, info.mtime,
+        lambda start, end: storage.open_range(key, start, end, STREAM_CHUNK_SIZE), lease,
+    )
+
+
+async def _send_chunks(scope, receive, send, size: int, mtime: float, open_chunks, lease=None):
+    """ส่ง header ตาม Range/HEAD แล้วส่งก้อนจาก ``open_chunks(start, end)`` (อ่านใน thread pool ทีละก้อน)"""
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                return
+
+    watcher = asyncio.create_task(watch_disconnect())
+    status = start = offset = 0
+    chunks = None
+    try:
+        headers = [
+            (b"content-type", b"video/mp4"),
+            (b"accept-ranges", b"bytes"),
+            (b"last-modified", formatdate(mtime, usegmt=True).encode("latin-1")),
+        ]
+
+        status, start, end = 200, 0, size
+        range_header = _header(scope, b"range")
+        if range_header:
+            requested = parse_range_header(range_header)
+            if requested is not None:
+                span = requested.range_for_length(size)
+                if span is None:
+                    headers.append((b"content-range", f"bytes */{size}".encode("latin-1")))
+                    await send({"type": "http.response.start", "status": 416, "headers": headers})
+                    await send({"type": "http.response.body", "body": b""})
+                    return 416, 0
+                status, (start, end) = 206, span
+                headers.append((b"content-range", f"bytes {start}-{end - 1}/{size}".encode("latin-1")))
+
+        headers.append((b"content-length", str(end - start).encode("latin-1")))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if scope["method"] == "HEAD" or start >= end:
+            await send({"type": "http.response.body", "body": b""})
+            return status, 0
+
+        loop = asyncio.get_running_loop()
+        offset = start
+        chunks = open_chunks(start, end)
+        while offset < end and not disconnected.is_set():
+            chunk = await loop.run_in_executor(_io_executor, next, chunks, None)
+            if not chunk:
+                break
+            if lease is not None:
+                # คุมแบนด์วิดท์ต่อผู้ใช้ (ขอ token จาก runtime.db เป็นครั้งคราว จึงรันใน thread)
+                wait = await asyncio.to_thread(lease.consume, len(chunk))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            # send รอจน socket ว่าง (flow control ของ server) ผู้ชมที่ดูช้าจึงไม่ทำให้บัฟเฟอร์บวม
+            await send({"type": "http.response.body", "body": chunk, "more_body": offset + len(chunk) < end})
+            offset += len(chunk)
+
+        if offset < end and not disconnected.is_set():
+            await send({"type": "http.response.body", "body": b""})
+    except (OSError, appmod.MediaStorageError):
+        # ผู้ชมปิดการเชื่อมต่อ หรืออ่านจากที่เก็บไม่ได้ระหว่างส่ง
+        pass
+    finally:
+        watcher.cancel()
+        if chunks is not None:
+            # ปิดไฟล์ / คืน connection ของ S3 (ถ้าถูกยกเลิกระหว่างอ่าน ก้อนนั้นยังค้างใน thread ให้ GC ปิดแทน)
+            try:
+                chunks.close()
+            except ValueError:
+                pass
+    return status, offset - start
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            _io_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+
+    # STREAM_OFFLOAD: proxy ด้านหน้าส่งไฟล์เอง ให้ Flask ตอบแค่ header (ไม่ต้องส่งไฟล์แบบ async)
+    if scope["type"] == "http" and scope["method"] in ("GET", "HEAD") and not flask_app.config["STREAM_OFFLOAD"]:
+        match = _STREAM_PATH.match(scope["path"])
+        if match:
+            episode_id = int(match.group(1))
+            token = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("st", [None])[0]
+            claims = _in_app(appmod.verify_stream_token, token, episode_id)
+            if claims is not None:
+                await stream_episode(scope, receive, send, episode_id, claims["u"], claims)
+                return
+            # ยังไม่ล็อกอิน ให้ Flask จัดการ (redirect ไปหน้าเข้าสู่ระบบพร้อม flash เหมือนเดิม)
+            user_id = session_user_id(scope)
+            if user_id:
+                await stream_episode(scope, receive, send, episode_id, user_id)
+                return
+
+    await _wsgi(scope, receive, send)
@@ -0,0 +1,2000 @@
+"""
+สคริปต์วัดประสิทธิภาพของ MySeriesVideo (รันแยกจากเซิร์ฟเวอร์จริง ใช้ DB/โฟลเดอร์ชั่วคราวเสมอ)
+
+    python bench.py routes      # p50/p95/p99, จำนวน query และ RSS ของทุก route บน DB จำลองขนาดใหญ่
+    python bench.py startup     # เวลา import, create_app() และ request แรกของ worker ใหม่
+    python bench.py templates   # เวลา render template แบบ cold / bytecode cache / in-memory
+    python bench.py stream-concurrency  # ผู้ชมพร้อมกันที่รับได้: gunicorn (sync) เทียบ uvicorn asgi:app
+    python bench.py stream-load # MB/s, TTFB, RSS ต่อการเชื่อมต่อ ภายใต้ Range request พร้อมกัน (--drive = ผ่านการโหลดซ้ำ)
+    python bench.py stream-token  # ต้นทุนต่อ Range request: session + DB เทียบลิงก์สตรีมแบบลงชื่อ
+    python bench.py download    # ตรวจตัวโหลดไฟล์ Drive แบบหลายช่วง (โหลดต่อ, ช่วงที่หลุด, ไม่มี Range, HTML) + MB/s
+    python bench.py storage     # MB/s ของที่เก็บไฟล์ local เทียบ S3 (MinIO / moto ในเครื่อง): put, ranged GET, /stream
+    python bench.py offload     # ตรวจ nginx.conf.example กับ nginx จริง + MB/s และ CPU ของ worker เมื่อ nginx ส่งไฟล์เอง
+    python bench.py login-burst # ล็อกอินพร้อมกันจำนวนมากระหว่างมีผู้ชม: แฮชรหัสผ่านใน request เทียบ process pool
+    python bench.py user-search # ค้นหาผู้ใช้ในหน้าแอดมินบน users 1M แถว: LIKE เดิม เทียบ trigram + key prefix
+    python bench.py compression # gzip/brotli ต่อ route: ไบต์ที่ประหยัดได้ เทียบ CPU ที่ใช้บีบ (และเมื่อได้จากแคช)
+    python bench.py coherence   # หลาย process: แคชในหน่วยความจำเห็นการแก้ไขของ process อื่น (และไม่ล้างเกินจำเป็น)
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def _percentiles(samples):
+    """p50/p95/p99 (มิลลิวินาที)"""
+    if len(samples) < 2:
+        value = _ms(samples[0]) if samples else None
+        return {"p50_ms": value, "p95_ms": value, "p99_ms": value}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50_ms": _ms(cuts[49]), "p95_ms": _ms(cuts[94]), "p99_ms": _ms(cuts[98])}
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss บน Linux เป็น KB
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _git_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def _print_table(rows, columns):
+    widths = [max(len(str(col)), *(len(str(r.get(col, ""))) for r in rows)) for col in columns]
+    print("  ".join(str(col).ljust(w) for col, w in zip(columns, widths)))
+    for r in rows:
+        print("  ".join(str(r.get(col, "")).ljust(w) for col, w in zip(columns, widths)))
+
+
+# ---------- routes: ทุกหน้าผ่าน test client บน DB จำลอง ----------
+
+def _seed_catalog(appmod, application, tmp, args):
+    """เติมข้อมูลจำลองตามขนาดที่กำหนดลง DB ของ ``application`` ทุกตอนชี้ไปที่ไฟล์วิดีโอเล็ก ๆ ไฟล์เดียว"""
+    video_path = os.path.join(tmp, "bench.mp4")
+    with open(video_path, "wb") as f:
+        f.write(os.urandom(1024 * 1024))
+
+    def stamp(i):
+        return f"2024-{1 + i % 12:02d}-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:00"
+
+    with application.app_context():
+        conn = appmod.get_db_connection()
+    conn.executemany(
+        "INSERT INTO series (id, title, description, thumbnail_url, created_at) VALUES (?, ?, ?, ?, ?)",
+        (
+            (i, f"ซีรีส์ทดสอบ {i}", f"เรื่องย่อของซีรีส์ {i} " * 5, f"/covers/{i}.jpg", stamp(i))
+            for i in range(1, args.series + 1)
+        ),
+    )
+    conn.executemany(
+        """
+        INSERT INTO episodes (id, series_id, title, description, episode_number, source_type, file_path, created_at)
+        VALUES (?, ?, ?, ?, ?, 'upload', ?, ?)
+        """,
+        (
+            (
+                (sid - 1) * args.episodes + n, sid, f"ตอนที่ {n}", f"รายละเอียดตอน {n}",
+                n, video_path, stamp(n),
+            )
+            for sid in range(1, args.series + 1)
+            for n in range(1, args.episodes + 1)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO users (id, username, password, created_at) VALUES (?, ?, '-', ?)",
+        ((i, f"user{i}", stamp(i)) for i in range(1, args.users + 1)),
+    )
+    appmod.backfill_user_keys(conn)
+    total_episodes = args.series * args.episodes
+    conn.executemany(
+        "INSERT INTO watch_history (user_id, series_id, episode_id, watched_at) VALUES (?, ?, ?, ?)",
+        (
+            (
+                1 + i % args.users,
+                1 + (i % total_episodes) // args.episodes,
+                1 + i % total_episodes,
+                stamp(i),
+            )
+            for i in range(args.history)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+class _QueryCounter:
+    """นับคำสั่ง SQL ต่อ request แบบเดียวกับ metrics ของแอป (execute/executemany หนึ่งครั้ง = 1)"""
+
+    def __init__(self, appmod):
+        self.count = 0
+        original = appmod.record_query
+
+        def counted(seconds, sql=None, count=1):
+            self.count += count
+            return original(seconds, sql, count)
+
+        appmod.record_query = counted
+
+
+def bench_routes(args):
+    sys.path.insert(0, BASE_DIR)
+    import app as appmod
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        application = appmod.create_app({
+            "DB_PATH": os.path.join(tmp, "videos.db"),
+            "VIDEO_ROOT": os.path.join(tmp, "video_files"),
+            "JINJA_CACHE_DIR": os.path.join(tmp, "jinja_cache"),
+        })
+        start = time.perf_counter()
+        _seed_catalog(appmod, application, tmp, args)
+        seed_seconds = time.perf_counter() - start
+        counter = _QueryCounter(appmod)
+
+        anonymous = application.test_client()
+        viewer = application.test_client()
+        admin = application.test_client()
+        with viewer.session_transaction() as sess:
+            sess["user_id"], sess["username"] = 1, "user1"
+        with admin.session_transaction() as sess:
+            sess["is_admin"], sess["admin_username"] = True, "admin"
+
+        sid = max(1, args.series // 2)
+        eid = (sid - 1) * args.episodes + 1
+        backup = admin.get("/admin/backup/download/videos").data
+
+        def restore(client):
+            return client.post(
+                "/admin/backup",
+                data={"restore_mode": "merge", "backup_file": (BytesIO(backup), "videos.json")},
+                content_type="multipart/form-data",
+            )
+
+        routes = [
+            ("index", lambda: anonymous.get("/"), args.runs),
+            ("search", lambda: anonymous.get("/search?q=ซีรีส์ทดสอบ 7"), args.runs),
+            ("search_suggest", lambda: anonymous.get("/search/suggest?q=ซีรีส์ทดสอบ 7"), args.runs),
+            ("series_detail", lambda: anonymous.get(f"/series/{sid}"), args.runs),
+            ("watch_episode", lambda: viewer.get(f"/series/{sid}/episode/{eid}"), args.runs),
+            ("stream_episode", lambda: viewer.get(f"/stream/{eid}", headers={"Range": "bytes=0-65535"}), args.runs),
+            ("api_series", lambda: anonymous.get("/api/v1/series?fields=id,title"), args.runs),
+            ("api_episodes", lambda: anonymous.get(f"/api/v1/series/{sid}/episodes"), args.runs),
+            ("api_search", lambda: anonymous.get("/api/v1/search?q=ซีรีส์ทดสอบ 7"), args.runs),
+            ("api_changes_full", lambda: anonymous.get("/api/v1/changes?changes_since=0"), args.runs),
+            ("my_page", lambda: viewer.get("/me"), args.runs),
+            ("admin_series", lambda: admin.get("/admin/series"), args.runs),
+            ("admin_episodes", lambda: admin.get(f"/admin/series/{sid}/episodes"), args.runs),
+            ("admin_users", lambda: admin.get("/admin/users"), args.runs),
+            ("admin_users_search", lambda: admin.get("/admin/users?q=user12"), args.runs),
+            ("admin_user_detail", lambda: admin.get("/admin/users/1"), args.runs),
+            ("admin_cache", lambda: admin.get("/admin/cache"), args.runs),
+            ("backup_videos", lambda: admin.get("/admin/backup/download/videos"), args.heavy_runs),
+            ("backup_users", lambda: admin.get("/admin/backup/download/users"), args.heavy_runs),
+            ("restore_videos", lambda: restore(admin), args.heavy_runs),
+        ]
+
+        for name, call, runs in routes:
+            if args.only and name not in args.only:
+                continue
+            call().close()  # request แรก (compile template / เปิดไฟล์) ไม่นับ
+            samples, queries, statuses = [], [], set()
+            for _ in range(runs):
+                counter.count = 0
+                t0 = time.perf_counter()
+                response = call()
+                response.get_data()
+                samples.append(time.perf_counter() - t0)
+                response.close()
+                queries.append(counter.count)
+                statuses.add(response.status_code)
+            results[name] = {
+                **_percentiles(samples),
+                "queries": round(statistics.mean(queries), 1),
+                "status": ",".join(str(code) for code in sorted(statuses)),
+                "peak_rss_mb": _peak_rss_mb(),
+            }
+        with application.app_context():
+            appmod.bandwidth_flush(force=True)
+
+    rows = [{"route": name, **values} for name, values in results.items()]
+    _print_table(rows, ["route", "p50_ms", "p95_ms", "p99_ms", "queries", "status", "peak_rss_mb"])
+    print(f"seed {args.series} series x {args.episodes} eps, {args.users} users, "
+          f"{args.history} history rows in {seed_seconds:.1f}s; peak RSS {_peak_rss_mb()} MB")
+    return {"routes": results, "seed_seconds": round(seed_seconds, 2), "peak_rss_mb": _peak_rss_mb()}
+
+
+# ---------- startup: import / create_app / request แรก ----------
+
+# รันใน process ใหม่ทุกครั้ง เพื่อวัดแบบ worker ที่เพิ่งเริ่ม (ไม่มีโมดูลค้างใน sys.modules)
+_STARTUP_PROBE = r"""
+import json, os, sys, time
+base_dir, tmp, warm = sys.argv[1], sys.argv[2], sys.argv[3] == "1"
+t0 = time.perf_counter()
+sys.path.insert(0, base_dir)
+import app as appmod
+t1 = time.perf_counter()
+application = appmod.create_app({
+    "DB_PATH": os.path.join(tmp, "videos.db"),
+    "VIDEO_ROOT": os.path.join(tmp, "video_files"),
+    "WARM_UP": warm,
+    "JINJA_CACHE_DIR": os.path.join(tmp, "jinja_cache"),
+})
+t2 = time.perf_counter()
+client = application.test_client()
+first, second = {}, {}
+for path in ("/", "/login", "/search?q=test"):
+    s = time.perf_counter(); client.get(path); first[path] = time.perf_counter() - s
+for path in ("/", "/login", "/search?q=test"):
+    s = time.perf_counter(); client.get(path); second[path] = time.perf_counter() - s
+print(json.dumps({"import": t1 - t0, "create_app": t2 - t1, "first": first, "second": second}))
+"""
+
+
+def bench_startup(args):
+    results = {}
+    for warm in (False, True):
+        samples = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as tmp:
+                out = subprocess.run(
+                    [sys.executable, "-c", _STARTUP_PROBE, BASE_DIR, tmp, "1" if warm else "0"],
+                    capture_output=True, text=True, check=True, cwd=tmp,
+                )
+                samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+        summary = {
+            "import_ms": _ms(statistics.median(s["import"] for s in samples)),
+            "create_app_ms": _ms(statistics.median(s["create_app"] for s in samples)),
+        }
+        for path in samples[0]["first"]:
+            summary[f"first {path} ms"] = _ms(statistics.median(s["first"][path] for s in samples))
+            summary[f"second {path} ms"] = _ms(statistics.median(s["second"][path] for s in samples))
+        results["warm_up" if warm else "no_warm_up"] = summary
+
+    rows = [{"metric": key, **{mode: results[mode][key] for mode in results}} for key in results["warm_up"]]
+    _print_table(rows, ["metric", "no_warm_up", "warm_up"])
+    return results
+
+
+# ---------- templates: compile จาก source / โหลด bytecode / cache ในหน่วยความจำ ----------
+
+BENCH_TEMPLATES = ("index.html", "series_detail.html", "admin_episodes.html")
+
+
+def _template_context(name, rows):
+    series = [
+        {
+            "id": i,
+            "title": f"ซีรีส์ทดสอบ {i}",
+            "description": "เรื่องย่อ " * 20,
+            "thumbnail_url": f"/covers/{i}.jpg",
+        }
+        for i in range(1, rows + 1)
+    ]
+    episodes = [
+        {
+            "id": i,
+            "episode_number": i,
+            "title": f"ตอนที่ {i}",
+            "description": "รายละเอียดตอน " * 10,
+            "thumbnail_url": f"/episode_covers/{i}.jpg",
+            "is_active": 1,
+        }
+        for i in range(1, rows + 1)
+    ]
+    if name == "index.html":
+        return {"series_list": series}
+    return {"series": series[0], "episodes": episodes}
+
+
+def bench_templates(args):
+    from flask import render_template
+    from jinja2 import FileSystemBytecodeCache
+
+    sys.path.insert(0, BASE_DIR)
+    import app as appmod
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        application = appmod.create_app({
+            "DB_PATH": os.path.join(tmp, "videos.db"),
+            "VIDEO_ROOT": os.path.join(tmp, "video_files"),
+            "JINJA_BYTECODE_CACHE": False,
+            "TEMPLATE_PRECOMPILE": False,
+        })
+        env = application.jinja_env
+        os.makedirs(os.path.join(tmp, "jinja_cache"))
+        disk_cache = FileSystemBytecodeCache(os.path.join(tmp, "jinja_cache"))
+
+        def render(name, mode):
+            if mode != "memory":
+                # ล้าง cache ในหน่วยความจำ (รวม base.html) ให้เหมือน worker ที่เพิ่งเริ่ม
+                env.cache.clear()
+            env.bytecode_cache = disk_cache if mode == "bytecode" else None
+            with application.test_request_context("/", base_url="http://bench.local"):
+                start = time.perf_counter()
+                render_template(name, **_template_context(name, args.rows))
+                return time.perf_counter() - start
+
+        for name in BENCH_TEMPLATES:
+            # เขียน bytecode ลงดิสก์ก่อน 1 ครั้ง ให้โหมด bytecode อ่านจาก cache เสมอ
+            env.cache.clear()
+            env.bytecode_cache = disk_cache
+            env.get_template(name)
+
+            summary = {}
+            for mode in ("cold", "bytecode", "memory"):
+                samples = [render(name, mode) for _ in range(args.runs)]
+                summary[f"{mode}_ms"] = _ms(statistics.median(samples))
+            results[name] = summary
+
+    rows = [{"template": name, **values} for name, values in results.items()]
+    _print_table(rows, ["template", "cold_ms", "bytecode_ms", "memory_ms"])
+    return results
+
+
+# ---------- stream-concurrency: ผู้ชมที่ดูช้า ๆ ค้างการเชื่อมต่อไว้พร้อมกัน ----------
+
+def _seed_stream_db(tmp, size_mb, files=1, drive=False):
+    """สร้าง DB ชั่วคราวที่มีผู้ใช้ 1 คน และตอนละ 1 ไฟล์ (sparse ขนาด size_mb) คืน (แอป, episode ids, session cookie)
+
+    drive=True: ตอนเป็นแบบ gdrive ที่ไฟล์ในเครื่องหาย ทุก request แรกต้องโหลดใหม่จาก DRIVE_DOWNLOAD_URL
+    """
+    sys.path.insert(0, BASE_DIR)
+    import app as appmod
+
+    application = appmod.create_app({
+        "DB_PATH": os.path.join(tmp, "videos.db"),
+        "VIDEO_ROOT": os.path.join(tmp, "video_files"),
+        "JINJA_CACHE_DIR": os.path.join(tmp, "jinja_cache"),
+    })
+
+    now = "2024-01-01 00:00:00"
+    with application.app_context():
+        conn = appmod.get_db_connection()
+    user_id = conn.execute(
+        "INSERT INTO users (username, password, created_at) VALUES ('bench', '-', ?)", (now,)
+    ).lastrowid
+    series_id = conn.execute(
+        "INSERT INTO series (title, created_at) VALUES ('bench', ?)", (now,)
+    ).lastrowid
+    episode_ids = []
+    # ไฟล์อยู่ใต้ VIDEO_ROOT ของเซิร์ฟเวอร์ bench (ส่งผ่าน STREAM_OFFLOAD ได้)
+    video_dir = os.path.join(tmp, "video_files")
+    os.makedirs(video_dir, exist_ok=True)
+    for n in range(1, files + 1):
+        video_path = os.path.join(video_dir, f"bench{n}.mp4")
+        if not drive:
+            with open(video_path, "wb") as f:
+                f.truncate(size_mb * 1024 * 1024)
+        episode_ids.append(conn.execute(
+            """
+            INSERT INTO episodes (series_id, title, episode_number, source_type, drive_id, file_path, created_at)
+            VALUES (?, 'bench', ?, ?, ?, ?, ?)
+            """,
+            (series_id, n, "gdrive" if drive else "upload", f"BENCH{n}" if drive else None, video_path, now),
+        ).lastrowid)
+    conn.commit()
+    conn.close()
+
+    serializer = application.session_interface.get_signing_serializer(application)
+    cookie = f"{application.config['SESSION_COOKIE_NAME']}={serializer.dumps({'user_id': user_id})}"
+    return application, episode_ids, cookie
+
+
+# ---------- stream-token: ต้นทุนต่อ Range request แบบ session + DB เทียบลิงก์ลงชื่อ ----------
+
+def bench_stream_token(args):
+    sys.path.insert(0, BASE_DIR)
+    import app as appmod
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        application, episode_ids, cookie = _seed_stream_db(tmp, args.size_mb)
+        counter = _QueryCounter(appmod)
+        client = application.test_client(use_cookies=False)
+
+        # runtime.db ใช้ sqlite3 ธรรมดา (ไม่ผ่าน record_query) นับจากจำนวนครั้งที่เปิด connection แทน
+        runtime_opens = [0]
+        get_runtime_db = appmod.get_runtime_db
+
+        def counted_runtime_db(path=None):
+            runtime_opens[0] += 1
+            return get_runtime_db(path)
+
+        appmod.get_runtime_db = counted_runtime_db
+
+        with application.app_context():
+            conn = appmod.get_db_connection()
+            episode = conn.execute("SELECT * FROM episodes WHERE id = ?", (episode_ids[0],)).fetchone()
+            user_id = conn.execute("SELECT id FROM users").fetchone()["id"]
+            conn.close()
+            token = appmod.mint_stream_token(episode, user_id)
+
+        modes = {
+            "session": (f"/stream/{episode['id']}", {"Cookie": cookie}),
+            "token": (f"/stream/{episode['id']}?st={token}", {}),
+        }
+        # ค่าเริ่มต้น (ตัวจำกัดปิด) เทียบกับเปิดตัวจำกัดต่อผู้ใช้ (ตอนพร้อมกัน + แบนด์วิดท์)
+        limits = {
+            "default": (application.config["STREAM_MAX_CONCURRENT"], application.config["STREAM_USER_RATE_BYTES"]),
+            "limiter": (args.limiter_streams, args.limiter_rate_mb * 1024 * 1024),
+        }
+        size = args.size_mb * 1024 * 1024
+        for limit_name, (max_streams, rate_bytes) in limits.items():
+            application.config.update(STREAM_MAX_CONCURRENT=max_streams, STREAM_USER_RATE_BYTES=rate_bytes)
+            with application.app_context():
+                appmod.reset_stream_limits(user_id)
+            for name, (url, headers) in modes.items():
+                client.get(url, headers=headers).close()
+                samples, queries, runtime, statuses = [], [], [], set()
+                for i in range(args.runs):
+                    start = (i * 7919 * args.range_kb * 1024) % max(1, size - args.range_kb * 1024)
+                    counter.count = 0
+                    runtime_opens[0] = 0
+                    t0 = time.perf_counter()
+                    response = client.get(
+                        url, headers={**headers, "Range": f"bytes={start}-{start + args.range_kb * 1024 - 1}"}
+                    )
+                    response.get_data()
+                    response.close()
+                    samples.append(time.perf_counter() - t0)
+                    queries.append(counter.count)
+                    runtime.append(runtime_opens[0])
+                    statuses.add(response.status_code)
+                results[f"{name} ({limit_name})"] = {
+                    **_percentiles(samples),
+                    "mean_ms": _ms(statistics.mean(samples)),
+                    "queries": round(statistics.mean(queries), 2),
+                    "runtime_db": round(statistics.mean(runtime), 2),
+                    "status": ",".join(str(code) for code in sorted(statuses)),
+                }
+
+        with application.app_context():
+            t0 = time.perf_counter()
+            for _ in range(args.runs):
+                appmod.verify_stream_token(token, episode["id"])
+            verify_us = round((time.perf_counter() - t0) / args.runs * 1e6, 1)
+            # ยอดแบนด์วิดท์ที่ค้างอยู่ต้องลง DB ชั่วคราวก่อนลบโฟลเดอร์ (ไม่งั้น atexit จะเขียนไม่ได้)
+            appmod.bandwidth_flush(force=True)
+        appmod.get_runtime_db = get_runtime_db
+
+    rows = [{"mode": name, **values} for name, values in results.items()]
+    _print_table(rows, ["mode", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "queries", "runtime_db", "status"])
+    print(f"verify_stream_token: {verify_us} us/call; range {args.range_kb} KB x {args.runs} requests; "
+          f"limiter = {args.limiter_streams} ตอน, {args.limiter_rate_mb} MB/s")
+    return {"modes": results, "verify_us": verify_us}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_port(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"เซิร์ฟเวอร์ปิดตัวก่อนพร้อม (exit {proc.returncode})")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("เซิร์ฟเวอร์ไม่พร้อมภายในเวลาที่กำหนด")
+
+
+async def _slow_viewer(port, path, cookie, args):
+    """เปิดสตรีมแล้วอ่านช้า ๆ ตาม --rate-kb จนครบ --hold วินาที คืน TTFB (None = ไม่ได้รับข้อมูลทันเวลา)"""
+    start = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), args.ttfb_timeout)
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: bench\r\nCookie: {cookie}\r\nRange: bytes=0-\r\n\r\n".encode()
+        )
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), args.ttfb_timeout - (time.perf_counter() - start))
+        if b" 206 " not in status_line:
+            return None
+        ttfb = time.perf_counter() - start
+
+        deadline = start + args.hold
+        while time.perf_counter() < deadline:
+            if not await reader.read(args.rate_kb * 1024):
+                break
+            await asyncio.sleep(1)
+        return ttfb
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def _page_latency(port, delay, timeout):
+    """โหลดหน้า /login ระหว่างที่มีผู้ชมค้างอยู่ (None = ไม่ตอบภายใน timeout)"""
+    await asyncio.sleep(delay)
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+        writer.write(b"GET /login HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+        return time.perf_counter() - start
+    except (OSError, asyncio.TimeoutError):
+        return None
+
+
+async def _run_viewers(port, path, cookie, args):
+    viewers = [_slow_viewer(port, path, cookie, args) for _ in range(args.clients)]
+    page = _page_latency(port, min(2.0, args.hold / 2), args.ttfb_timeout)
+    *ttfbs, page_s = await asyncio.gather(*viewers, page)
+    return ttfbs, page_s
+
+
+class _Server:
+    """รันเซิร์ฟเวอร์จริงใน process แยก (cwd = โฟลเดอร์ชั่วคราว จึงใช้ videos.db / video_files ของ bench)"""
+
+    def __init__(self, kind, tmp, workers=4, threads=1, timeout=120, env=None):
+        self.port = _free_port()
+        if kind == "gunicorn":
+            command = [
+                sys.executable, "-m", "gunicorn", "--pythonpath", BASE_DIR,
+                "-w", str(workers), "--threads", str(threads), "-b", f"127.0.0.1:{self.port}",
+                "--timeout", str(timeout), "app:create_app()",
+            ]
+        else:
+            command = [
+                sys.executable, "-m", "uvicorn", "--app-dir", BASE_DIR, "--port", str(self.port),
+                "--log-level", "warning", "--no-access-log", "asgi:app",
+            ]
+        self.env = dict(
+            os.environ,
+            SECRET_KEY=os.environ.get("SECRET_KEY", "dev-secret-key"),
+            VIDEO_ROOT=os.path.join(tmp, "video_files"),
+            JINJA_CACHE_DIR=os.path.join(tmp, "jinja_cache"),
+            # ผู้ชมจำลองทุกคนใช้บัญชีเดียวกัน ปิดตัวจำกัดสตรีมต่อผู้ใช้ไว้ (วัดความจุของเซิร์ฟเวอร์)
+            STREAM_MAX_CONCURRENT="0",
+            STREAM_USER_RATE_BYTES="0",
+        )
+        self.env.update(env or {})
+        self.command, self.cwd = command, tmp
+        self.proc = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(self.command, cwd=self.cwd, env=self.env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_port(self.port, self.proc)
+            self._wait_ready()
+        except Exception:
+            self.__exit__()
+            raise
+        return self
+
+    def _wait_ready(self, timeout=30):
+        # port เปิดแล้วแต่ worker อาจยังบูตไม่เสร็จ รอจนหน้า /login ตอบได้ แล้วเผื่อเวลาให้ worker ที่เหลือ
+        import urllib.request
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/login", timeout=5):
+                    break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        time.sleep(1)
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait(timeout=30)
+
+
+# ---------- offload: nginx ส่งไฟล์เองด้วย X-Accel-Redirect (ข้ามถ้าไม่มี nginx) ----------
+
+class _Nginx:
+    """รัน nginx (ไม่ใช่ daemon, ไม่มี worker แยก) ด้วย server block จาก nginx.conf.example"""
+
+    def __init__(self, binary, tmp, app_port, video_root):
+        self.port = _free_port()
+        with open(os.path.join(BASE_DIR, "nginx.conf.example"), encoding="utf-8") as f:
+            site = f.read()
+        for old, new in (
+            ("server 127.0.0.1:8000;", f"server 127.0.0.1:{app_port};"),
+            ("listen 80;", f"listen 127.0.0.1:{self.port};"),
+            ("alias /srv/myseries/video_files/;", f"alias {video_root}/;"),
+        ):
+            if old not in site:
+                raise RuntimeError(f"nginx.conf.example เปลี่ยนไป หา '{old}' ไม่เจอ")
+            site = site.replace(old, new)
+
+        prefix = os.path.join(tmp, f"nginx-{self.port}")
+        os.makedirs(prefix)
+        temp_paths = "\n".join(
+            f"    {name}_temp_path {prefix}/{name};" for name in ("client_body", "proxy", "fastcgi", "uwsgi", "scgi")
+        )
+        self.config = os.path.join(prefix, "nginx.conf")
+        with open(self.config, "w", encoding="utf-8") as f:
+            f.write(
+                f"daemon off;\nmaster_process off;\npid {prefix}/nginx.pid;\n"
+                f"error_log {prefix}/error.log warn;\n"
+                "events { worker_connections 1024; }\n"
+                f"http {{\n    access_log off;\n{temp_paths}\n{site}\n}}\n"
+            )
+        self.command = [binary, "-p", prefix, "-c", self.config]
+        self.proc = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(self.command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_port(self.port, self.proc)
+        except Exception:
+            self.__exit__()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait(timeout=30)
+
+
+def _http(port, method, path, headers=None):
+    import http.client
+
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request(method, path, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+def _offload_checks(port, episode_id, cookie, data):
+    """ตรวจพฤติกรรมผ่าน nginx คืน dict ชื่อการตรวจ -> ผ่าน/ไม่ผ่าน"""
+    path = f"/stream/{episode_id}"
+    size = len(data)
+    checks = {}
+    status, _, _ = _http(port, "GET", path)
+    checks["anonymous_redirects_to_login"] = status == 302
+    status, headers, body = _http(port, "GET", path, {"Cookie": cookie, "Range": "bytes=1000-1999"})
+    checks["range_206_matches_file"] = status == 206 and body == data[1000:2000]
+    checks["x_accel_header_hidden"] = not any(k.lower() == "x-accel-redirect" for k in headers)
+    status, _, body = _http(port, "GET", path, {"Cookie": cookie})
+    checks["full_200_matches_file"] = status == 200 and body == data
+    status, headers, _ = _http(port, "HEAD", path, {"Cookie": cookie})
+    checks["head_content_length"] = status == 200 and int(headers.get("Content-Length", -1)) == size
+    status, _, _ = _http(port, "GET", path, {"Cookie": cookie, "Range": f"bytes={size + 10}-"})
+    checks["unsatisfiable_416"] = status == 416
+    status, _, _ = _http(port, "GET", "/_protected_video/bench1.mp4")
+    checks["internal_location_not_public"] = status == 404
+    return checks
+
+
+def _download_load(port, path, cookie, clients, duration):
+    """ผู้ชม ``clients`` คนโหลดไฟล์ทั้งไฟล์ซ้ำ ๆ นาน ``duration`` วินาที คืน (ไบต์รวม, error)"""
+    import http.client
+
+    totals = {"bytes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def viewer():
+        while time.monotonic() < deadline:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            try:
+                conn.request("GET", path, headers={"Cookie": cookie})
+                response = conn.getresponse()
+                received = 0
+                while chunk := response.read(1024 * 1024):
+                    received += len(chunk)
+                with lock:
+                    totals["bytes"] += received
+            except OSError:
+                with lock:
+                    totals["errors"] += 1
+            finally:
+                conn.close()
+
+    threads = [threading.Thread(target=viewer) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return totals["bytes"], totals["errors"]
+
+
+def bench_offload(args):
+    binary = args.nginx or shutil.which("nginx")
+    if not binary:
+        print("ข้าม: ไม่พบ nginx ใน PATH (ระบุด้วย --nginx)")
+        return {"skipped": "nginx not found"}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        _, episode_ids, cookie = _seed_stream_db(tmp, args.size_mb)
+        # ใส่ข้อมูลสุ่มจริง (ไม่ใช่ไฟล์ sparse) เพื่อเทียบไบต์ที่ได้กับไฟล์
+        data = os.urandom(args.size_mb * 1024 * 1024)
+        with open(os.path.join(tmp, "video_files", "bench1.mp4"), "wb") as f:
+            f.write(data)
+        video_root = os.path.join(tmp, "video_files")
+
+        for mode in ("nginx", ""):
+            name = f"offload_{mode}" if mode else "python"
+            env = {"STREAM_OFFLOAD": mode}
+            with _Server("gunicorn", tmp, workers=args.workers, threads=args.threads, env=env) as server, \
+                    _Nginx(binary, tmp, server.port, video_root) as proxy:
+                checks = _offload_checks(proxy.port, episode_ids[0], cookie, data)
+                _, cpu_before = _proc_tree_usage(server.proc.pid)
+                start = time.perf_counter()
+                received, errors = _download_load(
+                    proxy.port, f"/stream/{episode_ids[0]}", cookie, args.clients, args.duration
+                )
+                elapsed = time.perf_counter() - start
+                _, cpu_after = _proc_tree_usage(server.proc.pid)
+            gb = received / 1024 ** 3
+            results[name] = {
+                "checks_passed": f"{sum(checks.values())}/{len(checks)}",
+                "failed": ",".join(k for k, ok in checks.items() if not ok) or "-",
+                "mb_per_s": round(received / 1024 ** 2 / elapsed, 1),
+                "errors": errors,
+                "app_cpu_s_per_gb": round((cpu_after - cpu_before) / gb, 2) if gb else None,
+            }
+
+    rows = [{"mode": name, **values} for name, values in results.items()]
+    _print_table(rows, ["mode", "checks_passed", "failed", "mb_per_s", "errors", "app_cpu_s_per_gb"])
+    return results
+
+
+# ---------- coherence: แคชในหน่วยความจำของหลาย process เห็นการแก้ไขของกันและกัน ----------
+
+# process อ่าน: เรียก get_catalog() วนไปเรื่อย ๆ จด title ของเรื่อง id 1 ที่เห็นครั้งแรก และจำนวนครั้งที่สร้าง snapshot ใหม่
+_COHERENCE_PROBE = r"""
+import json, os, sys, threading, time
+base_dir, tmp, interval = sys.argv[1], sys.argv[2], float(sys.argv[3])
+sys.path.insert(0, base_dir)
+import app as appmod
+application = appmod.create_app({
+    "DB_PATH": os.path.join(tmp, "videos.db"),
+    "VIDEO_ROOT": os.path.join(tmp, "video_files"),
+    "JINJA_CACHE_DIR": os.path.join(tmp, "jinja_cache"),
+    "CACHE_CHECK_INTERVAL": interval,
+    "WARM_UP": False,
+    "TEMPLATE_PRECOMPILE": False,
+})
+application.app_context().push()
+builds = 0
+load_catalog = appmod.load_catalog
+def counted(conn):
+    global builds
+    builds += 1
+    return load_catalog(conn)
+appmod.load_catalog = counted
+stop = threading.Event()
+threading.Thread(target=lambda: (sys.stdin.read(), stop.set()), daemon=True).start()
+appmod.get_catalog()
+print("ready", flush=True)
+seen, last, calls, spent = {}, None, 0, 0.0
+while not stop.is_set():
+    t0 = time.perf_counter()
+    title = appmod.get_catalog().series(1).title
+    spent += time.perf_counter() - t0
+    calls += 1
+    if title != last:
+        seen.setdefault(title, time.time())
+        last = title
+    time.sleep(0.001)
+print(json.dumps({"seen": seen, "builds": builds, "calls": calls, "avg_us": spent / calls * 1e6}), flush=True)
+"""
+
+
+def bench_coherence(args):
+    sys.path.insert(0, BASE_DIR)
+    import sqlite3
+    import app as appmod
+
+    with tempfile.TemporaryDirectory() as tmp, appmod.create_app({
+        "DB_PATH": os.path.join(tmp, "videos.db"),
+        "VIDEO_ROOT": os.path.join(tmp, "video_files"),
+        "JINJA_CACHE_DIR": os.path.join(tmp, "jinja_cache"),
+    }).app_context():
+        now = "2024-01-01 00:00:00"
+        conn = appmod.get_db_connection()
+        conn.execute("INSERT INTO series (id, title, created_at) VALUES (1, 'v0', ?)", (now,))
+        conn.execute(
+            "INSERT INTO episodes (id, series_id, title, source_type, created_at) VALUES (1, 1, 'bench', 'upload', ?)",
+            (now,),
+        )
+        conn.execute("INSERT INTO users (id, username, password, created_at) VALUES (1, 'bench', '-', ?)", (now,))
+        conn.commit()
+        conn.close()
+
+        readers = [
+            subprocess.Popen(
+                [sys.executable, "-c", _COHERENCE_PROBE, BASE_DIR, tmp, str(args.interval)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, cwd=tmp,
+            )
+            for _ in range(args.workers)
+        ]
+        try:
+            for reader in readers:
+                reader.stdout.readline()
+
+            # 1) เขียนตารางนอก namespace "catalog" (users / watch_history): ต้องไม่ทำให้ catalog ถูกสร้างใหม่
+            for i in range(args.writes):
+                conn = appmod.get_db_connection()
+                conn.execute("UPDATE users SET password = ? WHERE id = 1", (f"p{i}",))
+                conn.execute(
+                    "INSERT INTO watch_history (user_id, series_id, episode_id, watched_at) VALUES (1, 1, 1, ?)",
+                    (now,),
+                )
+                conn.commit()
+                conn.close()
+                time.sleep(args.pause)
+
+            # 2) แก้เรื่องสลับกันระหว่างผ่านแอป กับ sqlite3 ตรง ๆ (trigger ต้องเพิ่ม epoch ให้ทั้งสองทาง)
+            committed = {}
+            for i in range(1, args.writes + 1):
+                if i % 2:
+                    conn = appmod.get_db_connection()
+                else:
+                    conn = sqlite3.connect(os.path.join(tmp, "videos.db"))
+                conn.execute("UPDATE series SET title = ? WHERE id = 1", (f"v{i}",))
+                conn.commit()
+                committed[f"v{i}"] = time.time()
+                conn.close()
+                time.sleep(args.pause)
+        except BaseException:
+            for reader in readers:
+                reader.kill()
+            raise
+
+        results = []
+        for reader in readers:
+            out, _ = reader.communicate("")
+            results.append(json.loads(out.strip().splitlines()[-1]))
+
+    rows = []
+    for n, result in enumerate(results, 1):
+        lags = [result["seen"][title] - at for title, at in committed.items() if title in result["seen"]]
+        missed = len(committed) - len(lags)
+        # สร้างครั้งแรก 1 ครั้ง + 1 ครั้งต่อการแก้เรื่องที่เห็น
+        extra = result["builds"] - 1 - len(lags)
+        rows.append({
+            "worker": n,
+            "missed": missed,
+            "extra_rebuilds": extra,
+            "lag_p50_ms": _ms(statistics.median(lags)) if lags else None,
+            "lag_max_ms": _ms(max(lags)) if lags else None,
+            "get_catalog_us": round(result["avg_us"], 2),
+            "ok": missed == 0 and extra == 0 and bool(lags) and max(lags) <= args.interval + 0.1,
+        })
+    _print_table(rows, ["worker", "missed", "extra_rebuilds", "lag_p50_ms", "lag_max_ms", "get_catalog_us", "ok"])
+    print(f"{args.writes} writes outside the catalog + {args.writes} catalog writes; "
+          f"CACHE_CHECK_INTERVAL={args.interval}s, {sum(r['ok'] for r in rows)}/{len(rows)} workers ok")
+    return {"workers": rows}
+
+
+
+# ---------- user-search: ค้นหาผู้ใช้ในหน้าแอดมินบนตาราง users ขนาดใหญ่ ----------
+
+def bench_user_search(args):
+    sys.path.insert(0, BASE_DIR)
+    import random
+    import app as appmod
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "videos.db")
+        application = appmod.create_app({
+            "DB_PATH": db_path,
+            "VIDEO_ROOT": os.path.join(tmp, "video_files"),
+            "JINJA_CACHE_DIR": os.path.join(tmp, "jinja_cache"),
+        })
+        with application.app_context():
+            conn = appmod.get_db_connection()
+        size_before = os.path.getsize(db_path)
+        start = time.perf_counter()
+        # เพิ่มผ่าน trigger ของ users_search เหมือนการสมัครจริง
+        conn.executemany(
+            "INSERT INTO users (id, username, password, created_at, user_key) VALUES (?, ?, '-', ?, ?)",
+            (
+                (
+                    i, f"user{i}",
+                    f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:00.{i:06d}",
+                    "U%016X" % rng.getrandbits(64),
+                )
+                for i in range(1, args.users + 1)
+            ),
+        )
+        conn.commit()
+        seed_seconds = time.perf_counter() - start
+        has_fts = appmod._has_user_search(conn)
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        fts_bytes = conn.execute(
+            "SELECT coalesce(sum(length(block)), 0) FROM users_search_data"
+        ).fetchone()[0] if has_fts else 0
+
+        probe = max(1, args.users * 7 // 9)
+        key = conn.execute("SELECT user_key FROM users WHERE id = ?", (probe,)).fetchone()[0]
+        queries = [
+            ("list", ""),
+            ("key_exact", key),
+            ("key_prefix", key[:8]),
+            ("key_fragment", key[5:12]),
+            ("username_exact", f"user{probe}"),
+            ("username_rare", f"user{probe // 10}"),
+            ("username_common", "user1"),
+            ("everyone", "ser"),
+            ("short", "r1"),
+            ("no_match", "zzzz"),
+        ]
+
+        def old_query(q):
+            # คำสั่งเดิมก่อนมี users_search (ไม่แบ่งหน้า)
+            if not q:
+                return conn.execute("SELECT * FROM users ORDER BY datetime(created_at) DESC LIMIT 100").fetchall()
+            like = f"%{q}%"
+            return conn.execute(
+                "SELECT * FROM users WHERE username LIKE ? OR user_key LIKE ? ORDER BY datetime(created_at) DESC",
+                (like, like),
+            ).fetchall()
+
+        rows = []
+        for name, q in queries:
+            old_samples, new_samples = [], []
+            for _ in range(args.runs):
+                t0 = time.perf_counter()
+                old_rows = old_query(q)
+                old_samples.append(time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                page, next_cursor = appmod.search_users(conn, q, args.page_size)
+                new_samples.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            if next_cursor:
+                appmod.search_users(conn, q, args.page_size, appmod._decode_cursor(next_cursor))
+            rows.append({
+                "query": name,
+                "matches_old": len(old_rows),
+                "old_p50_ms": _ms(statistics.median(old_samples)),
+                "page_rows": len(page),
+                "new_p50_ms": _ms(statistics.median(new_samples)),
+                "page2_ms": _ms(time.perf_counter() - t0) if next_cursor else "-",
+                # หน้าแรกต้องเป็นแถวเดียวกับ (ช่วงต้นของ) ผลแบบเดิม
+                "same_first_page": [row["id"] for row in page] == [row["id"] for row in old_rows[:len(page)]],
+            })
+        conn.close()
+
+    _print_table(rows, ["query", "matches_old", "old_p50_ms", "page_rows", "new_p50_ms", "page2_ms", "same_first_page"])
+    print(f"{args.users} users inserted in {seed_seconds:.1f}s (with users_search triggers={has_fts}); "
+          f"DB {page_count * page_size / 1024 ** 2:.0f} MB, trigram index {fts_bytes / 1024 ** 2:.0f} MB "
+          f"(empty DB {size_before / 1024 ** 2:.1f} MB)")
+    return {"queries": rows, "seed_seconds": round(seed_seconds, 1), "db_mb": round(page_count * page_size / 1024 ** 2)}
+
+# ---------- login-burst: คนล็อกอินพร้อมกันจำนวนมาก ระหว่างที่มีผู้ชมสตรีมอยู่ ----------
+
+def bench_login_burst(args):
+    sys.path.insert(0, BASE_DIR)
+    import http.client
+    from urllib.parse import urlencode
+    from werkzeug.security import generate_password_hash
+    import app as appmod
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        application, episode_ids, cookie = _seed_stream_db(tmp, 64)
+        hash_method = application.config["PASSWORD_HASH_METHOD"]
+        # hash เดียวกันทุกบัญชี (ต้นทุนตรวจเท่ากับของจริง ไม่ต้องรอแฮชทีละคนตอน seed)
+        hashed = generate_password_hash("bench-password", hash_method)
+        with application.app_context():
+            conn = appmod.get_db_connection()
+        conn.executemany(
+            "INSERT INTO users (username, password, created_at) VALUES (?, ?, '2024-01-01 00:00:00')",
+            ((f"burst{i}", hashed) for i in range(args.logins)),
+        )
+        conn.commit()
+        conn.close()
+
+        stream_path = f"/stream/{episode_ids[0]}"
+        for mode, hash_workers in (("inline", 0), (f"pool_{args.hash_workers}", args.hash_workers)):
+            env = {"PASSWORD_HASH_WORKERS": str(hash_workers), "PASSWORD_HASH_QUEUE_LIMIT": str(args.queue_limit)}
+            with _Server("gunicorn", tmp, workers=args.workers, threads=args.threads, env=env) as server:
+                # เรียกแต่ละ worker ให้สร้าง pool ก่อน (ไม่นับเวลาเริ่ม process ของ pool)
+                for i in range(args.workers * args.threads):
+                    _http(server.port, "POST", "/login", {"Content-Type": "application/x-www-form-urlencoded"})
+
+                stop = threading.Event()
+                viewer_samples = []  # (เวลาเริ่ม, latency)
+                lock = threading.Lock()
+
+                def viewer():
+                    while not stop.is_set():
+                        t0 = time.perf_counter()
+                        try:
+                            status, _, _ = _http(server.port, "GET", stream_path, {
+                                "Cookie": cookie, "Range": "bytes=0-65535",
+                            })
+                        except OSError:
+                            status = None
+                        with lock:
+                            viewer_samples.append((t0, time.perf_counter() - t0, status))
+                        time.sleep(0.01)
+
+                logins = []
+                barrier = threading.Barrier(args.logins)
+
+                def login(i):
+                    body = urlencode({"username": f"burst{i}", "password": "bench-password"})
+                    barrier.wait()
+                    t0 = time.perf_counter()
+                    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=120)
+                    try:
+                        conn.request("POST", "/login", body=body,
+                                     headers={"Content-Type": "application/x-www-form-urlencoded"})
+                        status = conn.getresponse().status
+                    except OSError:
+                        status = None
+                    finally:
+                        conn.close()
+                    with lock:
+                        logins.append((time.perf_counter() - t0, status))
+
+                viewers = [threading.Thread(target=viewer) for _ in range(args.viewers)]
+                for t in viewers:
+                    t.start()
+                time.sleep(args.baseline)
+                _, cpu_before = _proc_tree_usage(server.proc.pid)
+                burst_start = time.perf_counter()
+                burst = [threading.Thread(target=login, args=(i,)) for i in range(args.logins)]
+                for t in burst:
+                    t.start()
+                for t in burst:
+                    t.join()
+                burst_end = time.perf_counter()
+                stop.set()
+                for t in viewers:
+                    t.join()
+
+            before = [lat for t0, lat, status in viewer_samples if t0 < burst_start and status == 206]
+            during = [lat for t0, lat, status in viewer_samples if burst_start <= t0 <= burst_end]
+            ok = [lat for lat, status in logins if status == 302]
+            results[mode] = {
+                "logins_ok": len(ok),
+                "rejected_503": sum(1 for _, status in logins if status == 503),
+                "login_errors": sum(1 for _, status in logins if status not in (200, 302, 503)),
+                "login_p50_ms": _ms(statistics.median(ok)) if ok else None,
+                "login_max_ms": _ms(max(ok)) if ok else None,
+                "burst_s": round(burst_end - burst_start, 2),
+                "stream_p95_before_ms": _percentiles(before)["p95_ms"],
+                "stream_p95_during_ms": _percentiles(during)["p95_ms"] if during else None,
+                "stream_max_during_ms": _ms(max(during)) if during else None,
+            }
+
+    rows = [{"mode": name, **values} for name, values in results.items()]
+    _print_table(rows, ["mode", "logins_ok", "rejected_503", "login_errors", "login_p50_ms", "login_max_ms",
+                        "burst_s", "stream_p95_before_ms", "stream_p95_during_ms", "stream_max_during_ms"])
+    print(f"{args.logins} concurrent logins ({hash_method}), {args.viewers} viewers, "
+          f"gunicorn {args.workers}w x {args.threads} threads, PASSWORD_HASH_QUEUE_LIMIT={args.queue_limit}")
+    return results
+
+# ---------- compression: ไบต์ที่ประหยัดได้ เทียบ CPU ที่ใช้บีบ ----------
+
+def bench_compression(args):
+    sys.path.insert(0, BASE_DIR)
+    import app as appmod
+
+    encodings = [("gzip", level) for level in args.gzip_levels]
+    if appmod.brotli is not None:
+        encodings += [("br", quality) for quality in args.br_qualities]
+    else:
+        print("ไม่มีโมดูล brotli: วัดเฉพาะ gzip")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        application = appmod.create_app({
+            "DB_PATH": os.path.join(tmp, "videos.db"),
+            "VIDEO_ROOT": os.path.join(tmp, "video_files"),
+            "JINJA_CACHE_DIR": os.path.join(tmp, "jinja_cache"),
+        })
+        _seed_catalog(appmod, application, tmp, args)
+        config = application.config
+
+        anonymous = application.test_client()
+        admin = application.test_client()
+        with admin.session_transaction() as sess:
+            sess["is_admin"], sess["admin_username"] = True, "admin"
+        sid = max(1, args.series // 2)
+        routes = [
+            ("index", anonymous, "/"),
+            ("search", anonymous, "/search?q=ซีรีส์ทดสอบ 7"),
+            ("series_detail", anonymous, f"/series/{sid}"),
+            ("api_series", anonymous, "/api/v1/series"),
+            ("api_changes_full", anonymous, "/api/v1/changes?changes_since=0"),
+            ("admin_users", admin, "/admin/users"),
+            ("admin_user_detail", admin, "/admin/users/1"),
+            ("backup_videos", admin, "/admin/backup/download/videos"),
+            ("backup_users", admin, "/admin/backup/download/users"),
+        ]
+
+        for name, client, path in routes:
+            raw = client.get(path).get_data()
+            for encoding, level in encodings:
+                # CPU ของการบีบล้วน ๆ (ไม่ผ่านแคช)
+                cpu = []
+                for _ in range(args.runs):
+                    compress, finish = appmod._compressor(encoding, level)
+                    t0 = time.process_time()
+                    out = compress(raw) + finish()
+                    cpu.append(time.process_time() - t0)
+                # หน้าเดิมซ้ำ: hash เนื้อหาแล้วได้ผลจากแคช
+                appmod.reset_compress_cache()
+                appmod.compress_body(raw, encoding, level, config["COMPRESS_CACHE_BYTES"])
+                t0 = time.perf_counter()
+                for _ in range(args.runs):
+                    appmod.compress_body(raw, encoding, level, config["COMPRESS_CACHE_BYTES"])
+                cached = (time.perf_counter() - t0) / args.runs
+                cpu_s = statistics.median(cpu)
+                saved = len(raw) - len(out)
+                rows.append({
+                    "route": name,
+                    "encoding": f"{encoding}-{level}",
+                    "raw_kb": round(len(raw) / 1024, 1),
+                    "out_kb": round(len(out) / 1024, 1),
+                    "saved_pct": round(saved / len(raw) * 100, 1) if raw else 0,
+                    "cpu_ms": _ms(cpu_s),
+                    "kb_saved_per_cpu_ms": round(saved / 1024 / (cpu_s * 1000), 1) if cpu_s else None,
+                    "cached_us": round(cached * 1e6, 1),
+                })
+
+        # ทั้ง request ผ่าน middleware ตามค่าที่ตั้งไว้: ไม่บีบ / บีบครั้งแรก / ได้จากแคช
+        encoding = appmod.negotiate_encoding("br, gzip")
+        e2e = []
+        for name, client, path in routes:
+            identity = _request_samples(client, path, {}, args.runs)
+            appmod.reset_compress_cache()
+            cold = []
+            for _ in range(args.runs):
+                appmod.reset_compress_cache()
+                cold += _request_samples(client, path, {"Accept-Encoding": "br, gzip"}, 1)
+            warm = _request_samples(client, path, {"Accept-Encoding": "br, gzip"}, args.runs)
+            e2e.append({
+                "route": name,
+                "identity_p50_ms": _ms(statistics.median(identity)),
+                "compressed_p50_ms": _ms(statistics.median(cold)),
+                "cached_p50_ms": _ms(statistics.median(warm)),
+            })
+
+    _print_table(rows, ["route", "encoding", "raw_kb", "out_kb", "saved_pct", "cpu_ms",
+                        "kb_saved_per_cpu_ms", "cached_us"])
+    print()
+    _print_table(e2e, ["route", "identity_p50_ms", "compressed_p50_ms", "cached_p50_ms"])
+    print(f"request ผ่าน middleware ใช้ {encoding}; COMPRESS_MIN_SIZE={config['COMPRESS_MIN_SIZE']}, "
+          f"COMPRESS_BUFFER_MAX={config['COMPRESS_BUFFER_MAX']}")
+    return {"encodings": rows, "requests": e2e}
+
+
+def _request_samples(client, path, headers, runs):
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        response = client.get(path, headers=headers)
+        response.get_data()
+        samples.append(time.perf_counter() - t0)
+        response.close()
+    return samples
+
+def bench_stream_concurrency(args):
+    servers = {
+        f"gunicorn_sync_{args.workers}w": dict(kind="gunicorn", workers=args.workers, timeout=args.hold * 4),
+        "uvicorn_asgi": dict(kind="uvicorn"),
+    }
+
+    results = {}
+    for name, options in servers.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            _, (episode_id,), cookie = _seed_stream_db(tmp, args.size_mb)
+            with _Server(tmp=tmp, **options) as server:
+                ttfbs, page_s = asyncio.run(_run_viewers(server.port, f"/stream/{episode_id}", cookie, args))
+
+        served = sorted(t for t in ttfbs if t is not None)
+        results[name] = {
+            "clients": args.clients,
+            "served": len(served),
+            "ttfb_p50_ms": _ms(statistics.median(served)) if served else None,
+            "ttfb_max_ms": _ms(served[-1]) if served else None,
+            "page_ms": _ms(page_s) if page_s is not None else "timeout",
+        }
+
+    rows = [{"server": name, **values} for name, values in results.items()]
+    _print_table(rows, ["server", "clients", "served", "ttfb_p50_ms", "ttfb_max_ms", "page_ms"])
+    return results
+
+
+# ---------- stream-load: ผู้ชมพร้อมกันที่กระโดดดูด้วย Range request ----------
+
+def _proc_tree_usage(pid):
+    """(RSS รวมเป็นไบต์, CPU seconds รวม) ของ process และลูกโดยตรง (อ่านจาก /proc)"""
+    page = os.sysconf("SC_PAGE_SIZE")
+    ticks = os.sysconf("SC_CLK_TCK")
+    rss = cpu = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # fields[1] = ppid, [11] = utime, [12] = stime, [21] = rss (pages)
+        if int(entry) == pid or int(fields[1]) == pid:
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            rss += int(fields[21]) * page
+    return rss, cpu
+
+
+class _DriveStandIn:
+    """เซิร์ฟเวอร์แทน Google Drive ในเครื่อง: ส่งไฟล์ขนาด size ไบต์ รองรับ Range
+
+    ค่าเริ่มต้นส่งศูนย์ทั้งไฟล์ ถ้าให้ ``data`` จะส่งไบต์นั้นแทน (ใช้ตรวจเนื้อไฟล์ที่โหลดได้)
+    attribute ด้านล่างเปลี่ยนได้ระหว่างทดสอบ: ranges (False = ไม่สนใจ Range ตอบ 200 ทั้งไฟล์),
+    content_type, etag (เปลี่ยนค่า = ไฟล์เปลี่ยน, รองรับ If-Range), redirect (ให้ /download ส่ง 302 ไป /file),
+    cut_after / cuts (ตัดการเชื่อมต่อหลังส่งช่วงข้อมูลไป cut_after ไบต์ อีก cuts ครั้ง)
+    """
+
+    def __init__(self, size, bandwidth_mb=0, data=None):
+        import http.server
+        import threading
+
+        stand_in = self
+        self.size, self.requests, self.sent = size, 0, 0
+        self.data = data
+        self.ranges, self.content_type, self.etag, self.redirect = True, "video/mp4", None, False
+        self.cut_after, self.cuts = 0, 0
+        self.lock = threading.Lock()
+        block = bytes(1024 * 1024)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *a):
+                pass
+
+            def do_GET(self):
+                with stand_in.lock:
+                    stand_in.requests += 1
+                if stand_in.redirect and self.path.startswith("/download"):
+                    self.send_response(302)
+                    self.send_header("Location", "/file" + self.path[len("/download"):])
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                start, end = 0, stand_in.size - 1
+                requested = self.headers.get("Range")
+                if_range = self.headers.get("If-Range")
+                if (
+                    requested and requested.startswith("bytes=") and stand_in.ranges
+                    and (if_range is None or if_range == stand_in.etag)
+                ):
+                    first, _, last = requested[6:].partition("-")
+                    start, end = int(first), min(int(last) if last else end, end)
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{stand_in.size}")
+                else:
+                    requested = None
+                    self.send_response(200)
+                self.send_header("Content-Type", stand_in.content_type)
+                self.send_header("Content-Length", str(end - start + 1))
+                if stand_in.etag:
+                    self.send_header("ETag", stand_in.etag)
+                self.end_headers()
+
+                remaining = end - start + 1
+                with stand_in.lock:
+                    cut = requested and end > start and stand_in.cuts > 0
+                    if cut:
+                        stand_in.cuts -= 1
+                        remaining = min(remaining, stand_in.cut_after)
+                offset = start
+                try:
+                    while remaining > 0:
+                        n = min(remaining, len(block))
+                        if stand_in.data is not None:
+                            self.wfile.write(stand_in.data[offset:offset + n])
+                        else:
+                            self.wfile.write(block[:n])
+                        offset += n
+                        remaining -= n
+                        with stand_in.lock:
+                            stand_in.sent += n
+                        if bandwidth_mb:
+                            time.sleep(n / (bandwidth_mb * 1024 * 1024))
+                except OSError:
+                    pass
+                if cut:
+                    # ส่งไม่ครบ Content-Length แล้วปิด socket (เหมือนเน็ตหลุดกลางช่วง)
+                    self.close_connection = True
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/download?id={{id}}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = self.sent = 0
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+async def _range_request(port, path, cookie, start, length, timeout):
+    """GET แบบ Range หนึ่งครั้ง คืน (ttfb, จำนวนไบต์ที่ได้) หรือ None ถ้าล้มเหลว"""
+    t0 = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: bench\r\nCookie: {cookie}\r\n"
+            f"Range: bytes={start}-{start + length - 1}\r\nConnection: close\r\n\r\n".encode()
+        )
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        ttfb = time.perf_counter() - t0
+        if b" 206 " not in status_line and b" 200 " not in status_line:
+            return None
+        while (await asyncio.wait_for(reader.readline(), timeout)) not in (b"\r\n", b""):
+            pass
+        received = 0
+        while True:
+            chunk = await asyncio.wait_for(reader.read(256 * 1024), timeout)
+            if not chunk:
+                break
+            received += len(chunk)
+        return ttfb, received
+    except (OSError, asyncio.TimeoutError, ValueError):
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def _seeking_viewer(port, paths, cookie, size, args, stats, stop_at, rng):
+    """ผู้ชมหนึ่งคน: อ่านต่อเนื่องทีละ --chunk-mb และกระโดดไปตำแหน่งสุ่มตามโอกาส --seek-prob"""
+    path = rng.choice(paths)
+    chunk = args.chunk_mb * 1024 * 1024
+    position = 0
+    while time.perf_counter() < stop_at:
+        if position + chunk > size or rng.random() < args.seek_prob:
+            position = rng.randrange(0, max(1, size - chunk))
+        result = await _range_request(port, path, cookie, position, chunk, args.timeout)
+        if result is None:
+            stats["errors"] += 1
+            await asyncio.sleep(0.1)
+            continue
+        ttfb, received = result
+        stats["ttfb"].append(ttfb)
+        stats["bytes"] += received
+        position += received
+
+
+async def _saturation_probe(port, stop_at, samples):
+    """โหลดหน้า /login ทุก 0.25 วินาทีระหว่างทดสอบ ถ้า worker เต็มเวลาตอบจะพุ่งขึ้นชัดเจน"""
+    while time.perf_counter() < stop_at:
+        t0 = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), 10)
+            writer.write(b"GET /login HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            await asyncio.wait_for(reader.read(), 10)
+            writer.close()
+            samples.append(time.perf_counter() - t0)
+        except (OSError, asyncio.TimeoutError):
+            samples.append(10.0)
+        await asyncio.sleep(0.25)
+
+
+async def _run_stream_load(server, paths, cookie, size, clients, args):
+    import random
+
+    stats = {"ttfb": [], "bytes": 0, "errors": 0}
+    probe = []
+    rss_peak = 0
+    rss_idle, cpu_before = _proc_tree_usage(server.proc.pid)
+    started = time.perf_counter()
+    stop_at = started + args.duration
+
+    async def sample_rss():
+        nonlocal rss_peak
+        while time.perf_counter() < stop_at:
+            rss_peak = max(rss_peak, _proc_tree_usage(server.proc.pid)[0])
+            await asyncio.sleep(0.5)
+
+    rng = random.Random(args.seed)
+    await asyncio.gather(
+        *(
+            _seeking_viewer(server.port, paths, cookie, size, args, stats, stop_at, random.Random(rng.random()))
+            for _ in range(clients)
+        ),
+        _saturation_probe(server.port, stop_at, probe),
+        sample_rss(),
+    )
+    elapsed = time.perf_counter() - started
+    cpu_after = _proc_tree_usage(server.proc.pid)[1]
+
+    return {
+        "clients": clients,
+        "requests": len(stats["ttfb"]),
+        "errors": stats["errors"],
+        "mb_per_s": round(stats["bytes"] / elapsed / (1024 * 1024), 1),
+        **{f"ttfb_{k}": v for k, v in _percentiles(stats["ttfb"]).items()},
+        "probe_p95_ms": _percentiles(probe)["p95_ms"],
+        "rss_idle_mb": round(rss_idle / (1024 * 1024), 1),
+        "rss_peak_mb": round(rss_peak / (1024 * 1024), 1),
+        "rss_per_conn_kb": round(max(0, rss_peak - rss_idle) / clients / 1024, 1),
+        "server_cpu_pct": round((cpu_after - cpu_before) / elapsed * 100, 1),
+    }
+
+
+def bench_stream_load(args):
+    size = (args.drive_size_mb * 1024 * 1024) if args.drive else int(args.size_gb * 1024 ** 3)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        stand_in = _DriveStandIn(size, args.drive_bandwidth_mb) if args.drive else None
+        try:
+            _, episode_ids, cookie = _seed_stream_db(
+                tmp, size // (1024 * 1024), files=args.files, drive=bool(stand_in)
+            )
+            paths = [f"/stream/{episode_id}" for episode_id in episode_ids]
+            env = {"DRIVE_DOWNLOAD_URL": stand_in.url} if stand_in else None
+            with _Server(args.server, tmp, workers=args.workers, threads=args.threads,
+                         timeout=args.duration * 4, env=env) as server:
+                if stand_in:
+                    # request แรกของแต่ละตอนต้องรอโหลดไฟล์ทั้งไฟล์จาก stand-in ก่อน
+                    for path in paths:
+                        t0 = time.perf_counter()
+                        asyncio.run(_range_request(server.port, path, cookie, 0, 1024, 3600))
+                        results[f"rehydrate {path}"] = {"first_byte_ms": _ms(time.perf_counter() - t0)}
+                for clients in args.clients:
+                    results[f"{clients} clients"] = asyncio.run(
+                        _run_stream_load(server, paths, cookie, size, clients, args)
+                    )
+        finally:
+            if stand_in:
+                stand_in.close()
+
+    load_rows = [{"run": name, **values} for name, values in results.items() if "clients" in values]
+    _print_table(load_rows, [
+        "run", "requests", "errors", "mb_per_s", "ttfb_p50_ms", "ttfb_p95_ms", "ttfb_p99_ms",
+        "probe_p95_ms", "rss_peak_mb", "rss_per_conn_kb", "server_cpu_pct",
+    ])
+    for name, values in results.items():
+        if "first_byte_ms" in values:
+            print(f"{name}: first byte after Drive re-download {values['first_byte_ms']} ms")
+    return results
+
+
+# ---------- storage: throughput ของที่เก็บไฟล์ local เทียบ S3 (MinIO หรือ stand-in ในเครื่อง) ----------
+
+class _S3StandIn:
+    """เซิร์ฟเวอร์ S3 ในเครื่องแทน MinIO (moto server) ใช้เมื่อไม่ได้ระบุ --s3-endpoint"""
+
+    def __init__(self):
+        self.port = _free_port()
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "moto.server", "-H", "127.0.0.1", "-p", str(self.port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            _wait_port(self.port, self.proc)
+        except Exception:
+            self.close()
+            raise
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait(timeout=30)
+
+
+def _storage_driver_run(storage, src_path, size, args):
+    """วัด driver ตรง ๆ ใน process นี้: put แบบสตรีม, อ่านทั้งไฟล์, และ Range 1 MB แบบสุ่มพร้อมกัน"""
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+
+    key = "bench/storage.bin"
+    t0 = time.perf_counter()
+    with open(src_path, "rb") as f:
+        storage.put(key, f)
+    put_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    received = sum(len(chunk) for chunk in storage.open_range(key, 0, None, 256 * 1024))
+    read_s = time.perf_counter() - t0
+    assert received == size, (received, size)
+
+    span = 1024 * 1024
+    rng = random.Random(args.seed)
+    starts = [rng.randrange(0, size - span) for _ in range(args.reads)]
+
+    def ranged(start):
+        t = time.perf_counter()
+        chunks = storage.open_range(key, start, start + span, 256 * 1024)
+        first = next(chunks)
+        ttfb = time.perf_counter() - t
+        got = len(first) + sum(len(chunk) for chunk in chunks)
+        return ttfb, got
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        results = list(pool.map(ranged, starts))
+    ranged_s = time.perf_counter() - t0
+    storage.delete(key)
+
+    mb = size / 1024 ** 2
+    return {
+        "put_mb_s": round(mb / put_s, 1),
+        "read_mb_s": round(mb / read_s, 1),
+        "range_mb_s": round(sum(got for _, got in results) / 1024 ** 2 / ranged_s, 1),
+        **{f"range_ttfb_{k}": v for k, v in _percentiles([ttfb for ttfb, _ in results]).items()},
+    }
+
+
+def bench_storage(args):
+    sys.path.insert(0, BASE_DIR)
+    import app as appmod
+
+    size = args.size_mb * 1024 * 1024
+    stand_in = None
+    s3_env = None
+    try:
+        import boto3  # noqa: F401
+
+        if args.s3_endpoint or args.s3_bucket:
+            endpoint = args.s3_endpoint
+        else:
+            import moto  # noqa: F401
+
+            stand_in = _S3StandIn()
+            endpoint = stand_in.url
+        s3_env = {
+            "MEDIA_STORAGE": "s3",
+            "S3_BUCKET": args.s3_bucket or "myseries-bench",
+            "S3_PREFIX": f"bench-{os.getpid()}/",
+            "S3_ENDPOINT_URL": endpoint or "",
+            "S3_REGION": os.environ.get("S3_REGION") or "us-east-1",
+            "S3_ACCESS_KEY_ID": os.environ.get("S3_ACCESS_KEY_ID") or ("bench" if stand_in else ""),
+            "S3_SECRET_ACCESS_KEY": os.environ.get("S3_SECRET_ACCESS_KEY") or ("bench" if stand_in else ""),
+        }
+    except ImportError as e:
+        print(f"ข้าม S3: ไม่มีโมดูล {e.name} (pip install -r requirements-bench.txt หรือระบุ --s3-endpoint ของ MinIO)")
+
+    drivers = [("local", {"MEDIA_STORAGE": "local"})]
+    if s3_env is not None:
+        drivers.append(("s3" if not stand_in else "s3 (moto stand-in)", s3_env))
+
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            application, episode_ids, cookie = _seed_stream_db(tmp, args.size_mb)
+            with application.app_context():
+                conn = appmod.get_db_connection()
+                file_path = conn.execute(
+                    "SELECT file_path FROM episodes WHERE id = ?", (episode_ids[0],)
+                ).fetchone()[0]
+                conn.close()
+            # เนื้อไฟล์สุ่ม (ไม่ใช่ไฟล์ sparse) ที่เก็บปลายทางบีบ/ข้ามส่วนที่เป็นศูนย์ไม่ได้
+            with open(file_path, "wb") as f:
+                for _ in range(args.size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            src_path = os.path.join(tmp, "source.bin")
+            shutil.copyfile(file_path, src_path)
+
+            for name, env in drivers:
+                driver_app = appmod.create_app({
+                    **{key: application.config[key] for key in ("DB_PATH", "VIDEO_ROOT", "JINJA_CACHE_DIR")},
+                    **{key: type(application.config[key])(value) for key, value in env.items()},
+                })
+                with driver_app.app_context():
+                    storage = appmod.video_storage()
+                if name != "local":
+                    if stand_in:
+                        storage.client.create_bucket(Bucket=env["S3_BUCKET"])
+                    with open(src_path, "rb") as f:
+                        storage.put(file_path, f)
+                row = _storage_driver_run(storage, src_path, size, args)
+
+                # ผ่านแอปจริง: gunicorn ส่ง /stream จากที่เก็บนี้ให้ผู้ชมพร้อมกัน
+                with _Server("gunicorn", tmp, workers=args.workers, threads=args.threads, env=env) as server:
+                    _, cpu_before = _proc_tree_usage(server.proc.pid)
+                    start = time.perf_counter()
+                    received, errors = _download_load(
+                        server.port, f"/stream/{episode_ids[0]}", cookie, args.clients, args.duration
+                    )
+                    elapsed = time.perf_counter() - start
+                    _, cpu_after = _proc_tree_usage(server.proc.pid)
+                gb = received / 1024 ** 3
+                row["stream_mb_s"] = round(received / 1024 ** 2 / elapsed, 1)
+                row["stream_errors"] = errors
+                row["app_cpu_s_per_gb"] = round((cpu_after - cpu_before) / gb, 2) if gb else None
+                if name != "local":
+                    storage.delete(file_path)
+                results[name] = row
+    finally:
+        if stand_in:
+            stand_in.close()
+
+    rows = [{"driver": name, **values} for name, values in results.items()]
+    _print_table(rows, [
+        "driver", "put_mb_s", "read_mb_s", "range_mb_s", "range_ttfb_p50_ms", "range_ttfb_p95_ms",
+        "stream_mb_s", "stream_errors", "app_cpu_s_per_gb",
+    ])
+    print(f"ไฟล์ {args.size_mb} MB, Range 1 MB สุ่ม {args.reads} ครั้ง ({args.clients} พร้อมกัน), "
+          f"/stream: {args.clients} ผู้ชม {args.duration} วินาที gunicorn {args.workers}w x {args.threads} threads")
+    if stand_in:
+        print("S3 วัดกับ moto server ในเครื่อง (Python ล้วน) ตัวเลขต่ำกว่า MinIO/S3 จริง ใช้ --s3-endpoint เพื่อวัดของจริง")
+    return results
+
+
+# ---------- download: ตัวโหลดไฟล์ Drive แบบหลาย connection กับ stand-in ในเครื่อง ----------
+
+def bench_download(args):
+    """ตรวจ download_ranged กับ _DriveStandIn (assert ทุกกรณี) แล้ววัด MB/s แบบ connection เดียวเทียบหลายช่วง"""
+    import random
+
+    sys.path.insert(0, BASE_DIR)
+    import app as appmod
+
+    size = args.size_mb * 1024 * 1024
+    rng = random.Random(args.seed)
+    data = rng.randbytes(size)
+    stand_in = _DriveStandIn(size, data=data)
+    url = stand_in.url.format(id="bench")
+    rows, failures = [], []
+
+    def leftovers(output):
+        return [path for path in (output + ".part", output + ".part.json") if os.path.exists(path)]
+
+    def case(name, check):
+        stand_in.reset_counters()
+        t0 = time.perf_counter()
+        try:
+            check()
+            ok = "ok"
+        except AssertionError as e:
+            ok = "FAIL"
+            failures.append(f"{name}: {e}")
+        rows.append({
+            "case": name, "result": ok, "requests": stand_in.requests,
+            "mb_sent": round(stand_in.sent / 1024 ** 2, 2), "ms": _ms(time.perf_counter() - t0),
+        })
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "video.mp4")
+
+            def read_output():
+                with open(output, "rb") as f:
+                    return f.read()
+
+            def segmented():
+                stand_in.etag = '"v1"'
+                appmod.download_ranged(url, output, segments=args.segments)
+                assert read_output() == data, "เนื้อไฟล์ไม่ตรง"
+                assert stand_in.requests == 1 + args.segments, stand_in.requests
+                assert not leftovers(output), leftovers(output)
+                os.remove(output)
+
+            def interrupted():
+                # ช่วงหนึ่งหลุดกลางทาง (ผ่าน redirect) .part กับ map ต้องค้างไว้ และ map ต้องชี้ปลายทางที่ได้ไบต์มาจริง
+                stand_in.redirect, stand_in.cut_after, stand_in.cuts = True, 256 * 1024, 1
+                try:
+                    appmod.download_ranged(url, output, segments=args.segments)
+                except Exception:
+                    pass
+                else:
+                    raise AssertionError("โหลดสำเร็จทั้งที่การเชื่อมต่อถูกตัด")
+                assert not os.path.exists(output), "มีไฟล์ครึ่ง ๆ กลาง ๆ อยู่ที่ output"
+                assert len(leftovers(output)) == 2, leftovers(output)
+                with open(output + ".part.json") as f:
+                    state = json.load(f)
+                assert state.get("final_url", "").split("?")[0].endswith("/file"), state
+                assert state.get("etag") == stand_in.etag and state["size"] == size, state
+
+            def resumed():
+                with open(output + ".part.json") as f:
+                    done = sum(seg[2] for seg in json.load(f)["segments"])
+                assert 0 < done < size, done
+                appmod.download_ranged(url, output, segments=args.segments)
+                assert read_output() == data, "เนื้อไฟล์ไม่ตรงหลังโหลดต่อ"
+                # โหลดเฉพาะส่วนที่ขาด (+ 1 ไบต์ของ probe)
+                assert stand_in.sent == size - done + 1, (stand_in.sent, size - done + 1)
+                assert not leftovers(output), leftovers(output)
+                os.remove(output)
+
+            def changed_before_resume():
+                nonlocal data
+                stand_in.cuts = 1
+                try:
+                    appmod.download_ranged(url, output, segments=args.segments)
+                except Exception:
+                    pass
+                assert leftovers(output), "ไม่มี .part ให้โหลดต่อ"
+                # ไฟล์ปลายทางเปลี่ยน (ETag ใหม่) ต้องทิ้งของเดิมแล้วโหลดใหม่ทั้งไฟล์
+                data = stand_in.data = rng.randbytes(size)
+                stand_in.etag = '"v2"'
+                stand_in.reset_counters()
+                appmod.download_ranged(url, output, segments=args.segments)
+                assert read_output() == data, "เอาไบต์ของไฟล์เก่ามาต่อกับไฟล์ใหม่"
+                assert stand_in.sent == size + 1, stand_in.sent
+                os.remove(output)
+
+            def if_range():
+                # ไฟล์เปลี่ยนระหว่างโหลด: ช่วงที่ขอด้วย If-Range ของเก่าได้ 200 ต้องล้มแทนการเขียนปน
+                stand_in.redirect = False
+                original = appmod._save_segment_map
+
+                def change_after_probe(map_path, state):
+                    stand_in.etag = '"v3"'
+                    original(map_path, state)
+
+                appmod._save_segment_map = change_after_probe
+                try:
+                    appmod.download_ranged(url, output, segments=args.segments)
+                except Exception:
+                    pass
+                else:
+                    raise AssertionError("โหลดสำเร็จทั้งที่ไฟล์เปลี่ยนกลางทาง")
+                finally:
+                    appmod._save_segment_map = original
+                assert not os.path.exists(output), "มีไฟล์ปนกันอยู่ที่ output"
+                for path in leftovers(output):
+                    os.remove(path)
+
+            def no_range():
+                stand_in.ranges = False
+                appmod.download_ranged(url, output, segments=args.segments)
+                assert read_output() == data, "เนื้อไฟล์ไม่ตรง"
+                assert stand_in.requests == 1, stand_in.requests
+                assert not leftovers(output), leftovers(output)
+                os.remove(output)
+                stand_in.ranges = True
+
+            def html_content_type():
+                stand_in.content_type = "text/html; charset=utf-8"
+                try:
+                    appmod.download_ranged(url, output, segments=args.segments)
+                except appmod.DirectDownloadUnavailable:
+                    pass
+                else:
+                    raise AssertionError("ไม่ raise DirectDownloadUnavailable")
+                assert not os.path.exists(output) and not leftovers(output), leftovers(output)
+                stand_in.content_type = "video/mp4"
+
+            def html_body():
+                # Content-Type ดูเหมือนไฟล์ แต่เนื้อเป็นหน้า HTML (หน้ายืนยันของ Drive)
+                page = b"<!DOCTYPE html><html><body>confirm</body></html>"
+                stand_in.data = page + bytes(size - len(page))
+                stand_in.content_type = "application/octet-stream"
+                for ranges in (True, False):
+                    stand_in.ranges = ranges
+                    try:
+                        appmod.download_ranged(url, output, segments=args.segments)
+                    except appmod.DirectDownloadUnavailable:
+                        pass
+                    else:
+                        raise AssertionError(f"ไม่ raise DirectDownloadUnavailable (ranges={ranges})")
+                    assert not os.path.exists(output) and not leftovers(output), leftovers(output)
+                stand_in.ranges, stand_in.data, stand_in.content_type = True, data, "video/mp4"
+
+            case("segmented", segmented)
+            case("interrupted segment (via redirect)", interrupted)
+            case("resume from .part.json", resumed)
+            case("file changed before resume", changed_before_resume)
+            case("file changed during download (If-Range)", if_range)
+            case("no Range support", no_range)
+            case("HTML content type", html_content_type)
+            case("HTML body", html_body)
+    finally:
+        stand_in.close()
+
+    _print_table(rows, ["case", "result", "requests", "mb_sent", "ms"])
+
+    # ความเร็ว: stand-in จำกัดความเร็วต่อการเชื่อมต่อ (เหมือน Drive) หลายช่วงพร้อมกันจึงเร็วกว่า
+    speed_rows = []
+    throttled = _DriveStandIn(size, args.bandwidth_mb)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for segments in (1, args.segments):
+                output = os.path.join(tmp, f"speed_{segments}.mp4")
+                t0 = time.perf_counter()
+                appmod.download_ranged(throttled.url.format(id="speed"), output, segments=segments)
+                elapsed = time.perf_counter() - t0
+                speed_rows.append({"segments": segments, "seconds": round(elapsed, 2),
+                                   "mb_per_s": round(args.size_mb / elapsed, 1)})
+    finally:
+        throttled.close()
+    _print_table(speed_rows, ["segments", "seconds", "mb_per_s"])
+    print(f"ไฟล์ {args.size_mb} MB, stand-in จำกัด {args.bandwidth_mb} MB/s ต่อการเชื่อมต่อ")
+
+    if failures:
+        raise SystemExit("ไม่ผ่าน:\n" + "\n".join(failures))
+    return {"cases": rows, "speed": speed_rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MySeriesVideo benchmarks")
+    parser.add_argument("--json", help="บันทึกผลเป็นไฟล์ JSON")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("routes", help="latency / query / RSS ของทุก route บน DB จำลอง")
+    p.add_argument("--series", type=int, default=300)
+    p.add_argument("--episodes", type=int, default=20, help="จำนวนตอนต่อเรื่อง")
+    p.add_argument("--users", type=int, default=5000)
+    p.add_argument("--history", type=int, default=100000, help="จำนวนแถว watch_history")
+    p.add_argument("--runs", type=int, default=50)
+    p.add_argument("--heavy-runs", type=int, default=5, help="จำนวนรอบของ backup/restore")
+    p.add_argument("--only", nargs="*", help="รันเฉพาะ route ที่ระบุ")
+    p.set_defaults(func=bench_routes)
+
+    p = sub.add_parser("startup", help="เวลา import / create_app / request แรก")
+    p.add_argument("--runs", type=int, default=5)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("templates", help="เวลา render template: compile ใหม่ / จาก bytecode cache / จากหน่วยความจำ")
+    p.add_argument("--runs", type=int, default=20)
+    p.add_argument("--rows", type=int, default=50, help="จำนวนซีรีส์/ตอนในข้อมูลจำลอง")
+    p.set_defaults(func=bench_templates)
+
+    p = sub.add_parser("stream-concurrency", help="จำนวนผู้ชมพร้อมกันที่ได้ภาพทันเวลา: gunicorn sync เทียบ asgi.py")
+    p.add_argument("--clients", type=int, default=200)
+    p.add_argument("--workers", type=int, default=4, help="จำนวน worker ของ gunicorn (sync)")
+    p.add_argument("--hold", type=int, default=10, help="วินาทีที่ผู้ชมแต่ละคนค้างการเชื่อมต่อ")
+    p.add_argument("--rate-kb", type=int, default=64, help="KB ที่ผู้ชมอ่านต่อวินาที")
+    p.add_argument("--ttfb-timeout", type=float, default=5.0)
+    p.add_argument("--size-mb", type=int, default=512, help="ขนาดไฟล์วิดีโอจำลอง (sparse)")
+    p.set_defaults(func=bench_stream_concurrency)
+
+    p = sub.add_parser("stream-token", help="ต้นทุนต่อ Range request: session + DB เทียบลิงก์สตรีมแบบลงชื่อ")
+    p.add_argument("--runs", type=int, default=2000)
+    p.add_argument("--range-kb", type=int, default=64, help="ขนาดต่อ Range request")
+    p.add_argument("--size-mb", type=int, default=256, help="ขนาดไฟล์วิดีโอจำลอง (sparse)")
+    p.add_argument("--limiter-streams", type=int, default=4,
+                   help="STREAM_MAX_CONCURRENT ของรอบที่เปิดตัวจำกัด")
+    p.add_argument("--limiter-rate-mb", type=int, default=1024,
+                   help="STREAM_USER_RATE_BYTES (MB/s) ของรอบที่เปิดตัวจำกัด")
+    p.set_defaults(func=bench_stream_token)
+
+    p = sub.add_parser("offload", help="ตรวจ STREAM_OFFLOAD=nginx กับ nginx จริง และเทียบ MB/s / CPU ของ worker")
+    p.add_argument("--nginx", help="path ของ nginx (ค่าเริ่มต้น: หาจาก PATH ไม่เจอ = ข้าม)")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--clients", type=int, default=8)
+    p.add_argument("--duration", type=int, default=10, help="วินาทีต่อโหมด")
+    p.add_argument("--size-mb", type=int, default=64, help="ขนาดไฟล์วิดีโอจำลอง (ข้อมูลสุ่ม)")
+    p.set_defaults(func=bench_offload)
+
+    p = sub.add_parser("coherence", help="หลาย process: catalog ในหน่วยความจำเห็นการแก้ไขของ process อื่นภายในกี่ ms")
+    p.add_argument("--workers", type=int, default=4, help="จำนวน process ที่อ่าน catalog")
+    p.add_argument("--interval", type=float, default=0.5, help="CACHE_CHECK_INTERVAL ของ process อ่าน")
+    p.add_argument("--writes", type=int, default=6, help="จำนวนครั้งที่แก้ต่อรอบ")
+    p.add_argument("--pause", type=float, default=0.8, help="วินาทีระหว่างการแก้แต่ละครั้ง (ต้องมากกว่า --interval)")
+    p.set_defaults(func=bench_coherence)
+
+    p = sub.add_parser("login-burst", help="ล็อกอินพร้อมกันระหว่างมีผู้ชมสตรีม: แฮชใน thread ของ request เทียบ process pool")
+    p.add_argument("--logins", type=int, default=64, help="จำนวนคนที่กดล็อกอินพร้อมกัน")
+    p.add_argument("--viewers", type=int, default=8, help="ผู้ชมที่ขอ Range 64 KB ต่อเนื่องระหว่างนั้น")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--hash-workers", type=int, default=2, help="PASSWORD_HASH_WORKERS ของโหมด pool")
+    p.add_argument("--queue-limit", type=int, default=4, help="PASSWORD_HASH_QUEUE_LIMIT")
+    p.add_argument("--baseline", type=float, default=2, help="วินาทีที่วัดผู้ชมก่อนเริ่มล็อกอิน")
+    p.set_defaults(func=bench_login_burst)
+
+    p = sub.add_parser("user-search", help="ค้นหาผู้ใช้ในหน้าแอดมิน: LIKE ทั้งตารางแบบเดิม เทียบ trigram / key prefix / แบ่งหน้า")
+    p.add_argument("--users", type=int, default=1000000)
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--page-size", type=int, default=100)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_user_search)
+
+    p = sub.add_parser("compression", help="gzip/brotli: ไบต์ที่ประหยัดได้ต่อ route เทียบ CPU ที่ใช้บีบ และผลของแคช")
+    p.add_argument("--series", type=int, default=300)
+    p.add_argument("--episodes", type=int, default=20, help="จำนวนตอนต่อเรื่อง")
+    p.add_argument("--users", type=int, default=5000)
+    p.add_argument("--history", type=int, default=20000, help="จำนวนแถว watch_history")
+    p.add_argument("--runs", type=int, default=10)
+    p.add_argument("--gzip-levels", type=int, nargs="+", default=[1, 6, 9])
+    p.add_argument("--br-qualities", type=int, nargs="+", default=[4, 5, 11], help="ใช้เมื่อติดตั้งโมดูล brotli")
+    p.set_defaults(func=bench_compression)
+
+    p = sub.add_parser("download", help="ตรวจตัวโหลดไฟล์ Drive แบบหลายช่วงกับ stand-in: โหลดต่อ, ช่วงที่หลุด, ไม่มี Range, หน้า HTML")
+    p.add_argument("--size-mb", type=int, default=16)
+    p.add_argument("--segments", type=int, default=4)
+    p.add_argument("--bandwidth-mb", type=float, default=20, help="ความเร็วต่อการเชื่อมต่อของ stand-in ตอนวัด MB/s")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_download)
+
+    p = sub.add_parser("storage", help="MB/s ของที่เก็บไฟล์ local เทียบ S3: put แบบ multipart, ranged GET และ /stream ผ่าน gunicorn")
+    p.add_argument("--size-mb", type=int, default=256, help="ขนาดไฟล์ทดสอบ")
+    p.add_argument("--reads", type=int, default=200, help="จำนวน Range 1 MB แบบสุ่ม")
+    p.add_argument("--clients", type=int, default=8, help="Range / ผู้ชม /stream พร้อมกัน")
+    p.add_argument("--duration", type=int, default=10, help="วินาทีที่โหลด /stream ต่อ driver")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--s3-endpoint", default=os.environ.get("S3_ENDPOINT_URL", ""),
+                   help="endpoint ของ MinIO (ว่าง = ใช้ moto server ในเครื่องแทน), credential จาก S3_ACCESS_KEY_ID/S3_SECRET_ACCESS_KEY")
+    p.add_argument("--s3-bucket", default=os.environ.get("S3_BUCKET", ""), help="bucket ที่มีอยู่แล้ว (ว่าง = สร้างใน stand-in)")
+    p.set_defaults(func=bench_storage)
+
+    p = sub.add_parser("stream-load", help="MB/s, TTFB, หน่วยความจำต่อการเชื่อมต่อ ของ /stream ภายใต้ Range request พร้อมกัน")
+    p.add_argument("--server", choices=("gunicorn", "uvicorn"), default="gunicorn")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--threads", type=int, default=1, help="--threads ของ gunicorn (1 = sync worker)")
+    p.add_argument("--clients", type=int, nargs="+", default=[4, 16, 64], help="ไล่จำนวนผู้ชมพร้อมกัน")
+    p.add_argument("--duration", type=int, default=15, help="วินาทีต่อรอบ")
+    p.add_argument("--files", type=int, default=4, help="จำนวนไฟล์วิดีโอ (ตอน)")
+    p.add_argument("--size-gb", type=float, default=4, help="ขนาดไฟล์ sparse ต่อไฟล์")
+    p.add_argument("--chunk-mb", type=int, default=2, help="ขนาดต่อ Range request")
+    p.add_argument("--seek-prob", type=float, default=0.2, help="โอกาสที่ผู้ชมกระโดดไปตำแหน่งสุ่มต่อ request")
+    p.add_argument("--timeout", type=float, default=30)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--drive", action="store_true", help="ตอนแบบ gdrive ที่ไฟล์หาย ต้องโหลดใหม่จาก stand-in server ในเครื่อง")
+    p.add_argument("--drive-size-mb", type=int, default=256, help="ขนาดไฟล์จาก stand-in (โหมด --drive)")
+    p.add_argument("--drive-bandwidth-mb", type=float, default=0, help="จำกัดความเร็ว stand-in (MB/s, 0 = ไม่จำกัด)")
+    p.set_defaults(func=bench_stream_load)
+
+    args = parser.parse_args(argv)
+    results = args.func(args)
+    if args.json:
+        with open(args.json, "w") as f:
+            params = {k: v for k, v in vars(args).items() if k not in ("func", "json", "command")}
+            json.dump(
+                {
+                    "command": args.command,
+                    "commit": _git_commit(),
+                    "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "params": params,
+                    "results": results,
+                },
+                f, ensure_ascii=False, indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
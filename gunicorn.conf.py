@@ -0,0 +1,4 @@
+# ตั้งค่า gunicorn: gunicorn -c gunicorn.conf.py
+# process แม่เรียก create_app() ครั้งเดียว (ตรวจ schema + warm-up) ก่อน fork worker
+wsgi_app = "app:create_app()"
+preload_app = True